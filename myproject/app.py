@@ -1,5 +1,5 @@
-import os, sys, random
-from flask import Flask, render_template, redirect, request
+import argparse, os, sys
+from flask import Flask, render_template, redirect, request, session
 from waitress import serve
 
 # 添加项目路径到Python路径
@@ -7,16 +7,35 @@ current_dir = os.path.dirname(os.path.abspath(__file__))
 app_dir = os.path.join(current_dir, 'app')
 sys.path.insert(0, app_dir)
 
+from app import db, avatar, usernames, assets, events, metrics, profiling, compression, sessions, prefork, suggestions, hashing
 from app.views.account import ac
 from app.views.about import ab
 from app.views.friend import fr
+from app.views.echocave import ec
+from app.views.chat import Chat
+from app.echocave import store as echocave_store
 
+THREADS = 16  # waitress 线程数（多进程模式下是每个 worker 的线程数），数据库连接池也按这个大小创建
+PORT = int(os.environ.get('PORT', 5000))
+WORKERS = int(os.environ.get('WORKERS', 0)) or os.cpu_count() or 1  # 多进程模式的 worker 数，默认等于CPU核数
+
+hashing.init(THREADS)
 app = Flask(__name__)
 # 配置Session密钥
 app.secret_key = '你的超级安全密钥_可以随便改_但要够长bruh233333'
+metrics.init_app(app)
+profiling.init_app(app)
+db.init_app(app)
+sessions.init_app(app)
+assets.init_app(app)
+avatar.init_app(app)
+events.init_app(app)
+compression.init_app(app)
 app.register_blueprint(ac)
 app.register_blueprint(ab)
 app.register_blueprint(fr)
+app.register_blueprint(ec)
+app.register_blueprint(Chat)
 
 @app.route('/')
 def goto_home():
@@ -24,34 +43,74 @@ def goto_home():
 
 @app.route('/home')
 def index():
-    # 一次性读取所有回声洞内容
-    with open('echohole.txt', 'r', encoding='utf-8') as f:
-        all_echocaves = [line.strip() for line in f if line.strip()]
-    
-    # 随机选择一条用于初始显示
-    initial_echocave = random.choice(all_echocaves) if all_echocaves else "暂无内容"
+    # 页面只带一条回声洞，"换一条"时再通过 /api/echocave/random 获取
+    initial_echocave, session['echocave'] = echocave_store.next_unique(session.get('echocave'))
     
     return render_template('index.html', 
-                         echocave=initial_echocave,
-                         all_echocaves=all_echocaves)
+                         echocave=initial_echocave or "暂无内容")
+
+
+def warm_up():
+    """启动时把连接池、用户名过滤器、好友关系图、回声洞、静态资源哈希和模板都准备好，第一个请求不用等"""
+    db.init_pool(size=THREADS)
+    os.makedirs(avatar.UPLOAD_FOLDER, exist_ok=True)
+    with db.connection() as conn:
+        usernames.load(conn)
+        suggestions.graph.rebuild(conn)
+    len(echocave_store)  # 提前加载回声洞内容
+    assets.warm_up()
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='启动网站')
+    parser.add_argument('--prefork', action='store_true',
+                        help='多进程模式：主进程监听端口，预先启动多个 worker 进程处理请求（仅 Linux/macOS）')
+    parser.add_argument('--workers', type=int, default=WORKERS, help=f'多进程模式的 worker 数，默认 {WORKERS}（CPU核数）')
+    parser.add_argument('--reuse-port', action='store_true',
+                        help='多进程模式下每个 worker 用 SO_REUSEPORT 各自监听端口，由内核分配连接')
+    args = parser.parse_args()
+
+    if prefork.is_worker():
+        # 推送服务在主进程里，worker 只负责发令牌
+        events.gateway.configure(app.secret_key)
+        prefork.run_worker(app, warm_up, THREADS)
+        sys.exit(0)
+
+    if args.prefork and not prefork.supported():
+        print('⚠️ 当前系统不支持多进程模式，改用单进程运行')
+        args.prefork = False
+    if args.reuse_port and not prefork.reuse_port_supported():
+        print('⚠️ 当前系统不支持 SO_REUSEPORT，改用共享的监听 socket')
+        args.reuse_port = False
+
     print('-' * 50)
     print('网站启动中...')
     print('数据库路径:', os.path.join(os.getcwd(), 'database.db'))
     print('项目路径:', os.getcwd())
-    print('服务地址: http://127.0.0.1:5000')
+    print(f'服务地址: http://127.0.0.1:{PORT}')
+    print(f'推送服务: http://127.0.0.1:{events.EVENTS_PORT}')
+    if args.prefork:
+        print(f'多进程模式: {args.workers} 个 worker，每个 {THREADS} 个线程')
     print('-' * 50)
 
-    # 确保数据库文件存在
-    if not os.path.exists('database.db'):
-        print('📦 初始化数据库中...')
-        from app.views.account import init_db
-        init_db()
+    print('📦 初始化数据库中...')
+    if args.prefork:
+        # 迁移只在主进程里执行一次，worker 启动时数据库已经是最新的（WAL 模式，多个进程可以同时读）
+        db.init_pool(size=1)
+        events.gateway.start(app.secret_key)
+        os.environ['EVENTS_PORT'] = str(events.gateway.port)
+        master = prefork.Master([sys.executable, os.path.abspath(__file__)], args.workers,
+                                host='0.0.0.0', port=PORT, reuse_port=args.reuse_port)
+        sys.exit(master.run())
+
+    # 启动时建好连接池并执行数据库迁移，之后的请求直接复用连接
+    warm_up()
+    events.gateway.start(app.secret_key)
 
     try:
-        serve(app, host='0.0.0.0', port=5000, threads=16)
+        serve(app, host='0.0.0.0', port=PORT, threads=THREADS)
         #app.run(host='0.0.0.0', port=5000, debug=True)
     except Exception as e:
         print('启动失败:', str(e))
@@ -3,11 +3,23 @@ from flask import Flask
 def create_app():
     app = Flask(__name__)
 
+    from . import db, assets, avatar, events, metrics, profiling, compression, sessions
+    metrics.init_app(app)
+    profiling.init_app(app)
+    db.init_app(app)
+    sessions.init_app(app)
+    assets.init_app(app)
+    avatar.init_app(app)
+    events.init_app(app)
+    compression.init_app(app)
+
     from .views import account
     from .views import chat
     from .views import about
+    from .views import echocave
     app.register_blueprint(account.ac)
     app.register_blueprint(about.ab)
     app.register_blueprint(chat.Chat)
+    app.register_blueprint(echocave.ec)
 
     return app
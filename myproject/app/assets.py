@@ -0,0 +1,171 @@
+from flask import Blueprint, request, send_file, abort
+from werkzeug.security import safe_join
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+import threading
+
+try:
+    import brotli
+except ImportError:  # brotli 是可选依赖，没装时只生成 gzip
+    brotli = None
+
+STATIC_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'static')
+# 构建产物：带内容哈希的文件名 + 预压缩文件 + manifest.json
+BUILD_FOLDER = os.path.join(STATIC_FOLDER, 'dist')
+MANIFEST_PATH = os.path.join(BUILD_FOLDER, 'manifest.json')
+# 用户上传的文件不是构建产物，不参与指纹化
+EXCLUDED_DIRS = {'uploads', 'dist'}
+COMPRESSIBLE = {'.css', '.js', '.map', '.svg', '.json', '.txt', '.html'}
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+assets = Blueprint('assets', __name__)
+
+# 原始路径 -> 带哈希的路径，以及反过来的映射
+_manifest = {}
+_reverse = {}
+_built = False
+_lock = threading.Lock()
+
+
+def fingerprint(path):
+    """计算文件内容哈希，取前10位"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:10]
+
+
+def hashed_name(name, digest):
+    """bootstrap.min.css -> bootstrap.min.3f2a9c0d1e.css"""
+    root, ext = os.path.splitext(name)
+    return f"{root}.{digest}{ext}"
+
+
+def iter_static_files():
+    """遍历 static 目录下需要指纹化的文件，返回以 / 分隔的相对路径"""
+    for root, dirs, files in os.walk(STATIC_FOLDER):
+        rel_root = os.path.relpath(root, STATIC_FOLDER)
+        if rel_root == '.':
+            dirs[:] = [d for d in dirs if d not in EXCLUDED_DIRS]
+        for name in files:
+            yield os.path.normpath(os.path.join(rel_root, name)).replace(os.sep, '/')
+
+
+def build():
+    """构建：复制成带哈希的文件名，生成 gzip/brotli 预压缩文件和 manifest.json，返回文件数"""
+    global _built
+    if os.path.exists(BUILD_FOLDER):
+        shutil.rmtree(BUILD_FOLDER)
+    manifest = {}
+    for logical in iter_static_files():
+        source = os.path.join(STATIC_FOLDER, logical)
+        target = hashed_name(logical, fingerprint(source))
+        output = os.path.join(BUILD_FOLDER, target)
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        shutil.copyfile(source, output)
+        if os.path.splitext(logical)[1] in COMPRESSIBLE:
+            with open(source, 'rb') as f:
+                data = f.read()
+            with open(output + '.gz', 'wb') as f:
+                f.write(gzip.compress(data, compresslevel=9, mtime=0))
+            if brotli is not None:
+                with open(output + '.br', 'wb') as f:
+                    f.write(brotli.compress(data, quality=11))
+        manifest[logical] = target
+    with open(MANIFEST_PATH, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    with _lock:
+        _manifest.clear()
+        _reverse.clear()
+        _built = False
+    return len(manifest)
+
+
+def _load_manifest():
+    """读取构建好的 manifest；没有构建过时为空，之后按需计算哈希"""
+    global _built
+    with _lock:
+        if _built:
+            return
+        if os.path.exists(MANIFEST_PATH):
+            with open(MANIFEST_PATH, encoding='utf-8') as f:
+                _manifest.update(json.load(f))
+            _reverse.update({v: k for k, v in _manifest.items()})
+        _built = True
+
+
+def asset_url(path):
+    """模板里用：把 static 下的路径转换成带内容哈希的URL"""
+    _load_manifest()
+    target = _manifest.get(path)
+    if target is None:
+        # 没有执行构建步骤时，启动后第一次用到再计算哈希，直接读 static 目录下的原文件
+        source = os.path.join(STATIC_FOLDER, path)
+        if not os.path.isfile(source):
+            return f"/static/{path}"
+        target = hashed_name(path, fingerprint(source))
+        with _lock:
+            _manifest[path] = target
+            _reverse[target] = path
+    return f"/assets/{target}"
+
+
+def warm_up():
+    """启动时把 static 下所有文件的哈希算好，返回文件数"""
+    count = 0
+    for logical in iter_static_files():
+        asset_url(logical)
+        count += 1
+    return count
+
+
+def _pick_encoding(path):
+    """按 Accept-Encoding 选出已经预压缩好的文件"""
+    accepted = request.accept_encodings
+    for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if accepted[encoding] and os.path.isfile(path + suffix):
+            return encoding, path + suffix
+    return None, path
+
+
+@assets.route('/assets/<path:filename>')
+def serve_asset(filename):
+    """带哈希的文件永久缓存；原始文件名（比如 .map 的相对引用）每次都要验证"""
+    _load_manifest()
+    logical = _reverse.get(filename)
+    if logical is None:
+        if filename.split('/', 1)[0] in EXCLUDED_DIRS:
+            abort(404)
+        path = safe_join(STATIC_FOLDER, filename)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+        response = send_file(path, conditional=True, max_age=0)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    built = os.path.join(BUILD_FOLDER, filename)
+    path = built if os.path.isfile(built) else os.path.join(STATIC_FOLDER, logical)
+    encoding, path = _pick_encoding(path)
+    response = send_file(
+        path,
+        mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+        etag=False
+    )
+    # 文件名里已经带了内容哈希，直接拿来当 ETag
+    response.set_etag(f"{filename}-{encoding}" if encoding else filename)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = IMMUTABLE
+    return response.make_conditional(request)
+
+
+def init_app(app):
+    """注册静态资源路由和模板里的 asset_url"""
+    app.register_blueprint(assets)
+    app.add_template_global(asset_url)
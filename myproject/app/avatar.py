@@ -0,0 +1,464 @@
+from concurrent.futures import ProcessPoolExecutor
+from flask import Blueprint, request, send_file, abort
+import hashlib
+import os
+import re
+import threading
+import time
+import uuid
+
+from app import bus, writer
+from app.assets import IMMUTABLE
+from app.metrics import avatar_render_seconds
+from app.pagecache import bump, bump_related
+
+# 头像上传目录（myproject/static/uploads）
+UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'static', 'uploads')
+# 上传的原图先放到暂存目录，处理完再删掉
+STAGING_FOLDER = os.path.join(UPLOAD_FOLDER, 'staging')
+# 按内容寻址的头像：avatars/<user_id>/<内容哈希>_<尺寸>.<格式>，通过 /avatars/... 永久缓存
+AVATAR_FOLDER = os.path.join(UPLOAD_FOLDER, 'avatars')
+DEFAULT_AVATAR = '/static/uploads/default.png'
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp']
+
+# 每个头像生成的尺寸：列表用小图，个人资料页用大图
+RENDITIONS = {'small': 48, 'medium': 128, 'large': 800}
+FORMATS = {'jpg': 'JPEG', 'webp': 'WEBP'}
+SAVE_OPTIONS = {'JPEG': {'quality': 85, 'optimize': True}, 'WEBP': {'quality': 80, 'method': 4}}
+# 参与内容哈希：同一张图换了尺寸或压缩参数，生成的文件不一样，URL 也要跟着变
+RENDER_SETTINGS = repr((sorted(RENDITIONS.items()), sorted(FORMATS.items()), sorted(SAVE_OPTIONS.items()))).encode()
+HASH_LENGTH = 16
+GC_GRACE = 3600    # 秒，头像被替换后旧文件再保留这么久，刚渲染出来、还引用旧地址的页面不会显示裂图
+_AVATAR_NAME = re.compile(r'[0-9a-f]{%d}_\d+\.(jpg|webp)' % HASH_LENGTH)
+# 旧式前缀文件：<user_id>_<token>_<尺寸>.<格式>
+_LEGACY_RENDITION = re.compile(r'(\d+_\w+)_\d+\.(?:jpg|webp)')
+
+WORKERS = 2        # 处理图片的进程数
+MAX_PENDING = 32   # 排队中的头像任务上限，超过就让用户稍后再试
+
+# 进程内头像缓存：user_id -> (文件名, 版本号)，命中时不需要查库也不需要访问文件系统
+_cache = {}
+_cache_lock = threading.Lock()
+
+# 正在处理的头像任务和处理失败的原因，都按 user_id 记录
+_pending = {}
+_failed = {}
+_jobs_lock = threading.Lock()
+_executor = None
+
+# 等着清理旧头像文件的用户，由一个后台线程成批处理
+_gc_pending = set()
+_gc_running = False
+_gc_lock = threading.Lock()
+
+
+def avatar_url(filename, version=0, size='large', fmt='jpg'):
+    """根据数据库里记录的头像拼出URL
+
+    新头像记录的是 "<user_id>/<内容哈希>"，地址里带着哈希，内容变了地址就变，可以永久缓存；
+    稍早的头像记录的是不带扩展名的前缀，每个尺寸和格式各有一个文件；
+    更早的头像（带扩展名）只有一个原始文件，用版本号让浏览器缓存失效。
+    """
+    if not filename:
+        return DEFAULT_AVATAR
+    if '/' in filename:
+        return f"/avatars/{filename}_{RENDITIONS[size]}.{fmt}"
+    if '.' in filename:
+        return f"/static/uploads/{filename}?v={version}" if version else f"/static/uploads/{filename}"
+    return f"/static/uploads/{filename}_{RENDITIONS[size]}.{fmt}"
+
+
+def remember(user_id, filename, version=0):
+    """把查询结果顺手放进缓存"""
+    with _cache_lock:
+        _cache[user_id] = (filename, version)
+
+
+def get_avatar(db, user_id, size='large', fmt='jpg'):
+    """获取用户头像URL，优先读缓存"""
+    cached = _cache.get(user_id)
+    if cached is None:
+        cursor = db.conn.execute(
+            "SELECT avatar, avatar_version FROM users WHERE id = ?",
+            (user_id,)
+        )
+        result = cursor.fetchone()
+        if not result:
+            return DEFAULT_AVATAR
+        cached = (result[0], result[1])
+        remember(user_id, *cached)
+    return avatar_url(*cached, size=size, fmt=fmt)
+
+
+def _switch_avatar(db, user_id, filename):
+    """在写队列里执行：换成新头像，返回 (旧头像, 新的头像版本)"""
+    previous = db.conn.execute(
+        "SELECT avatar FROM users WHERE id = ?",
+        (user_id,)
+    ).fetchone()
+    db.conn.execute(
+        "UPDATE users SET avatar = ?, avatar_version = avatar_version + 1 WHERE id = ?",
+        (filename, user_id)
+    )
+    version = db.conn.execute(
+        "SELECT avatar_version FROM users WHERE id = ?",
+        (user_id,)
+    ).fetchone()[0]
+    return (previous[0] if previous else None), version
+
+
+def _avatar_switched(db, user_id, filename, version):
+    """新头像提交之后更新缓存：好友列表、好友请求里都会显示头像"""
+    bump_related(db, user_id)
+    remember(user_id, filename, version)
+    bus.broadcast('avatar.changed', user_id)
+
+
+def _avatar_switched_later(user_id, filename, result):
+    """排队超时的头像切换之后才提交时，在后台线程里补上缓存更新"""
+    from app.db import connection
+    with connection() as db:
+        _avatar_switched(db, user_id, filename, result[1])
+
+
+def set_avatar(db, user_id, filename):
+    """头像文件保存成功后交给写队列记录到数据库，并更新缓存，返回被替换掉的旧头像"""
+    try:
+        previous, version = writer.execute(_switch_avatar, user_id, filename)
+    except writer.WriteBusy as busy:
+        busy.then(lambda result: _avatar_switched_later(user_id, filename, result))
+        raise
+    _avatar_switched(db, user_id, filename, version)
+    return previous
+
+
+def forget(user_id=None):
+    """清掉某个用户（或全部）的头像缓存"""
+    with _cache_lock:
+        if user_id is None:
+            _cache.clear()
+        else:
+            _cache.pop(user_id, None)
+
+
+bus.subscribe('avatar.changed', forget)
+
+
+def rendition_files(filename):
+    """某个头像在磁盘上对应的全部文件名（相对于上传目录）"""
+    if '.' in filename:
+        return [filename]
+    if '/' in filename:
+        return [os.path.join('avatars', f"{filename}_{px}.{ext}") for px in RENDITIONS.values() for ext in FORMATS]
+    return [f"{filename}_{px}.{ext}" for px in RENDITIONS.values() for ext in FORMATS]
+
+
+def content_hash(file_data):
+    """上传的原图加上生成参数算出的哈希，同一张图生成的文件完全一样，可以共用一个地址"""
+    digest = hashlib.sha256(RENDER_SETTINGS)
+    digest.update(file_data)
+    return digest.hexdigest()[:HASH_LENGTH]
+
+
+def render_avatar(staging_path, user_id):
+    """在子进程里执行：校验图片并生成各个尺寸的JPEG/WebP文件，返回要记进数据库的 "<user_id>/<内容哈希>"
+
+    文件先写到临时文件再改名，永久缓存的地址上不会读到写了一半的文件。
+    """
+    import io
+    from PIL import Image
+
+    with open(staging_path, 'rb') as f:
+        file_data = f.read()
+
+    # 验证图片完整性，verify()之后需要重新打开
+    Image.open(io.BytesIO(file_data)).verify()
+    image = Image.open(io.BytesIO(file_data))
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    prefix = f"{user_id}/{content_hash(file_data)}"
+    directory = os.path.join(AVATAR_FOLDER, str(user_id))
+    os.makedirs(directory, exist_ok=True)
+    # 从大到小依次缩放，小图直接在上一张的基础上缩，省掉重复的大图缩放
+    for px in sorted(RENDITIONS.values(), reverse=True):
+        if image.width > px or image.height > px:
+            image.thumbnail((px, px), Image.Resampling.LANCZOS)
+        for ext, fmt in FORMATS.items():
+            output_path = os.path.join(UPLOAD_FOLDER, 'avatars', f"{prefix}_{px}.{ext}")
+            temp_path = f"{output_path}.{uuid.uuid4().hex[:8]}.tmp"
+            try:
+                image.save(temp_path, fmt, **SAVE_OPTIONS[fmt])
+                os.replace(temp_path, output_path)
+            except BaseException:
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+                raise
+    return prefix
+
+
+def _timed_render(staging_path, user_id):
+    """在子进程里执行：生成头像并返回 ("<user_id>/<内容哈希>", 耗时)，耗时由主进程计入统计"""
+    start = time.perf_counter()
+    return render_avatar(staging_path, user_id), time.perf_counter() - start
+
+
+def _get_executor():
+    global _executor
+    with _jobs_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=WORKERS)
+    return _executor
+
+
+def submit_avatar(file_data, user_id):
+    """把上传的图片写进暂存目录并交给进程池处理，返回 (是否已受理, 提示信息)"""
+    with _jobs_lock:
+        if user_id in _pending:
+            return False, "上一张头像还在处理中，请稍后再试"
+        if len(_pending) >= MAX_PENDING:
+            return False, "服务器繁忙，请稍后再试"
+        _pending[user_id] = None
+        _failed.pop(user_id, None)
+    bus.broadcast('avatar.job', [user_id, True, None])
+    bump(user_id)  # 个人资料页要显示"处理中"
+
+    try:
+        os.makedirs(STAGING_FOLDER, exist_ok=True)
+        token = uuid.uuid4().hex[:12]
+        staging_path = os.path.join(STAGING_FOLDER, f"{user_id}_{token}")
+        with open(staging_path, 'wb') as f:
+            f.write(file_data)
+        future = _get_executor().submit(_timed_render, staging_path, user_id)
+    except Exception:
+        with _jobs_lock:
+            _pending.pop(user_id, None)
+        bus.broadcast('avatar.job', [user_id, False, None])
+        raise
+
+    with _jobs_lock:
+        _pending[user_id] = future
+    future.add_done_callback(lambda f: _finish_avatar(f, user_id, staging_path))
+    return True, "头像已上传，正在处理中"
+
+
+def _finish_avatar(future, user_id, staging_path):
+    """子进程处理完成后切换到新头像，在这之前页面一直显示旧头像"""
+    from app.db import connection
+
+    try:
+        prefix, elapsed = future.result()
+        avatar_render_seconds.observe(elapsed)
+        with connection() as db:
+            previous = set_avatar(db, user_id, prefix)
+            small = get_avatar(db, user_id, size='small')
+    except writer.WriteBusy as busy:
+        if busy.future is None:
+            return _end_job(user_id, "服务器繁忙，头像没有更新，请稍后重新上传")
+        # 切换还在写队列里排着，之后仍会提交：保持"处理中"，提交了再收尾，最后没写成功才算失败
+        busy.then(lambda result: _avatar_ready(user_id, prefix, result[0], avatar_url(prefix, result[1], size='small')))
+        busy.future.add_done_callback(
+            lambda f: f.exception() is not None and _end_job(user_id, "服务器繁忙，头像没有更新，请稍后重新上传"))
+        return
+    except Exception as e:
+        return _end_job(user_id, f"图片处理失败: {str(e)}")
+    finally:
+        try:
+            os.remove(staging_path)
+        except OSError:
+            pass
+    _avatar_ready(user_id, prefix, previous, small)
+
+
+def _avatar_ready(user_id, prefix, previous, small):
+    """新头像提交之后收尾：其他设备上的会话里记录的头像也换掉，旧文件等着清理，结束"处理中"状态"""
+    from app.sessions import store as sessions
+
+    try:
+        sessions.update_user(user_id, profile_picture_path=small)
+        # 新头像已经生效：旧文件记下被替换的时间，过了 GC_GRACE 由 collect_garbage 删掉
+        if previous and previous != prefix:
+            retire(previous)
+        _schedule_gc(user_id)
+    finally:
+        _end_job(user_id)
+
+
+def _end_job(user_id, error=None):
+    """头像任务结束，失败时记下原因给个人资料页显示"""
+    with _jobs_lock:
+        _pending.pop(user_id, None)
+        if error:
+            _failed[user_id] = error
+    bus.broadcast('avatar.job', [user_id, False, error])
+    bump(user_id)
+
+
+def _job_remote(payload):
+    """其他 worker 上的头像任务开始或结束了，这里也记一下，刷新页面打到哪个 worker 都一样"""
+    user_id, processing, error = payload
+    with _jobs_lock:
+        if processing:
+            _pending.setdefault(user_id, None)
+        elif _pending.get(user_id, False) is None:
+            del _pending[user_id]
+        if error:
+            _failed[user_id] = error
+
+
+bus.subscribe('avatar.job', _job_remote)
+
+
+def avatar_status(user_id):
+    """查询头像任务状态，返回 (是否处理中, 失败原因)；失败原因只返回一次"""
+    with _jobs_lock:
+        return user_id in _pending, _failed.pop(user_id, None)
+
+
+def backfill(conn):
+    """扫描一遍上传目录，把已有的头像文件登记到还没有头像记录的用户上，返回登记数量"""
+    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+    found = {}
+    for filename in os.listdir(UPLOAD_FOLDER):
+        user_id, ext = os.path.splitext(filename)
+        ext = ext.lower()
+        if not user_id.isdigit() or ext not in IMAGE_EXTENSIONS:
+            continue
+        # 同一个用户有多个文件时，和以前逐个探测的顺序保持一致
+        current = found.get(int(user_id))
+        if current is None or IMAGE_EXTENSIONS.index(ext) < IMAGE_EXTENSIONS.index(os.path.splitext(current)[1].lower()):
+            found[int(user_id)] = filename
+
+    cursor = conn.executemany(
+        "UPDATE users SET avatar = ?, avatar_version = 1 WHERE id = ? AND avatar IS NULL",
+        [(filename, user_id) for user_id, filename in found.items()]
+    )
+    forget()
+    return cursor.rowcount
+
+
+def retire(filename):
+    """头像被替换时调用：把旧文件的修改时间改成现在，collect_garbage 从这时开始计算保留期"""
+    for name in rendition_files(filename):
+        try:
+            os.utime(os.path.join(UPLOAD_FOLDER, name))
+        except OSError:
+            pass
+
+
+def collect_garbage(user_ids=None, grace=GC_GRACE):
+    """删掉已经不用的头像文件，返回删除的文件数
+
+    按内容寻址的目录里，不是用户当前头像、并且被替换超过 grace 秒的版本都删掉；
+    user_ids 为 None 时扫描全部用户，顺带清理没有用户引用的旧式前缀文件和处理失败残留的暂存文件。
+    """
+    from app.db import connection
+
+    deadline = time.time() - grace
+    if user_ids is None:
+        try:
+            user_ids = [int(name) for name in os.listdir(AVATAR_FOLDER) if name.isdigit()]
+        except OSError:
+            user_ids = []
+        sweep_all = True
+    else:
+        sweep_all = False
+
+    with connection() as db:
+        current = {}
+        for start in range(0, len(user_ids), 500):
+            chunk = user_ids[start:start + 500]
+            current.update(db.conn.execute(
+                f"SELECT id, avatar FROM users WHERE id IN ({','.join('?' * len(chunk))})", chunk
+            ).fetchall())
+        if sweep_all:
+            in_use = {row[0] for row in db.conn.execute(
+                "SELECT avatar FROM users WHERE avatar IS NOT NULL AND avatar NOT LIKE '%/%' AND avatar NOT LIKE '%.%'"
+            )}
+
+    removed = 0
+    for user_id in user_ids:
+        directory = os.path.join(AVATAR_FOLDER, str(user_id))
+        keep = set(rendition_files(current[user_id])) if current.get(user_id) else set()
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            continue
+        for name in names:
+            if os.path.join('avatars', str(user_id), name) not in keep:
+                removed += _remove_if_older(os.path.join(directory, name), deadline)
+        try:
+            os.rmdir(directory)  # 用户已删除或没有头像了，目录空了就顺手删掉
+        except OSError:
+            pass
+
+    if sweep_all:
+        for name in os.listdir(UPLOAD_FOLDER):
+            match = _LEGACY_RENDITION.fullmatch(name)
+            if match and match.group(1) not in in_use:
+                removed += _remove_if_older(os.path.join(UPLOAD_FOLDER, name), deadline)
+        if os.path.isdir(STAGING_FOLDER):
+            for name in os.listdir(STAGING_FOLDER):
+                removed += _remove_if_older(os.path.join(STAGING_FOLDER, name), deadline)
+    return removed
+
+
+def _schedule_gc(user_id):
+    """把这个用户的旧头像清理交给后台线程，不占用处理图片的回调；全量清理用 manage.py gc-avatars"""
+    global _gc_running
+    with _gc_lock:
+        _gc_pending.add(user_id)
+        if _gc_running:
+            return
+        _gc_running = True
+    threading.Thread(target=_gc_loop, name='avatar-gc', daemon=True).start()
+
+
+def _gc_loop():
+    global _gc_running
+    while True:
+        with _gc_lock:
+            if not _gc_pending:
+                _gc_running = False
+                return
+            user_ids = list(_gc_pending)
+            _gc_pending.clear()
+        try:
+            collect_garbage(user_ids=user_ids)
+        except Exception as e:
+            print(f"清理旧头像失败: {e}")
+
+
+def _remove_if_older(path, deadline):
+    try:
+        if os.path.getmtime(path) < deadline:
+            os.remove(path)
+            return 1
+    except OSError:
+        pass
+    return 0
+
+
+avatars = Blueprint('avatars', __name__)
+
+
+@avatars.route('/avatars/<int:user_id>/<name>')
+def serve_avatar(user_id, name):
+    """按内容寻址的头像：地址里带着内容哈希，内容永远不变，可以永久缓存"""
+    match = _AVATAR_NAME.fullmatch(name)
+    if match is None:
+        abort(404)
+    path = os.path.join(AVATAR_FOLDER, str(user_id), name)
+    if not os.path.isfile(path):
+        abort(404)
+    response = send_file(path, mimetype='image/webp' if match.group(1) == 'webp' else 'image/jpeg', etag=False)
+    # 文件名就是内容哈希，直接拿来当 ETag；浏览器强制刷新时也能回 304
+    response.set_etag(f"{user_id}/{name}")
+    response.headers['Cache-Control'] = IMMUTABLE
+    return response.make_conditional(request)
+
+
+def init_app(app):
+    app.register_blueprint(avatars)
@@ -0,0 +1,303 @@
+"""批量导入/导出用户，生成测试用的用户和好友关系
+
+导入和导出都是边读边写，内存占用只和批大小有关，和文件大小无关：
+读一批、交给进程池算 bcrypt、在一个事务里写入，同时下一批已经在算哈希了。
+"""
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import json
+import os
+import random
+import sys
+
+import bcrypt
+
+from app import hashing
+
+BATCH_SIZE = 50000     # 每个事务写入的行数，事务越大提交（和 WAL 检查点）的次数越少
+HASH_CHUNK = 64        # 每次交给哈希进程的密码数，太小了进程间通信的开销比哈希还大
+IN_FLIGHT = 2          # 同时在算哈希的批数：一批写库的时候下一批在算，内存里最多这么多批
+SQL_CHUNK = 500        # IN (...) 里一次最多放多少个参数，老版本SQLite上限是999
+FIELDS = ('username', 'pwd_hash', 'created_at')   # 导出的列，导出的文件可以直接再导入
+FORMATS = ('csv', 'jsonl')
+TRIAD_PROBABILITY = 0.6   # 生成好友关系时，新的好友从"好友的好友"里挑的概率，越大抱团越明显
+MAX_ERRORS_SHOWN = 20
+
+
+class ImportStats:
+    """导入结果：imported 写入（新增或覆盖）、skipped 用户名已存在、invalid 数据有误"""
+
+    def __init__(self):
+        self.read = 0
+        self.imported = 0
+        self.skipped = 0
+        self.invalid = 0
+
+    def __str__(self):
+        return f'读取 {self.read} 行，写入 {self.imported}，已存在跳过 {self.skipped}，有误 {self.invalid}'
+
+
+def detect_format(path, fmt=None):
+    """没有指定格式时按扩展名判断，默认 CSV"""
+    if fmt:
+        return fmt
+    return 'jsonl' if path and path.lower().endswith(('.jsonl', '.ndjson')) else 'csv'
+
+
+def read_rows(stream, fmt):
+    """逐条读出 (文件里的行号, dict)，不会一次读进整个文件"""
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for number, line in enumerate(stream, start=1):
+        line = line.strip()
+        if line:
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            yield number, row if isinstance(row, dict) else {}
+
+
+def is_bcrypt_hash(value):
+    return isinstance(value, str) and len(value) == 60 and value[:4] in ('$2a$', '$2b$', '$2y$')
+
+
+def _hash_chunk(passwords, rounds):
+    """在子进程里执行：逐个计算 bcrypt，算不了的（比如超长密码）返回 None"""
+    hashes = []
+    for pwd in passwords:
+        try:
+            hashes.append(bcrypt.hashpw(pwd.encode(), bcrypt.gensalt(rounds)).decode())
+        except ValueError:
+            hashes.append(None)
+    return hashes
+
+
+def _report(line, message):
+    print(f'⚠️ 第 {line} 行: {message}', file=sys.stderr)
+
+
+def _validated(rows, stats, errors):
+    """检查每一行，返回 (行号, 用户名, 明文密码, 密码哈希, 创建时间)，有误的行计数后跳过
+
+    每行要有 username，以及 password（明文，导入时计算哈希）或 pwd_hash（已经算好的 bcrypt 哈希）之一。
+    """
+    for line, row in rows:
+        stats.read += 1
+        username = row.get('username')
+        username = username.strip() if isinstance(username, str) else ''
+        password, pwd_hash = row.get('password') or None, row.get('pwd_hash') or None
+        if not username:
+            message = '缺少 username'
+        elif (password is None) == (pwd_hash is None):
+            message = 'password 和 pwd_hash 要有且只有一个'
+        elif password is not None and not isinstance(password, str):
+            message = 'password 格式错误'
+        elif pwd_hash is not None and not is_bcrypt_hash(pwd_hash):
+            message = 'pwd_hash 不是 bcrypt 哈希'
+        else:
+            yield line, username, password, pwd_hash, row.get('created_at') or None
+            continue
+        stats.invalid += 1
+        if len(errors) < MAX_ERRORS_SHOWN:
+            errors.append(line)
+            _report(line, message)
+
+
+def _batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def import_users(db, rows, update=False, rounds=None, workers=None, batch_size=BATCH_SIZE):
+    """把 rows（read_rows 读出来的 (行号, dict)）写进用户表，返回 ImportStats
+
+    明文密码分块交给进程池计算 bcrypt（rounds 默认和网站一致），每批在一个事务里写入。
+    用户名已存在时默认跳过，update=True 时覆盖密码哈希。
+    """
+    rounds = rounds or hashing.BCRYPT_ROUNDS
+    stats = ImportStats()
+    errors = []
+    if update:
+        sql = '''INSERT INTO users (username, pwd_hash, created_at) VALUES (?, ?, COALESCE(?, CURRENT_TIMESTAMP))
+                 ON CONFLICT(username) DO UPDATE SET pwd_hash = excluded.pwd_hash'''
+    else:
+        sql = "INSERT OR IGNORE INTO users (username, pwd_hash, created_at) VALUES (?, ?, COALESCE(?, CURRENT_TIMESTAMP))"
+
+    def write(batch, futures):
+        hashes = iter([h for future in futures for h in future.result()])
+        values = []
+        for line, username, password, pwd_hash, created_at in batch:
+            if password is not None:
+                pwd_hash = next(hashes)
+                if pwd_hash is None:
+                    stats.invalid += 1
+                    if len(errors) < MAX_ERRORS_SHOWN:
+                        errors.append(line)
+                        _report(line, '密码无法计算哈希')
+                    continue
+            values.append((username, pwd_hash, created_at))
+        try:
+            db.conn.execute("BEGIN")
+            written = db.conn.executemany(sql, values).rowcount
+            db.conn.commit()
+        except Exception:
+            db.conn.rollback()
+            raise
+        stats.imported += written
+        stats.skipped += len(values) - written
+
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        pending = deque()
+        for batch in _batches(_validated(rows, stats, errors), batch_size):
+            passwords = [password for _, _, password, _, _ in batch if password is not None]
+            futures = [pool.submit(_hash_chunk, passwords[i:i + HASH_CHUNK], rounds)
+                       for i in range(0, len(passwords), HASH_CHUNK)]
+            pending.append((batch, futures))
+            if len(pending) >= IN_FLIGHT:
+                write(*pending.popleft())
+        while pending:
+            write(*pending.popleft())
+    return stats
+
+
+def export_users(db, stream, fmt, batch_size=BATCH_SIZE):
+    """按 id 顺序分批读出全部用户写到 stream，返回导出的行数"""
+    if fmt == 'csv':
+        writer = csv.writer(stream)
+        writer.writerow(FIELDS)
+        write = writer.writerows
+    else:
+        def write(rows):
+            stream.writelines(json.dumps(dict(zip(FIELDS, row)), ensure_ascii=False) + '\n' for row in rows)
+    count = 0
+    cursor = db.conn.execute(f"SELECT {', '.join(FIELDS)} FROM users ORDER BY id")
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        write(rows)
+        count += len(rows)
+    return count
+
+
+def _insert_batches(db, sql, rows, batch_size=BATCH_SIZE):
+    """把 rows 按批写入，每批一个事务，返回写入的行数"""
+    written = 0
+    for batch in _batches(rows, batch_size):
+        # 按主键顺序写入，改动集中在相邻的B树页上
+        batch.sort()
+        try:
+            db.conn.execute("BEGIN")
+            written += db.conn.executemany(sql, batch).rowcount
+            db.conn.commit()
+        except Exception:
+            db.conn.rollback()
+            raise
+    return written
+
+
+def _lookup_ids(db, names):
+    ids = {}
+    for start in range(0, len(names), SQL_CHUNK):
+        chunk = names[start:start + SQL_CHUNK]
+        ids.update(db.conn.execute(
+            f"SELECT username, id FROM users WHERE username IN ({','.join('?' * len(chunk))})", chunk
+        ).fetchall())
+    return ids
+
+
+def friend_graph(adj, friends, rng):
+    """生成 len(adj) 个人的好友关系，逐条返回 (a, b)，a、b 是编号，同时记进邻接表 adj
+
+    Holme-Kim 模型：每个新人和已有的人交 friends // 2 个朋友，先按"朋友越多越容易被认识"挑一个，
+    之后每个朋友以 TRIAD_PROBABILITY 的概率从上一个朋友的朋友里挑（抱团），否则再按朋友数挑。
+    得到的好友数是长尾分布（少数人好友很多），平均约 friends 个，好友之间互相认识的比例也比随机图高得多。
+    adj 是每人一个空的整数数组（array('l')），一百万人、平均20个好友大约占几百MB。
+    """
+    count = len(adj)
+    per_person = friends // 2
+    if per_person < 1:
+        return
+    ends = array('l')    # 每条关系的两端各记一次，随机取一个就是按好友数加权挑人
+
+    def link(a, b):
+        adj[a].append(b)
+        adj[b].append(a)
+        ends.append(a)
+        ends.append(b)
+
+    # 前几个人互相都是好友，作为起点
+    core = min(count, per_person + 1)
+    for a in range(core):
+        for b in range(a):
+            link(a, b)
+            yield a, b
+    for a in range(core, count):
+        chosen = set()
+        previous = None
+        attempts = 0
+        while len(chosen) < per_person and attempts < per_person * 10:
+            attempts += 1
+            if previous is not None and adj[previous] and rng.random() < TRIAD_PROBABILITY:
+                b = adj[previous][rng.randrange(len(adj[previous]))]
+            else:
+                b = ends[rng.randrange(len(ends))]
+            if b == a or b in chosen:
+                continue
+            chosen.add(b)
+            previous = b
+        for b in chosen:
+            link(a, b)
+            yield a, b
+
+
+def _both_directions(ids, edges):
+    """好友关系双向各存一行"""
+    for a, b in edges:
+        yield ids[a], ids[b]
+        yield ids[b], ids[a]
+
+
+def generate(db, users, friends=20, requests=5, pwd_hash=None, username_format='user{:06d}', seed=1,
+             batch_size=BATCH_SIZE):
+    """生成 users 个测试用户、好友关系和好友请求，全部分批写入，返回 (用户id列表, 好友对数, 好友请求数)
+
+    所有用户共用 pwd_hash（默认由密码 "benchmark" 现算一次），不用为每个人算 bcrypt。
+    好友请求：每人收到 requests 个，来自随机挑的还不是好友的人。
+    """
+    rng = random.Random(seed)
+    if pwd_hash is None:
+        pwd_hash = bcrypt.hashpw(b'benchmark', bcrypt.gensalt(hashing.BCRYPT_ROUNDS)).decode()
+
+    names = [username_format.format(i) for i in range(users)]
+    _insert_batches(db, "INSERT OR IGNORE INTO users (username, pwd_hash) VALUES (?, ?)",
+                    ((name, pwd_hash) for name in names), batch_size)
+    lookup = _lookup_ids(db, names)
+    ids = array('l', (lookup[name] for name in names))
+    del names, lookup
+
+    adj = [array('l') for _ in range(users)]
+    pairs = _insert_batches(db, "INSERT OR IGNORE INTO friendships (user_id, friend_id) VALUES (?, ?)",
+                            _both_directions(ids, friend_graph(adj, friends, rng)), batch_size) // 2
+
+    def incoming():
+        for to in range(users):
+            for _ in range(min(requests, users - 1)):
+                frm = rng.randrange(users)
+                if frm != to and frm not in adj[to]:
+                    yield ids[to], ids[frm]
+    sent = _insert_batches(db, "INSERT OR IGNORE INTO friend_requests (to_id, from_id) VALUES (?, ?)",
+                           incoming(), batch_size)
+    return ids, pairs, sent
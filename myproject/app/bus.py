@@ -0,0 +1,110 @@
+import json
+import logging
+import os
+import socket
+import threading
+
+from app.metrics import Counter
+
+# 多进程模式下由启动器设置：每个进程在这个目录里绑定一个 <pid>.sock，
+# 广播就是给目录里其他所有 socket 各发一个数据报；单进程运行时没有这个目录，广播什么也不做
+BUS_DIR = os.environ.get('BUS_DIR')
+MAX_MESSAGE = 64 * 1024   # 字节，单条消息的上限
+SEND_TIMEOUT = 1          # 秒，对方接收队列满时最多等这么久，超时就丢掉这条消息
+
+log = logging.getLogger(__name__)
+
+bus_messages = Counter('bus_messages_total', '进程间广播：sent 发出、received 收到、dropped 发送失败', ('result',))
+
+_handlers = {}
+_lock = threading.Lock()
+_sock = None
+_sender = None
+_path = None
+
+
+def subscribe(topic, handler):
+    """登记 handler(payload)，收到其他进程广播的这个主题时调用（自己发出的不会收到）"""
+    with _lock:
+        _handlers.setdefault(topic, []).append(handler)
+
+
+def enabled():
+    return _sock is not None
+
+
+def start(directory=BUS_DIR):
+    """绑定本进程的接收 socket 并启动接收线程，没有配置目录时不做任何事"""
+    global _sock, _sender, _path
+    with _lock:
+        if _sock is not None or not directory:
+            return
+        path = os.path.join(directory, f'{os.getpid()}.sock')
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(path)
+        sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sender.settimeout(SEND_TIMEOUT)
+        _sock, _sender, _path = sock, sender, path
+    threading.Thread(target=_run, args=(sock,), name='bus', daemon=True).start()
+
+
+def stop():
+    """进程退出前调用：删掉自己的 socket，其他进程就不会再发过来"""
+    global _sock
+    with _lock:
+        sock, _sock = _sock, None
+    if sock is None:
+        return
+    try:
+        os.remove(_path)
+    except OSError:
+        pass
+    sock.close()
+
+
+def broadcast(topic, payload):
+    """把消息发给其他所有进程，payload 要能转成 JSON"""
+    if _sock is None:
+        return
+    data = json.dumps([topic, payload], ensure_ascii=False).encode('utf-8')
+    if len(data) > MAX_MESSAGE:
+        log.warning('广播消息太大，已丢弃: %s (%d 字节)', topic, len(data))
+        bus_messages.inc(result='dropped')
+        return
+    directory = os.path.dirname(_path)
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return
+    for name in names:
+        path = os.path.join(directory, name)
+        if path == _path or not name.endswith('.sock'):
+            continue
+        try:
+            _sender.sendto(data, path)
+            bus_messages.inc(result='sent')
+        except (FileNotFoundError, ConnectionRefusedError):
+            pass  # 对方刚好退出了
+        except OSError as e:
+            log.warning('广播到 %s 失败: %s', name, e)
+            bus_messages.inc(result='dropped')
+
+
+def _run(sock):
+    while True:
+        try:
+            data = sock.recv(MAX_MESSAGE)
+        except OSError:
+            return  # stop() 关闭了 socket
+        bus_messages.inc(result='received')
+        try:
+            topic, payload = json.loads(data)
+        except ValueError:
+            continue
+        with _lock:
+            handlers = list(_handlers.get(topic, ()))
+        for handler in handlers:
+            try:
+                handler(payload)
+            except Exception:
+                log.exception('处理广播消息失败: %s', topic)
@@ -0,0 +1,145 @@
+from flask import request
+import gzip
+import os
+import time
+import zlib
+
+try:
+    import brotli
+except ImportError:  # brotli 是可选依赖，没装时只用 gzip
+    brotli = None
+
+from app.metrics import Counter, Histogram
+
+MIN_SIZE = 1024   # 字节，比这小的响应压缩了也省不了多少
+# 压缩级别越高越省流量、越费CPU，可以对照 /metrics 里的 compression_cpu_seconds 调整
+GZIP_LEVEL = int(os.environ.get('GZIP_LEVEL', 6))
+BROTLI_QUALITY = int(os.environ.get('BROTLI_QUALITY', 4))
+COMPRESSIBLE_TYPES = {
+    'text/html', 'text/plain', 'text/css', 'text/csv', 'text/javascript',
+    'application/json', 'application/javascript', 'application/x-ndjson', 'image/svg+xml',
+}
+
+compression_cpu = Histogram('compression_cpu_seconds', '每个响应压缩花费的CPU时间', ('encoding',),
+                            buckets=(0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1))
+compression_bytes = Counter('compression_bytes_total', '压缩前(in)和压缩后(out)的字节数', ('encoding', 'direction'))
+
+enabled = False   # init_app 之后为 True，页面缓存据此决定要不要自己压缩
+
+
+class _Compressor:
+    """gzip/brotli 的统一接口：compress 返回已经可以发出去的数据，finish 返回结尾"""
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == 'br':
+            self._obj = brotli.Compressor(quality=BROTLI_QUALITY)
+        else:
+            self._obj = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)  # 31：带 gzip 文件头
+
+    def compress(self, data):
+        if self.encoding == 'br':
+            return self._obj.process(data) + self._obj.flush()
+        return self._obj.compress(data) + self._obj.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._obj.finish() if self.encoding == 'br' else self._obj.flush()
+
+
+def _pick_encoding():
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+
+def _compress_body(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def _record(encoding, cpu, size_in, size_out):
+    compression_cpu.observe(cpu, encoding=encoding)
+    compression_bytes.inc(size_in, encoding=encoding, direction='in')
+    compression_bytes.inc(size_out, encoding=encoding, direction='out')
+
+
+def _stream(chunks, encoding):
+    """边生成边压缩，每块都 flush，浏览器不用等整个响应结束"""
+    compressor = _Compressor(encoding)
+    cpu = size_in = size_out = 0
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            start = time.thread_time()
+            data = compressor.compress(chunk)
+            cpu += time.thread_time() - start
+            size_in, size_out = size_in + len(chunk), size_out + len(data)
+            if data:
+                yield data
+        start = time.thread_time()
+        data = compressor.finish()
+        cpu += time.thread_time() - start
+        size_out += len(data)
+        yield data
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+        _record(encoding, cpu, size_in, size_out)
+
+
+def _weaken_etag(response):
+    # 压缩后的内容和原内容字节不同，强 ETag 要改成弱 ETag
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+
+
+def compress_response(response, encoded=None):
+    """按 Accept-Encoding 压缩 HTML/JSON 等文本响应
+
+    encoded 是调用方保存的 {编码: 压缩后的内容}（页面缓存和页面存在一起），
+    里面有就直接用，没有就压缩后存进去。
+    """
+    if (response.status_code < 200 or response.status_code in (204, 206, 304)
+            or response.direct_passthrough
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_TYPES
+            or request.method == 'HEAD'):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = _pick_encoding()
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = _stream(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < MIN_SIZE:
+            return response
+        compressed = encoded.get(encoding) if encoded is not None else None
+        if compressed is None:
+            start = time.thread_time()
+            compressed = _compress_body(data, encoding)
+            cpu = time.thread_time() - start
+            _record(encoding, cpu, len(data), len(compressed))
+            response.headers['Server-Timing'] = f'compress;dur={cpu * 1000:.2f}'
+            if encoded is not None:
+                encoded[encoding] = compressed
+        response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    _weaken_etag(response)
+    return response
+
+
+def init_app(app):
+    """给文本响应加上 gzip/brotli 压缩"""
+    global enabled
+    enabled = True
+    app.after_request(compress_response)
@@ -0,0 +1,313 @@
+from flask import g
+from WkSqlite3 import WkSqlite3
+from contextlib import contextmanager
+import os
+import queue
+import sqlite3
+import threading
+import logging
+
+from app.metrics import TimedConnection
+
+logging.getLogger('WkSqlite3').setLevel(logging.WARNING)
+
+# 数据库文件的绝对路径（myproject/database.db）
+DB_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'database.db')
+
+POOL_SIZE = 16        # 和 waitress 的线程数保持一致，每个线程最多占用一个连接
+BUSY_TIMEOUT = 5000   # 毫秒，写锁被占用时最多等待这么久
+ACQUIRE_TIMEOUT = 10  # 秒，连接池被借空时最多等待这么久
+
+
+# 数据库迁移：按顺序执行，执行到哪一步记录在 PRAGMA user_version 里
+def _migrate_users(conn):
+    """创建用户表，并补上老数据库缺少的列"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            pwd_hash TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            status TEXT,
+            friends_id TEXT,
+            friend_request TEXT
+        )
+    ''')
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(users)")}
+    for column in ('friends_id', 'friend_request'):
+        if column not in columns:
+            conn.execute(f"ALTER TABLE users ADD COLUMN {column} TEXT")
+
+
+def _migrate_friendships(conn):
+    """把逗号分隔的好友/好友请求列拆成带索引的关系表"""
+    # 好友关系双向各存一行，按 user_id 前缀就能查出某人的全部好友
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS friendships (
+            user_id INTEGER NOT NULL,
+            friend_id INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, friend_id)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_friendships_friend ON friendships (friend_id, user_id)")
+    # to_id 收到了 from_id 发来的好友请求
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS friend_requests (
+            to_id INTEGER NOT NULL,
+            from_id INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (to_id, from_id)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_friend_requests_from ON friend_requests (from_id, to_id)")
+
+    # 转换老数据，不存在的用户id直接丢掉；旧列保留不再使用，方便回滚
+    user_ids = {row[0] for row in conn.execute("SELECT id FROM users")}
+
+    def split_ids(text):
+        ids = set()
+        for item in (text or '').split(','):
+            item = item.strip()
+            if item.isdigit() and int(item) in user_ids:
+                ids.add(int(item))
+        return ids
+
+    friendships = set()
+    requests = set()
+    for user_id, friends_id, friend_request in conn.execute(
+        "SELECT id, friends_id, friend_request FROM users"
+    ).fetchall():
+        for friend_id in split_ids(friends_id) - {user_id}:
+            friendships.add((user_id, friend_id))
+            friendships.add((friend_id, user_id))
+        for from_id in split_ids(friend_request) - {user_id}:
+            requests.add((user_id, from_id))
+    conn.executemany("INSERT OR IGNORE INTO friendships (user_id, friend_id) VALUES (?, ?)", friendships)
+    # 已经是好友的请求没有意义，不再迁移
+    conn.executemany("INSERT OR IGNORE INTO friend_requests (to_id, from_id) VALUES (?, ?)", requests - friendships)
+
+
+def _migrate_avatars(conn):
+    """在用户表里记录头像文件名和版本号，并登记已有的头像文件"""
+    conn.execute("ALTER TABLE users ADD COLUMN avatar TEXT")
+    conn.execute("ALTER TABLE users ADD COLUMN avatar_version INTEGER NOT NULL DEFAULT 0")
+    from app.avatar import backfill
+    backfill(conn)
+
+
+def _migrate_user_search(conn):
+    """为用户名建立三元组全文索引，注册和改名时由触发器自动同步"""
+    try:
+        conn.execute('''
+            CREATE VIRTUAL TABLE users_search USING fts5(
+                username, content='users', content_rowid='id', tokenize='trigram'
+            )
+        ''')
+    except sqlite3.OperationalError as e:
+        # SQLite 3.34 以下没有 trigram 分词器，搜索退化为只走用户名前缀
+        print(f'⚠️ 无法创建用户名全文索引，搜索只支持前缀匹配: {e}')
+        return
+    conn.execute('''
+        CREATE TRIGGER users_search_insert AFTER INSERT ON users BEGIN
+            INSERT INTO users_search (rowid, username) VALUES (new.id, new.username);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER users_search_delete AFTER DELETE ON users BEGIN
+            INSERT INTO users_search (users_search, rowid, username) VALUES ('delete', old.id, old.username);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER users_search_update AFTER UPDATE OF username ON users BEGIN
+            INSERT INTO users_search (users_search, rowid, username) VALUES ('delete', old.id, old.username);
+            INSERT INTO users_search (rowid, username) VALUES (new.id, new.username);
+        END
+    ''')
+    conn.execute("INSERT INTO users_search (users_search) VALUES ('rebuild')")
+
+
+def _migrate_messages(conn):
+    """创建聊天消息表，按 (会话, 时间) 建索引"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            conversation TEXT NOT NULL,
+            sender_id INTEGER NOT NULL,
+            content TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_conversation ON messages (conversation, created_at, id)")
+
+
+def _migrate_sessions(conn):
+    """创建服务端会话表，按用户和最后访问时间建索引"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sessions (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER,
+            data TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            last_seen REAL NOT NULL
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions (user_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_last_seen ON sessions (last_seen)")
+
+
+MIGRATIONS = [
+    _migrate_users,
+    _migrate_friendships,
+    _migrate_avatars,
+    _migrate_user_search,
+    _migrate_messages,
+    _migrate_sessions,
+]
+
+
+def migrate(conn):
+    """把数据库升级到最新版本，已经执行过的迁移不会重复执行"""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for i, step in enumerate(MIGRATIONS[version:], start=version + 1):
+        try:
+            conn.execute("BEGIN")
+            step(conn)
+            conn.execute(f"PRAGMA user_version = {i}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        print(f'📦 数据库迁移 {i}: {step.__doc__}')
+
+
+def connect(path=DB_PATH):
+    """新建一个配置好的连接（WAL、busy_timeout、synchronous）"""
+    # 经过 TimedConnection 执行的SQL会计入 /metrics 和慢请求日志
+    db = WkSqlite3(path, check_same_thread=False, timeout=BUSY_TIMEOUT / 1000, factory=TimedConnection)
+    db.set_table('users')
+    db.conn.execute("PRAGMA journal_mode = WAL")
+    db.conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT}")
+    # WAL 模式下 NORMAL 已经能保证数据库不损坏，省掉每次提交的 fsync
+    db.conn.execute("PRAGMA synchronous = NORMAL")
+    return db
+
+
+class ConnectionPool:
+    """线程安全的SQLite连接池，连接在启动时按需创建、之后反复复用"""
+
+    def __init__(self, path=DB_PATH, size=POOL_SIZE):
+        self.path = path
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        return connect(self.path)
+
+    def acquire(self, timeout=ACQUIRE_TIMEOUT):
+        """借出一个连接，池里没有空闲连接时新建，达到上限后排队等待"""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        try:
+            return self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise RuntimeError('数据库连接池已满，请稍后重试')
+
+    def release(self, db):
+        """归还连接，顺手回滚没有提交的事务，避免脏状态带给下一个请求"""
+        try:
+            if db.conn.in_transaction:
+                db.conn.rollback()
+        except Exception:
+            with self._lock:
+                self._created -= 1
+            db.close()
+            return
+        self._idle.put(db)
+
+    def warm_up(self):
+        """启动时执行迁移，并把连接一次性建好"""
+        conns = [self.acquire() for _ in range(self.size)]
+        try:
+            migrate(conns[0].conn)
+        finally:
+            for db in conns:
+                self.release(db)
+
+    def close(self):
+        while True:
+            try:
+                db = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            db.close()
+            with self._lock:
+                self._created -= 1
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def init_pool(path=DB_PATH, size=POOL_SIZE):
+    """创建全局连接池并执行数据库迁移，应在服务启动时调用一次"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            pool = ConnectionPool(path, size)
+            pool.warm_up()
+            _pool = pool
+    return _pool
+
+
+def get_pool():
+    """获取全局连接池，没有初始化过就用默认配置初始化"""
+    if _pool is None:
+        return init_pool()
+    return _pool
+
+
+def get_db():
+    """获取当前请求使用的数据库连接，请求结束时自动归还"""
+    if '_db' not in g:
+        g._db = get_pool().acquire()
+    return g._db
+
+
+@contextmanager
+def connection():
+    """在请求之外（命令行、后台线程）临时借用一个连接"""
+    pool = get_pool()
+    db = pool.acquire()
+    try:
+        yield db
+    finally:
+        pool.release(db)
+
+
+def _release_db(exc=None):
+    db = g.pop('_db', None)
+    if db is not None:
+        get_pool().release(db)
+
+
+def init_app(app):
+    """注册请求结束时归还连接的钩子"""
+    app.teardown_appcontext(_release_db)
@@ -0,0 +1,100 @@
+from array import array
+import math
+import os
+import random
+import threading
+import time
+
+# 回声洞内容文件（myproject/echohole.txt），每行一条
+ECHOCAVE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'echohole.txt')
+RELOAD_INTERVAL = 2             # 秒，最多每隔这么久检查一次文件是否被修改
+MAX_IN_MEMORY = 1024 * 1024     # 文件小于1MB时整个读进内存，更大的文件只记录每行的偏移量
+
+
+class EchoCave:
+    """回声洞内容仓库：加载一次，按文件修改时间自动重新加载，按下标O(1)取任意一条"""
+
+    def __init__(self, path=ECHOCAVE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._lines = None          # 小文件：全部内容
+        self._offsets = array('q')  # 大文件：每条非空行的起始偏移量
+        self._mtime = None
+        self._checked_at = 0
+
+    def _load(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            self._lines, self._offsets, self._mtime = [], array('q'), None
+            return
+        if stat.st_size <= MAX_IN_MEMORY:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self._lines = [line.strip() for line in f if line.strip()]
+            self._offsets = array('q')
+        else:
+            offsets = array('q')
+            with open(self.path, 'rb') as f:
+                pos = 0
+                for line in f:
+                    if line.strip():
+                        offsets.append(pos)
+                    pos += len(line)
+            self._lines, self._offsets = None, offsets
+        self._mtime = stat.st_mtime
+
+    def _refresh(self):
+        """距离上次检查超过 RELOAD_INTERVAL 时看一下文件有没有被修改"""
+        now = time.monotonic()
+        if self._mtime is not None and now - self._checked_at < RELOAD_INTERVAL:
+            return
+        with self._lock:
+            if self._mtime is not None and now - self._checked_at < RELOAD_INTERVAL:
+                return
+            self._checked_at = now
+            try:
+                mtime = os.stat(self.path).st_mtime
+            except OSError:
+                mtime = None
+            if mtime is None or mtime != self._mtime:
+                self._load()
+
+    def __len__(self):
+        self._refresh()
+        return len(self._lines) if self._lines is not None else len(self._offsets)
+
+    def get(self, index):
+        """按下标取一条内容"""
+        self._refresh()
+        lines, offsets = self._lines, self._offsets
+        if lines is not None:
+            return lines[index]
+        with open(self.path, 'rb') as f:
+            f.seek(offsets[index])
+            return f.readline().decode('utf-8', errors='replace').strip()
+
+    def random(self):
+        """随机取一条，没有内容时返回None"""
+        count = len(self)
+        return self.get(random.randrange(count)) if count else None
+
+    def next_unique(self, state):
+        """按会话里保存的状态不重复地取下一条，全部取完一轮后重新打乱
+
+        state 是 {'seed', 'step', 'pos', 'count'}，用 (step * pos + seed) % count 生成排列，
+        step 和 count 互质时这是一个完整的排列，不需要在会话里保存已经看过的内容。
+        """
+        count = len(self)
+        if not count:
+            return None, state
+        if not state or state.get('count') != count or state.get('pos', 0) >= count:
+            step = random.randrange(1, count + 1)
+            while math.gcd(step, count) != 1:
+                step += 1
+            state = {'seed': random.randrange(count), 'step': step, 'pos': 0, 'count': count}
+        index = (state['step'] * state['pos'] + state['seed']) % count
+        state = dict(state, pos=state['pos'] + 1)
+        return self.get(index), state
+
+
+store = EchoCave()
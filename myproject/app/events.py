@@ -0,0 +1,398 @@
+from collections import OrderedDict, deque
+from urllib.parse import urlsplit, parse_qs
+import json
+import os
+import selectors
+import socket
+import threading
+import time
+import uuid
+
+from flask import Blueprint, request, session, jsonify
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+
+from app.metrics import Gauge
+from app.pubsub import hub, user_channel
+
+# 事件推送单独监听一个端口，由一个线程用 selectors 管理全部连接，
+# 空闲的连接只占一个 socket，不占 waitress 的线程
+EVENTS_PORT = int(os.environ.get('EVENTS_PORT', 5001))
+# 网站在反向代理或 https 后面时，用它指定浏览器访问推送服务的地址
+EVENTS_URL = os.environ.get('EVENTS_URL')
+TOKEN_MAX_AGE = 24 * 3600   # 秒，推送令牌的有效期
+HEARTBEAT_SECONDS = 15      # SSE 连接的心跳间隔
+POLL_SECONDS = 25           # 长轮询最多挂起多久
+REQUEST_TIMEOUT = 10        # 秒，请求头要在这段时间内发完
+MAX_REQUEST_SIZE = 8192
+MAX_OUTPUT_SIZE = 64 * 1024  # 积压这么多还没发出去的数据就断开，避免慢客户端占内存
+MAX_CONNECTIONS = 10000
+BACKLOG_SIZE = 20           # 每个频道保留最近的事件，供长轮询和断线重连补发
+MAX_CHANNELS = 10000
+
+ev = Blueprint('events', __name__)
+
+
+class _Connection:
+    __slots__ = ('sock', 'inbuf', 'outbuf', 'mode', 'channel', 'since', 'deadline', 'writing', 'closing')
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.inbuf = bytearray()
+        self.outbuf = bytearray()
+        self.mode = None        # None：还在读请求头，'sse' 或 'poll'：等待事件
+        self.channel = None
+        self.since = 0
+        self.deadline = time.monotonic() + REQUEST_TIMEOUT
+        self.writing = False
+        self.closing = False
+
+
+def _sse(event_id, event):
+    data = json.dumps(event['data'], ensure_ascii=False)
+    return f"id: {event_id}\nevent: {event['type']}\ndata: {data}\n\n".encode('utf-8')
+
+
+class EventGateway:
+    """用户事件推送服务：SSE（/events）和长轮询（/poll），事件来自 pubsub.hub 的 user:<id> 频道
+
+    所有连接都在一个线程里用非阻塞 socket 处理，其他线程发布事件时通过 socketpair 唤醒它。
+    每个事件有一个递增的序号，客户端带上最后收到的序号就能补上错过的事件。
+    序号只在内存里，推送服务重启后从 0 开始，所以发给客户端的编号是 "<启动标识>:<序号>"，
+    客户端据此分辨服务是否重启过，不会把重启后的新事件当成已经收到过的旧事件丢掉。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.epoch = uuid.uuid4().hex[:8]
+        self._seq = 0
+        self._backlog = OrderedDict()   # 频道 -> deque[(序号, 事件)]，按最近使用排序
+        self._pending = deque()         # 等待推送线程分发的 (频道, 序号, 事件)
+        self._conns = set()
+        self._waiting = {}              # 频道 -> 等待事件的连接
+        self._selector = None
+        self._serializer = None
+        self._thread = None
+        self.port = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    @property
+    def last_seq(self):
+        return self._seq
+
+    @property
+    def last_id(self):
+        return self._event_id(self._seq)
+
+    def _event_id(self, seq):
+        return f"{self.epoch}:{seq}"
+
+    def _parse_since(self, value):
+        """把客户端带来的事件编号换成本次启动的序号
+
+        别的启动标识说明客户端上次连的是重启前的推送服务，它的序号在这里没有意义，
+        而本次启动以来的事件客户端一个都没收到过，所以从头补发；没带或格式不对就只推送以后的事件。
+        """
+        epoch, _, seq = value.partition(':')
+        if not seq:
+            return self.last_seq
+        if epoch != self.epoch:
+            return 0
+        try:
+            return int(seq)
+        except ValueError:
+            return self.last_seq
+
+    def configure(self, secret_key, port=EVENTS_PORT):
+        """只配置令牌和端口、不监听：多进程模式下推送服务跑在主进程里，worker 只负责发令牌"""
+        self._serializer = URLSafeTimedSerializer(secret_key, salt='events')
+        self.port = port
+
+    def start(self, secret_key, host='0.0.0.0', port=EVENTS_PORT):
+        """开始监听，只需要调用一次"""
+        if self._thread is not None:
+            return
+        self._serializer = URLSafeTimedSerializer(secret_key, salt='events')
+        listener = socket.create_server((host, port), backlog=1024)
+        listener.setblocking(False)
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(listener, selectors.EVENT_READ, 'accept')
+        self._selector.register(self._wake_r, selectors.EVENT_READ, 'wake')
+        self.port = listener.getsockname()[1]
+        hub.add_listener(self._on_publish)
+        self._thread = threading.Thread(target=self._run, name='event-gateway', daemon=True)
+        self._thread.start()
+
+    def make_token(self, user_id):
+        return self._serializer.dumps(user_id)
+
+    def _check_token(self, token):
+        try:
+            return int(self._serializer.loads(token, max_age=TOKEN_MAX_AGE))
+        except (BadSignature, TypeError, ValueError):
+            return None
+
+    def _on_publish(self, channel, event):
+        """在发布事件的线程里调用：记下事件，唤醒推送线程"""
+        with self._lock:
+            self._seq += 1
+            backlog = self._backlog.get(channel)
+            if backlog is None:
+                backlog = self._backlog[channel] = deque(maxlen=BACKLOG_SIZE)
+            backlog.append((self._seq, event))
+            self._backlog.move_to_end(channel)
+            while len(self._backlog) > MAX_CHANNELS:
+                self._backlog.popitem(last=False)
+            self._pending.append((channel, self._seq, event))
+        try:
+            self._wake_w.send(b'\0')
+        except OSError:
+            pass  # 缓冲区满说明已经有唤醒在排队了
+
+    def _events_since(self, channel, since):
+        with self._lock:
+            return [(seq, event) for seq, event in self._backlog.get(channel, ()) if seq > since]
+
+    def _run(self):
+        next_tick = time.monotonic() + 1
+        while True:
+            for key, mask in self._selector.select(timeout=1):
+                if key.data == 'accept':
+                    self._accept(key.fileobj)
+                elif key.data == 'wake':
+                    self._drain_wake()
+                else:
+                    conn = key.data
+                    if mask & selectors.EVENT_READ:
+                        self._read(conn)
+                    if mask & selectors.EVENT_WRITE and conn.sock is not None:
+                        self._flush(conn)
+            self._dispatch()
+            now = time.monotonic()
+            if now >= next_tick:
+                self._tick(now)
+                next_tick = now + 1
+
+    def _accept(self, listener):
+        while True:
+            try:
+                sock, _ = listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                return
+            sock.setblocking(False)
+            conn = _Connection(sock)
+            self._conns.add(conn)
+            self._selector.register(sock, selectors.EVENT_READ, conn)
+            if len(self._conns) > MAX_CONNECTIONS:
+                self._respond(conn, 503, {'error': '连接数已满'})
+
+    def _drain_wake(self):
+        try:
+            while self._wake_r.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def _read(self, conn):
+        try:
+            data = conn.sock.recv(4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            return self._close(conn)
+        if not data:
+            return self._close(conn)
+        if conn.mode is not None or conn.closing:
+            return  # 请求已经处理过了，之后客户端发来的数据直接丢掉
+        conn.inbuf += data
+        if b'\r\n\r\n' in conn.inbuf:
+            self._handle_request(conn)
+        elif len(conn.inbuf) > MAX_REQUEST_SIZE:
+            self._respond(conn, 431, {'error': '请求头太长'})
+
+    def _handle_request(self, conn):
+        head = bytes(conn.inbuf).split(b'\r\n\r\n', 1)[0].decode('latin-1')
+        lines = head.split('\r\n')
+        parts = lines[0].split()
+        if len(parts) != 3:
+            return self._respond(conn, 400, {'error': '请求格式错误'})
+        method, target, _ = parts
+        if method != 'GET':
+            return self._respond(conn, 405, {'error': '只支持GET'})
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        url = urlsplit(target)
+        query = parse_qs(url.query)
+        if url.path not in ('/events', '/poll'):
+            return self._respond(conn, 404, {'error': '未找到'})
+
+        user_id = self._check_token(query.get('token', [''])[0])
+        if user_id is None:
+            return self._respond(conn, 403, {'error': '令牌无效或已过期'})
+        channel = user_channel(user_id)
+        # EventSource 断线重连时会自动带上 Last-Event-ID
+        since = self._parse_since(headers.get('last-event-id') or query.get('since', [''])[0])
+        missed = self._events_since(channel, since)
+
+        if url.path == '/poll':
+            if missed:
+                return self._respond(conn, 200, self._poll_body(missed, since))
+            conn.mode, conn.since = 'poll', since
+            conn.deadline = time.monotonic() + POLL_SECONDS
+        else:
+            conn.mode = 'sse'
+            conn.deadline = time.monotonic() + HEARTBEAT_SECONDS
+            self._write(conn, (
+                'HTTP/1.1 200 OK\r\n'
+                'Content-Type: text/event-stream; charset=utf-8\r\n'
+                'Cache-Control: no-cache\r\n'
+                'Access-Control-Allow-Origin: *\r\n'
+                'X-Accel-Buffering: no\r\n'
+                '\r\n'
+                'retry: 3000\n\n'
+            ).encode('latin-1') + b''.join(_sse(self._event_id(seq), event) for seq, event in missed))
+        if conn.sock is not None:
+            conn.channel = channel
+            self._waiting.setdefault(channel, set()).add(conn)
+
+    def _poll_body(self, events, since):
+        return {
+            'events': [dict(event, id=self._event_id(seq)) for seq, event in events],
+            'last': self._event_id(events[-1][0] if events else since)
+        }
+
+    def _respond(self, conn, status, body):
+        """返回一个 JSON 响应，发完后关闭连接"""
+        reason = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+                  405: 'Method Not Allowed', 431: 'Request Header Fields Too Large',
+                  503: 'Service Unavailable'}[status]
+        payload = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self._stop_waiting(conn)
+        conn.mode, conn.closing = None, True
+        self._write(conn, (
+            f'HTTP/1.1 {status} {reason}\r\n'
+            'Content-Type: application/json\r\n'
+            f'Content-Length: {len(payload)}\r\n'
+            'Cache-Control: no-store\r\n'
+            'Access-Control-Allow-Origin: *\r\n'
+            'Connection: close\r\n'
+            '\r\n'
+        ).encode('latin-1') + payload)
+
+    def _write(self, conn, data):
+        conn.outbuf += data
+        self._flush(conn)
+
+    def _flush(self, conn):
+        try:
+            while conn.outbuf:
+                sent = conn.sock.send(conn.outbuf)
+                del conn.outbuf[:sent]
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError:
+            return self._close(conn)
+        if conn.outbuf:
+            if len(conn.outbuf) > MAX_OUTPUT_SIZE:
+                return self._close(conn)
+            if not conn.writing:
+                conn.writing = True
+                self._selector.modify(conn.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, conn)
+        elif conn.closing:
+            self._close(conn)
+        elif conn.writing:
+            conn.writing = False
+            self._selector.modify(conn.sock, selectors.EVENT_READ, conn)
+
+    def _dispatch(self):
+        with self._lock:
+            pending, self._pending = self._pending, deque()
+        for channel, seq, event in pending:
+            for conn in list(self._waiting.get(channel, ())):
+                if conn.mode == 'sse':
+                    self._write(conn, _sse(self._event_id(seq), event))
+                elif conn.mode == 'poll':
+                    self._respond(conn, 200, self._poll_body([(seq, event)], conn.since))
+
+    def _tick(self, now):
+        """处理超时：读请求头超时断开，SSE 发心跳，长轮询返回空结果"""
+        for conn in list(self._conns):
+            if conn.deadline > now or conn.sock is None:
+                continue
+            if conn.mode == 'sse':
+                conn.deadline = now + HEARTBEAT_SECONDS
+                self._write(conn, b': ping\n\n')
+            elif conn.mode == 'poll':
+                self._respond(conn, 200, self._poll_body([], conn.since))
+            else:
+                self._close(conn)
+
+    def _stop_waiting(self, conn):
+        waiting = self._waiting.get(conn.channel)
+        if waiting is not None:
+            waiting.discard(conn)
+            if not waiting:
+                del self._waiting[conn.channel]
+        conn.channel = None
+
+    def _close(self, conn):
+        if conn.sock is None:
+            return
+        self._stop_waiting(conn)
+        self._conns.discard(conn)
+        try:
+            self._selector.unregister(conn.sock)
+        except (KeyError, ValueError):
+            pass
+        conn.sock.close()
+        conn.sock = None
+
+    def stats(self):
+        return {'connections': len(self._conns), 'channels': len(self._waiting), 'last_seq': self._seq}
+
+
+gateway = EventGateway()
+Gauge('event_connections', '推送服务当前的连接数', lambda: len(gateway._conns))
+
+
+def event_stream():
+    """当前登录用户连接推送服务需要的地址、令牌和起始事件编号，推送服务没启动时返回None
+
+    推送服务在别的进程里时不知道当前编号，since 为 null，由推送服务从它的最新序号开始推送。
+    """
+    user_id = session.get('user_id')
+    if not user_id or gateway.port is None:
+        return None
+    url = EVENTS_URL
+    if not url:
+        host = request.host
+        if ':' in host and not host.endswith(']'):
+            host = host.rsplit(':', 1)[0]
+        url = f"{request.scheme}://{host}:{gateway.port}"
+    since = gateway.last_id if gateway.running else None
+    return {'url': url.rstrip('/'), 'token': gateway.make_token(user_id), 'since': since}
+
+
+@ev.route('/api/events/config')
+def events_config():
+    """页面加载后再来取推送配置，页面本身就不包含令牌，可以被缓存"""
+    config = event_stream()
+    if config is None:
+        return jsonify({'error': '推送服务未启用'}), 404
+    response = jsonify(config)
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+def init_app(app):
+    """注册获取推送配置的接口"""
+    app.register_blueprint(ev)
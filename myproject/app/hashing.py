@@ -0,0 +1,70 @@
+from concurrent.futures import ThreadPoolExecutor
+import bcrypt
+import os
+import threading
+import time
+
+from app.metrics import bcrypt_seconds
+
+# bcrypt 的计算强度，可以用环境变量 BCRYPT_ROUNDS 调整；改动后老用户下次登录时自动重新哈希
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', 12))
+WORKERS = 4       # 同时计算哈希的线程数，bcrypt 计算时会释放GIL
+MAX_QUEUE = 4     # 排队等待的任务上限，超过就直接拒绝，不让请求线程堆在这里
+
+
+class HashingBusy(Exception):
+    """哈希任务排队已满，调用方应该让用户稍后重试"""
+
+
+_executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix='bcrypt')
+_slots = threading.BoundedSemaphore(WORKERS + MAX_QUEUE)
+
+
+def init(threads):
+    """按请求线程数确定计算中加排队的名额：最多占用一半的请求线程，其余的线程照常处理别的页面
+
+    名额比请求线程还多的话，请求线程全部等在哈希上也不会触发 HashingBusy，限流就形同虚设。
+    """
+    global _slots
+    _slots = threading.BoundedSemaphore(max(1, min(WORKERS + MAX_QUEUE, threads // 2)))
+
+
+def _timed(operation, func, *args):
+    """在哈希线程里执行，只统计计算本身的耗时"""
+    start = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        bcrypt_seconds.observe(time.perf_counter() - start, operation=operation)
+
+
+def _run(func, *args):
+    """把一次哈希计算交给专用线程池，排队已满时立刻抛出 HashingBusy"""
+    slots = _slots
+    if not slots.acquire(blocking=False):
+        raise HashingBusy()
+    try:
+        future = _executor.submit(_timed, func.__name__, func, *args)
+    except Exception:
+        slots.release()
+        raise
+    future.add_done_callback(lambda f: slots.release())
+    return future.result()
+
+
+def hash_password(pwd):
+    """生成密码哈希，返回字符串"""
+    return _run(bcrypt.hashpw, pwd.encode(), bcrypt.gensalt(BCRYPT_ROUNDS)).decode()
+
+
+def check_password(pwd, pwd_hash):
+    """校验密码是否和哈希匹配"""
+    return _run(bcrypt.checkpw, pwd.encode(), pwd_hash.encode())
+
+
+def needs_rehash(pwd_hash):
+    """哈希的计算强度和当前配置不一致时需要重新哈希"""
+    try:
+        return int(pwd_hash.split('$')[2]) != BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return True
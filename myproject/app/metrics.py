@@ -0,0 +1,255 @@
+from collections import defaultdict
+from flask import Blueprint, request, g, abort, Response
+import ipaddress
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+# 超过这个耗时（秒）的请求会连同它执行的SQL一起记到日志里
+SLOW_REQUEST_SECONDS = float(os.environ.get('SLOW_REQUEST_SECONDS', 0.5))
+SLOW_QUERY_LINES = 10   # 慢请求日志里最多列出多少条SQL
+# 允许访问 /metrics 的地址，逗号分隔
+METRICS_ALLOW = os.environ.get('METRICS_ALLOW', '127.0.0.0/8,::1/128,10.0.0.0/8,172.16.0.0/12,192.168.0.0/16')
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+log = logging.getLogger(__name__)
+metrics = Blueprint('metrics', __name__)
+
+_registry = []
+_local = threading.local()   # 当前线程正在处理的请求执行过的SQL
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    """只增不减的计数，可以带标签"""
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name, self.documentation, self.labelnames = name, documentation, tuple(labelnames)
+        self._values = defaultdict(float)
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            self._values[key] += amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(labels.get(name, '') for name in self.labelnames), 0)
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {value:g}' for key, value in items]
+
+
+class Gauge:
+    """当前值，采集时调用 func 取值；func 可以返回一个数，或者 {标签值元组: 数}"""
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, func, labelnames=()):
+        self.name, self.documentation, self.labelnames = name, documentation, tuple(labelnames)
+        self.func = func
+        _registry.append(self)
+
+    def samples(self):
+        value = self.func()
+        if not isinstance(value, dict):
+            return [f'{self.name} {value:g}']
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {v:g}' for key, v in sorted(value.items())]
+
+
+class Histogram:
+    """按区间统计分布（耗时等），输出 _bucket/_sum/_count"""
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name, self.documentation, self.labelnames = name, documentation, tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}   # 标签值 -> [各区间计数..., 总和, 次数]
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+                    break
+            state[-2] += value
+            state[-1] += 1
+
+    def samples(self):
+        with self._lock:
+            items = sorted((key, list(state)) for key, state in self._values.items())
+        lines = []
+        for key, state in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                le = 'le="%g"' % bound
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}')
+            le = 'le="+Inf"'
+            lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, le)} {state[-1]}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labelnames, key)} {state[-2]:.6f}')
+            lines.append(f'{self.name}_count{_format_labels(self.labelnames, key)} {state[-1]}')
+        return lines
+
+
+def render():
+    """按 Prometheus 文本格式输出全部指标"""
+    lines = []
+    for metric in _registry:
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        lines.extend(metric.samples())
+    return '\n'.join(lines) + '\n'
+
+
+request_seconds = Histogram('http_request_duration_seconds', '请求耗时', ('endpoint', 'method'))
+requests_total = Counter('http_requests_total', '请求数', ('endpoint', 'method', 'status'))
+slow_requests = Counter('http_slow_requests_total', '超过慢请求阈值的请求数', ('endpoint',))
+sql_queries = Counter('sql_queries_total', '执行的SQL语句数', ('statement',))
+sql_seconds = Counter('sql_query_seconds_total', 'SQL语句累计耗时', ('statement',))
+bcrypt_seconds = Histogram('bcrypt_seconds', 'bcrypt 计算耗时（不含排队）', ('operation',),
+                           buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5))
+avatar_render_seconds = Histogram('avatar_render_seconds', 'Pillow 生成头像各尺寸的耗时（不含排队）',
+                                  buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+
+
+# ---------- SQL 统计 ----------
+
+def _statement(sql):
+    word = sql.lstrip().split(None, 1)
+    return word[0].upper() if word else ''
+
+
+def record_sql(sql, elapsed):
+    statement = _statement(sql)
+    sql_queries.inc(statement=statement)
+    sql_seconds.inc(elapsed, statement=statement)
+    trace = getattr(_local, 'trace', None)
+    if trace is not None:
+        entry = trace.get(sql)
+        if entry is None:
+            trace[sql] = [1, elapsed]
+        else:
+            entry[0] += 1
+            entry[1] += elapsed
+
+
+class TimedCursor(sqlite3.Cursor):
+    """统计 execute/executemany 耗时的游标"""
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            record_sql(sql, time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            record_sql(sql, time.perf_counter() - start)
+
+
+class TimedConnection(sqlite3.Connection):
+    """数据库连接：sqlite3.connect(factory=TimedConnection)，经过它执行的SQL都会计入统计
+
+    只统计 execute 本身（SELECT 的第一批结果在这一步算出来），逐行取结果的时间不计入。
+    """
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+# ---------- 请求统计 ----------
+
+def _query_breakdown(trace):
+    lines = []
+    for sql, (count, elapsed) in sorted(trace.items(), key=lambda item: -item[1][1])[:SLOW_QUERY_LINES]:
+        text = re.sub(r'\s+', ' ', sql).strip()
+        lines.append(f'    {elapsed * 1000:8.1f}ms  x{count:<4} {text[:160]}')
+    return '\n'.join(lines)
+
+
+def _before_request():
+    g._metrics_start = time.perf_counter()
+    _local.trace = {}
+
+
+def _after_request(response):
+    g._metrics_status = response.status_code
+    return response
+
+
+def _teardown_request(exc=None):
+    start = g.pop('_metrics_start', None)
+    trace, _local.trace = getattr(_local, 'trace', None), None
+    if start is None:
+        return
+    elapsed = time.perf_counter() - start
+    endpoint = request.endpoint or 'unknown'
+    status = g.pop('_metrics_status', 500)
+    request_seconds.observe(elapsed, endpoint=endpoint, method=request.method)
+    requests_total.inc(endpoint=endpoint, method=request.method, status=status)
+    if elapsed >= SLOW_REQUEST_SECONDS:
+        slow_requests.inc(endpoint=endpoint)
+        trace = trace or {}
+        log.warning(
+            '慢请求 %s %s -> %s 耗时 %.1fms，SQL %d 条共 %.1fms\n%s',
+            request.method, request.full_path.rstrip('?'), status, elapsed * 1000,
+            sum(count for count, _ in trace.values()),
+            sum(seconds for _, seconds in trace.values()) * 1000,
+            _query_breakdown(trace)
+        )
+
+
+_allowed = [ipaddress.ip_network(net.strip()) for net in METRICS_ALLOW.split(',') if net.strip()]
+
+
+@metrics.route('/metrics')
+def expose():
+    """Prometheus 采集接口，只允许 METRICS_ALLOW 里的地址访问"""
+    try:
+        address = ipaddress.ip_address(request.remote_addr)
+    except ValueError:
+        abort(403)
+    if not any(address in net for net in _allowed):
+        abort(403)
+    return Response(render(), mimetype='text/plain; version=0.0.4')
+
+
+def init_app(app):
+    """给每个请求计时，并注册 /metrics"""
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    app.register_blueprint(metrics)
@@ -0,0 +1,155 @@
+from collections import OrderedDict
+from functools import wraps
+from flask import request, session, g, make_response, get_flashed_messages, Response
+import hashlib
+import os
+import threading
+import time
+import uuid
+
+from app import bus, compression
+from app.metrics import Counter, Gauge
+
+CACHE_SIZE = 2000   # 最多缓存多少个渲染好的页面
+CACHE_LIFETIME = 3600   # 秒，缓存的页面和 ETag 最多用这么久，过期的版本号也按这个清理
+
+# 进程启动时随机生成，重启（包括换模板、换静态资源）后旧的 ETag 全部失效；
+# 多进程模式下同一批启动的 worker 由启动器给同一个值，ETag 在 worker 之间通用
+_epoch = os.environ.get('APP_EPOCH') or uuid.uuid4().hex[:8]
+
+# 用户数据版本号：好友、好友请求、用户名、头像变化时更新成当前时间戳，页面缓存按它失效。
+# 用时间戳而不是计数，广播给其他 worker 后大家的版本号一致。
+# 版本号不会小于当前 CACHE_LIFETIME 周期的起点（_floor），比起点还旧的记录没有用处，换周期时清理掉
+_versions = {}
+_versions_lock = threading.Lock()
+_pruned_floor = 0
+
+# (路由, 路径, 用户, 版本, 登录信息) -> (ETag, 页面内容, Content-Type, {编码: 压缩后的内容})
+_pages = OrderedDict()
+_pages_lock = threading.Lock()
+
+page_cache = Counter('page_cache_total', '页面缓存结果：hit 直接返回缓存，not_modified 返回304，miss 重新渲染', ('result',))
+
+
+def _floor():
+    """当前周期的起点（微秒）：每过 CACHE_LIFETIME 秒所有用户的版本号至少变一次，各个 worker 算出来一样"""
+    period = CACHE_LIFETIME * 1000000
+    return time.time_ns() // 1000 // period * period
+
+
+def version(user_id):
+    return max(_versions.get(user_id, 0), _floor())
+
+
+def _prune(floor):
+    """换周期后删掉比起点还旧的版本号，version() 的结果不变；调用时要持有 _versions_lock"""
+    global _pruned_floor
+    if floor > _pruned_floor:
+        for user_id in [user_id for user_id, stamp in _versions.items() if stamp < floor]:
+            del _versions[user_id]
+        _pruned_floor = floor
+
+
+def _set_versions(user_ids, stamp):
+    with _versions_lock:
+        for user_id in user_ids:
+            if user_id and _versions.get(user_id, 0) < stamp:
+                _versions[user_id] = stamp
+        _prune(_floor())
+
+
+def bump(*user_ids):
+    """这些用户的数据变了，让他们的页面缓存失效（其他 worker 也一起失效）"""
+    user_ids = [user_id for user_id in user_ids if user_id]
+    if not user_ids:
+        return
+    with _versions_lock:
+        # 同一微秒内连续 bump 也要让版本号变化
+        stamp = max(time.time_ns() // 1000, *(version(user_id) + 1 for user_id in user_ids))
+    _set_versions(user_ids, stamp)
+    bus.broadcast('pagecache.bump', [user_ids, stamp])
+
+
+bus.subscribe('pagecache.bump', lambda payload: _set_versions(*payload))
+Gauge('page_cache_versions', '记录着的用户数据版本号个数', lambda: len(_versions))
+
+
+def bump_related(db, user_id):
+    """用户名或头像变了：自己和所有会在列表里看到他的人（好友、好友请求的双方）都要失效"""
+    cursor = db.conn.execute(
+        '''SELECT friend_id FROM friendships WHERE user_id = ?
+           UNION SELECT from_id FROM friend_requests WHERE to_id = ?
+           UNION SELECT to_id FROM friend_requests WHERE from_id = ?''',
+        (user_id, user_id, user_id)
+    )
+    bump(user_id, *(row[0] for row in cursor))
+
+
+def skip():
+    """当前页面包含不应该缓存的临时内容（比如头像处理中的提示）"""
+    g._skip_page_cache = True
+
+
+def _key():
+    user_id = session.get('user_id')
+    if not user_id:
+        return (request.endpoint, request.path, None)
+    # 登录时间和次数会显示在页面上，同一个用户的不同登录会话分开缓存
+    return (request.endpoint, request.path, user_id, version(user_id),
+            session.get('login_time'), session.get('login_count'))
+
+
+def _etag(key):
+    return hashlib.blake2b(f'{_epoch}{key!r}'.encode(), digest_size=12).hexdigest()
+
+
+def _respond(etag, body=None, content_type=None, encoded=None, per_user=False):
+    response = Response(status=304) if body is None else Response(body, content_type=content_type)
+    # 弱 ETag：同一个页面压缩和不压缩的版本共用
+    response.set_etag(etag, weak=True)
+    # 每次都让浏览器带着 ETag 来验证，没变化时返回304
+    response.headers['Cache-Control'] = 'private, no-cache' if per_user else 'no-cache'
+    response.headers['Vary'] = 'Cookie'
+    if body is not None and compression.enabled:
+        # 压缩好的内容和页面存在一起，缓存命中时不用每次重新压缩
+        response = compression.compress_response(response, encoded)
+    return response
+
+
+def cached(view):
+    """缓存 GET 请求渲染出来的页面
+
+    缓存键包含登录用户和他的数据版本号，匿名访问的页面所有人共用一份。
+    请求带 If-None-Match 且版本没变时直接返回304，不渲染模板也不查数据库。
+    带查询参数的请求（比如 /friend_list?accept=xx）和有提示消息要显示的请求不走缓存。
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method != 'GET' or request.args or session.get('_flashes'):
+            return view(*args, **kwargs)
+        key = _key()
+        etag = _etag(key)
+        per_user = key[2] is not None
+        if request.if_none_match.contains_weak(etag):
+            page_cache.inc(result='not_modified')
+            return _respond(etag, per_user=per_user)
+        with _pages_lock:
+            entry = _pages.get(key)
+            if entry is not None:
+                _pages.move_to_end(key)
+        if entry is not None:
+            page_cache.inc(result='hit')
+            return _respond(*entry, per_user=per_user)
+
+        page_cache.inc(result='miss')
+        response = make_response(view(*args, **kwargs))
+        if (response.status_code != 200 or response.is_streamed
+                or g.pop('_skip_page_cache', False) or get_flashed_messages()):
+            return response
+        entry = (etag, response.get_data(), response.content_type, {})
+        with _pages_lock:
+            _pages[key] = entry
+            while len(_pages) > CACHE_SIZE:
+                _pages.popitem(last=False)
+        return _respond(*entry, per_user=per_user)
+    return wrapper
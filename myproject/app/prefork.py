@@ -0,0 +1,299 @@
+import os
+import select
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+from waitress import wasyncore
+from waitress.server import create_server
+
+from app import bus, writer
+
+WARMUP_TIMEOUT = 60       # 秒，worker 预热（连接池、模板、缓存）最多等这么久
+GRACEFUL_TIMEOUT = int(os.environ.get('GRACEFUL_TIMEOUT', 30))  # 秒，worker 退出前等正在处理的请求完成
+RESPAWN_DELAY = 1         # 秒，worker 刚启动就退出时先等一下再重启，避免反复重启占满CPU
+MIN_UPTIME = 5            # 秒，活不到这么久的 worker 算启动失败
+DRAIN_MIN = 1             # 秒，停止接受连接后至少再处理这么久，刚接受、请求还没读进来的连接也能得到响应
+LISTEN_BACKLOG = 2048
+
+
+def supported():
+    """多进程模式要用到传递文件描述符和 Unix socket，只支持 Linux/macOS 等 POSIX 系统"""
+    return os.name == 'posix' and hasattr(socket, 'AF_UNIX')
+
+
+def reuse_port_supported():
+    return hasattr(socket, 'SO_REUSEPORT')
+
+
+def is_worker():
+    """当前进程是不是由启动器拉起的 worker"""
+    return 'PREFORK_READY_FD' in os.environ
+
+
+def _listen(host, port, reuse_port=False):
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(LISTEN_BACKLOG)
+    return sock
+
+
+class _Worker:
+    def __init__(self, index, proc, ready_fd, go_fd):
+        self.index = index
+        self.proc = proc
+        self.ready_fd = ready_fd
+        self.go_fd = go_fd
+        self.started = time.monotonic()
+        self.deadline = None   # 被要求退出后，超过这个时间还没退出就强制结束
+
+    @property
+    def pid(self):
+        return self.proc.pid
+
+    def close_pipes(self):
+        for fd in (self.ready_fd, self.go_fd):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        self.ready_fd = self.go_fd = -1
+
+    def stop(self):
+        """让 worker 不再接受新连接，处理完手上的请求后退出"""
+        self.close_pipes()
+        self.deadline = time.monotonic() + GRACEFUL_TIMEOUT + 5
+        if self.proc.poll() is None:
+            self.proc.send_signal(signal.SIGTERM)
+
+
+class Master:
+    """多进程启动器的主进程：监听端口、拉起并看管 worker
+
+    worker 是用 command 重新启动的独立进程，启动时先预热（连接池、模板、缓存），
+    同一批的 worker 全部预热完成后才一起开始接受请求。
+    默认由主进程监听端口，worker 继承同一个 socket；reuse_port=True 时每个 worker
+    用 SO_REUSEPORT 各自监听同一个端口，由内核分配连接。
+
+    信号：SIGHUP 平滑重启（新一批 worker 就绪后旧的才退出，期间不断服务，也会加载新代码和模板），
+    SIGTERM / SIGINT 等正在处理的请求完成后全部退出。worker 意外退出时自动重启。
+    """
+
+    def __init__(self, command, workers, host='0.0.0.0', port=5000, reuse_port=False):
+        self.command = command
+        self.count = max(1, workers)
+        self.host = host
+        self.port = port
+        self.reuse_port = reuse_port
+        self.workers = []
+        self._retiring = []
+        self._sock = None
+        self._bus_dir = None
+        self._reload = False
+        self._stopping = False
+
+    def run(self):
+        self._bus_dir = tempfile.mkdtemp(prefix='myproject-bus-')
+        bus.start(self._bus_dir)
+        if not self.reuse_port:
+            self._sock = _listen(self.host, self.port)
+        signal.signal(signal.SIGHUP, self._on_reload)
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        try:
+            epoch = self._new_epoch()
+            workers = [self._spawn(i, epoch) for i in range(self.count)]
+            if not self._start(workers):
+                print('❌ worker 启动失败')
+                return 1
+            self.workers = workers
+            print(f'✅ {len(workers)} 个 worker 已就绪 (主进程 pid {os.getpid()}，kill -HUP 平滑重启)')
+            while not self._stopping:
+                if self._reload:
+                    self._reload = False
+                    self._restart_all()
+                self._reap()
+                time.sleep(0.5)
+        finally:
+            self._shutdown()
+        return 0
+
+    def _on_reload(self, signum, frame):
+        self._reload = True
+
+    def _on_stop(self, signum, frame):
+        self._stopping = True
+
+    @staticmethod
+    def _new_epoch():
+        # 同一批 worker 共用，ETag 在它们之间通用；单独重启的 worker 用新的，不会认旧 ETag
+        return uuid.uuid4().hex[:8]
+
+    def _spawn(self, index, epoch):
+        ready_r, ready_w = os.pipe()
+        go_r, go_w = os.pipe()
+        env = dict(os.environ, BUS_DIR=self._bus_dir, APP_EPOCH=epoch, PREFORK_WORKER=str(index),
+                   PREFORK_READY_FD=str(ready_w), PREFORK_GO_FD=str(go_r))
+        fds = [ready_w, go_r]
+        if self._sock is not None:
+            env['PREFORK_LISTEN_FD'] = str(self._sock.fileno())
+            fds.append(self._sock.fileno())
+        else:
+            env['PREFORK_HOST'], env['PREFORK_PORT'] = self.host, str(self.port)
+        try:
+            proc = subprocess.Popen(self.command, env=env, pass_fds=fds)
+        finally:
+            os.close(ready_w)
+            os.close(go_r)
+        return _Worker(index, proc, ready_r, go_w)
+
+    def _start(self, workers):
+        """等这批 worker 全部预热完成，再让它们一起开始接受请求；有一个失败就全部放弃"""
+        deadline = time.monotonic() + WARMUP_TIMEOUT
+        waiting = {w.ready_fd: w for w in workers}
+        ok = True
+        while waiting and ok:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                ok = False
+                break
+            readable, _, _ = select.select(list(waiting), [], [], min(remaining, 1))
+            for fd in readable:
+                # 读到空说明 worker 在预热时退出了
+                ok = ok and os.read(fd, 16) == b'ready'
+                del waiting[fd]
+        if not ok:
+            for w in workers:
+                w.stop()
+                w.proc.kill()
+                w.proc.wait()
+                self._cleanup(w)
+            return False
+        for w in workers:
+            try:
+                os.write(w.go_fd, b'go')
+            except OSError:
+                pass  # 刚好退出了，_reap 会重启它
+            w.close_pipes()
+        return True
+
+    def _restart_all(self):
+        print('🔄 平滑重启：启动新的 worker...')
+        epoch = self._new_epoch()
+        workers = [self._spawn(i, epoch) for i in range(self.count)]
+        if not self._start(workers):
+            print('❌ 新的 worker 启动失败，继续使用原来的 worker')
+            return
+        for w in self.workers:
+            w.stop()
+        self._retiring.extend(self.workers)
+        self.workers = workers
+        print(f'✅ 平滑重启完成，{len(self._retiring)} 个旧 worker 处理完手上的请求后退出')
+
+    def _reap(self):
+        for i, w in enumerate(self.workers):
+            code = w.proc.poll()
+            if code is None:
+                continue
+            print(f'⚠️ worker {w.pid} 意外退出 (返回值 {code})，重新启动')
+            self._cleanup(w)
+            if time.monotonic() - w.started < MIN_UPTIME:
+                time.sleep(RESPAWN_DELAY)
+            replacement = self._spawn(w.index, self._new_epoch())
+            if self._start([replacement]):
+                self.workers[i] = replacement
+        now = time.monotonic()
+        for w in list(self._retiring):
+            if w.proc.poll() is None and now > w.deadline:
+                w.proc.kill()
+            if w.proc.poll() is not None:
+                self._retiring.remove(w)
+                self._cleanup(w)
+
+    def _cleanup(self, w):
+        """worker 被强制结束时来不及删自己的广播 socket，由主进程删"""
+        w.close_pipes()
+        try:
+            os.remove(os.path.join(self._bus_dir, f'{w.pid}.sock'))
+        except OSError:
+            pass
+
+    def _shutdown(self):
+        print('🛑 正在停止，等待 worker 处理完手上的请求...')
+        workers = self.workers + self._retiring
+        for w in workers:
+            w.stop()
+        for w in workers:
+            try:
+                w.proc.wait(max(0, w.deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                w.proc.kill()
+                w.proc.wait()
+        bus.stop()
+        shutil.rmtree(self._bus_dir, ignore_errors=True)
+        if self._sock is not None:
+            self._sock.close()
+
+
+def _busy(server):
+    """还有请求在排队、在处理或者响应还没发完"""
+    dispatcher = server.task_dispatcher
+    if dispatcher.active_count or dispatcher.queue:
+        return True
+    return any(getattr(channel, 'requests', None) or getattr(channel, 'total_outbufs_len', 0)
+               for channel in list(server._map.values()))
+
+
+def run_worker(app, warm_up, threads):
+    """worker 进程：预热，等主进程通知后开始接受请求，收到 SIGTERM 后处理完手上的请求再退出"""
+    # 先接上进程间广播，预热期间其他 worker 发出的更新也能收到
+    bus.start()
+    warm_up()
+    if 'PREFORK_LISTEN_FD' in os.environ:
+        sock = socket.socket(fileno=int(os.environ['PREFORK_LISTEN_FD']))
+    else:
+        sock = _listen(os.environ['PREFORK_HOST'], int(os.environ['PREFORK_PORT']), reuse_port=True)
+    server = create_server(app, sockets=[sock], threads=threads)
+
+    ready_fd, go_fd = int(os.environ['PREFORK_READY_FD']), int(os.environ['PREFORK_GO_FD'])
+    os.write(ready_fd, b'ready')
+    os.close(ready_fd)
+    go = os.read(go_fd, 16)
+    os.close(go_fd)
+    if go != b'go':
+        return  # 主进程放弃了这一批 worker
+
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(time.monotonic()))
+    # 终端里按 Ctrl+C 会发给整个进程组，由主进程统一安排退出
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    master = os.getppid()
+    while not stopping:
+        wasyncore.loop(timeout=1, map=server._map, use_poll=server.adj.asyncore_use_poll, count=1)
+        if os.getppid() != master:
+            stopping.append(time.monotonic())  # 主进程没了
+
+    # 不再接受新连接（共享 socket 时其他 worker 继续接受），等手上的请求处理完
+    wasyncore.dispatcher.close(server)
+    deadline = stopping[0] + GRACEFUL_TIMEOUT
+    drained = time.monotonic() + DRAIN_MIN
+    while (time.monotonic() < drained or _busy(server)) and time.monotonic() < deadline:
+        wasyncore.loop(timeout=0.2, map=server._map, use_poll=server.adj.asyncore_use_poll, count=1)
+    server.task_dispatcher.shutdown(timeout=max(0, deadline - time.monotonic()))
+    wasyncore.close_all(server._map)
+    try:
+        # 写队列里还没提交的写操作（会话访问时间等）
+        writer.execute(lambda db: None, timeout=5)
+    except Exception as e:
+        print(f'退出前提交写队列失败: {e}', file=sys.stderr)
+    bus.stop()
@@ -0,0 +1,233 @@
+from collections import Counter, deque
+from flask import Blueprint, request, session, render_template, abort, g
+import cProfile
+import hmac
+import os
+import pstats
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+
+# 按比例抽样分析的请求，0 表示关闭；设置了 PROFILE_TOKEN 时，带 X-Profile: <令牌> 头的请求一定分析
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN', '')
+# pstats：cProfile 的统计文件，可以用 snakeviz 等工具查看；collapsed：采样得到的调用栈，可以直接画火焰图
+PROFILE_FORMAT = os.environ.get('PROFILE_FORMAT', 'pstats')
+PROFILE_DIR = os.environ.get('PROFILE_DIR') or os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'profiles'
+)
+# 可以访问分析页面的用户名，逗号分隔
+ADMIN_USERS = {name.strip() for name in os.environ.get('ADMIN_USERS', '').split(',') if name.strip()}
+SAMPLE_INTERVAL = 0.002   # 秒，collapsed 模式的采样间隔
+KEEP_FILES = 20           # 每个路由最多保留多少个分析文件
+RECENT_SIZE = 50          # 分析页面汇总最近多少次分析
+TOP_FUNCTIONS = 30
+
+prof = Blueprint('profiling', __name__)
+
+# 最近的分析结果：{'endpoint', 'time', 'duration', 'file', 'functions': {函数: (自身耗时, 累计耗时, 调用次数)}}
+_recent = deque(maxlen=RECENT_SIZE)
+_recent_lock = threading.Lock()
+# cProfile 同一时间只能有一个在运行（Python 3.12 起在其他线程上再启用一个会抛 ValueError），
+# 已经有请求在用时，这次请求改用调用栈采样
+_cprofile_lock = threading.Lock()
+
+
+def is_admin():
+    return session.get('current_user') in ADMIN_USERS
+
+
+def _should_profile():
+    token = request.headers.get('X-Profile')
+    if token and PROFILE_TOKEN and hmac.compare_digest(token, PROFILE_TOKEN):
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+class StackSampler:
+    """collapsed 模式：后台线程定时读取被分析线程的调用栈，统计每条栈出现的次数
+
+    只在有请求正在被分析时才采样，其他时候线程一直在等待。
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self._targets = {}   # 线程id -> Counter(调用栈)
+        self._lock = threading.Lock()
+        self._active = threading.Event()
+        self._thread = None
+
+    def start(self, thread_id):
+        with self._lock:
+            self._targets[thread_id] = Counter()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+                self._thread.start()
+        self._active.set()
+
+    def stop(self, thread_id):
+        with self._lock:
+            stacks = self._targets.pop(thread_id, Counter())
+            if not self._targets:
+                self._active.clear()
+        return stacks
+
+    def _run(self):
+        while True:
+            self._active.wait()
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, stacks in self._targets.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        stacks[_stack(frame)] += 1
+            time.sleep(self.interval)
+
+
+def _frame_name(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _stack(frame):
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame.f_code))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+_sampler = StackSampler()
+
+
+def _output_path(endpoint, ext):
+    """profiles/<路由>/<时间>-<随机>.<扩展名>，顺手删掉这个路由最旧的文件"""
+    folder = os.path.join(PROFILE_DIR, re.sub(r'[^\w.-]', '_', endpoint))
+    os.makedirs(folder, exist_ok=True)
+    existing = sorted(os.listdir(folder))
+    for name in existing[:max(0, len(existing) - KEEP_FILES + 1)]:
+        try:
+            os.remove(os.path.join(folder, name))
+        except OSError:
+            pass
+    return os.path.join(folder, f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}.{ext}")
+
+
+def _save_pstats(profiler, endpoint):
+    stats = pstats.Stats(profiler)
+    path = _output_path(endpoint, 'pstats')
+    stats.dump_stats(path)
+    functions = {}
+    for (filename, line, name), (_, ncalls, tottime, cumtime, _) in stats.stats.items():
+        key = f"{name} ({os.path.basename(filename)}:{line})" if line else name
+        functions[key] = (tottime, cumtime, ncalls)
+    return path, functions
+
+
+def _save_collapsed(stacks, endpoint):
+    path = _output_path(endpoint, 'folded')
+    with open(path, 'w', encoding='utf-8') as f:
+        for stack, count in stacks.most_common():
+            f.write(f"{stack} {count}\n")
+    # 按采样次数估算：栈顶函数计入自身耗时，栈上出现过的函数都计入累计耗时
+    functions = {}
+    for stack, count in stacks.items():
+        frames = stack.split(';')
+        seconds = count * SAMPLE_INTERVAL
+        for name in dict.fromkeys(frames):
+            self_time, cumulative, samples = functions.get(name, (0, 0, 0))
+            functions[name] = (self_time, cumulative + seconds, samples + count)
+        self_time, cumulative, samples = functions[frames[-1]]
+        functions[frames[-1]] = (self_time + seconds, cumulative, samples)
+    return path, functions
+
+
+def _start_cprofile():
+    """拿到 cProfile 的使用权就开始分析，返回分析器；已经被占用时返回 None"""
+    if not _cprofile_lock.acquire(blocking=False):
+        return None
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # 别的工具（比如调试器）正在用性能分析的钩子
+        _cprofile_lock.release()
+        return None
+    return profiler
+
+
+def _before_request():
+    if not _should_profile():
+        return
+    profiler = _start_cprofile() if PROFILE_FORMAT != 'collapsed' else None
+    if profiler is not None:
+        g._profile = profiler
+    else:
+        _sampler.start(threading.get_ident())
+        g._profile = 'collapsed'
+    g._profile_start = time.perf_counter()
+
+
+def _teardown_request(exc=None):
+    profile = g.pop('_profile', None)
+    if profile is None:
+        return
+    duration = time.perf_counter() - g.pop('_profile_start')
+    endpoint = request.endpoint or 'unknown'
+    if profile == 'collapsed':
+        path, functions = _save_collapsed(_sampler.stop(threading.get_ident()), endpoint)
+    else:
+        profile.disable()
+        _cprofile_lock.release()
+        path, functions = _save_pstats(profile, endpoint)
+    with _recent_lock:
+        _recent.append({
+            'endpoint': endpoint,
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'duration': duration,
+            'file': os.path.relpath(path, PROFILE_DIR),
+            'functions': functions,
+        })
+
+
+def hot_functions(endpoint=None, limit=TOP_FUNCTIONS):
+    """汇总最近的分析结果，按自身耗时从高到低排列"""
+    totals = {}
+    with _recent_lock:
+        samples = [s for s in _recent if endpoint is None or s['endpoint'] == endpoint]
+    for sample in samples:
+        for name, (self_time, cumulative, calls) in sample['functions'].items():
+            total = totals.get(name, (0, 0, 0))
+            totals[name] = (total[0] + self_time, total[1] + cumulative, total[2] + calls)
+    ranked = sorted(totals.items(), key=lambda item: -item[1][0])[:limit]
+    return samples, ranked
+
+
+@prof.route('/admin/profiles')
+def profiles():
+    """管理员页面：最近的分析记录和最耗时的函数"""
+    if not is_admin():
+        abort(403)
+    endpoint = request.args.get('endpoint') or None
+    samples, ranked = hot_functions(endpoint)
+    with _recent_lock:
+        endpoints = sorted({s['endpoint'] for s in _recent})
+    return render_template(
+        'admin_profiles.html',
+        samples=list(reversed(samples)),
+        ranked=ranked,
+        endpoints=endpoints,
+        endpoint=endpoint,
+        profile_format=PROFILE_FORMAT,
+        profile_dir=PROFILE_DIR,
+        sample_rate=PROFILE_SAMPLE_RATE
+    )
+
+
+def init_app(app):
+    """按配置分析请求，并注册分析页面"""
+    app.before_request(_before_request)
+    app.teardown_request(_teardown_request)
+    app.register_blueprint(prof)
@@ -0,0 +1,43 @@
+import threading
+
+from app import bus
+
+
+class Hub:
+    """发布中心，频道一般是 user:<id>，事件交给登记的 listener（推送服务）转给客户端
+
+    多进程模式下发布的事件会广播给其他进程，推送服务在哪个进程里都能收到。
+    """
+
+    def __init__(self):
+        self._listeners = []
+        self._lock = threading.Lock()
+
+    def add_listener(self, listener):
+        """登记一个 listener(channel, event)，每次发布都会调用，用于把事件转给别的推送通道"""
+        with self._lock:
+            self._listeners.append(listener)
+
+    def publish(self, channel, event):
+        """把事件发给本进程的 listener，并广播给其他进程"""
+        bus.broadcast('pubsub', [channel, event])
+        self._deliver(channel, event)
+
+    def _deliver(self, channel, event):
+        with self._lock:
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener(channel, event)
+
+
+hub = Hub()
+bus.subscribe('pubsub', lambda payload: hub._deliver(*payload))
+
+
+def user_channel(user_id):
+    return f"user:{user_id}"
+
+
+def notify(user_id, event_type, data):
+    """给某个用户推送一条事件"""
+    hub.publish(user_channel(user_id), {'type': event_type, 'data': data})
@@ -0,0 +1,189 @@
+from collections import OrderedDict
+from functools import wraps
+from flask import g, request, session, render_template, jsonify, Response
+import math
+import os
+import threading
+import time
+
+from app.metrics import Counter, Gauge
+
+# 设成0关闭限流（比如压测时所有请求都来自同一个IP）
+RATELIMIT = os.environ.get('RATELIMIT', '1') != '0'
+MAX_KEYS = 10000   # 每个限流器最多记住多少个键，超出时淘汰最久没用到的
+# 同时在做的昂贵操作（bcrypt、图片处理）上限，所有路由共用；多进程模式下每个 worker 各算各的
+EXPENSIVE_CONCURRENCY = int(os.environ.get('EXPENSIVE_CONCURRENCY', 8))
+LIMITED_MESSAGE = "❌ 操作太频繁，请 {} 秒后再试"
+
+ratelimit_total = Counter('ratelimit_total', '限流检查结果：allowed 放行、limited 返回429', ('limiter', 'result'))
+
+_limiters = []
+
+
+class Limiter:
+    """令牌桶：每个键（IP、用户名）一个桶，每秒补充 rate 个令牌，最多攒 burst 个
+
+    桶只存 (令牌数, 上次更新时间)，空闲的键按 LRU 淘汰；被淘汰的键下次出现时是满桶，
+    和一直空闲到补满是一样的。
+    """
+
+    def __init__(self, name, rate, burst, max_keys=MAX_KEYS):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        _limiters.append(self)
+
+    def take(self, key, cost=1, charge=True):
+        """拿走 cost 个令牌，成功返回0，令牌不够时不扣，返回还要等多少秒
+
+        charge=False 时只看令牌够不够，不扣，也不计入放行次数（失败才扣令牌的规则先这样检查）。
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens >= cost:
+                if charge:
+                    tokens -= cost
+                wait = 0
+            else:
+                wait = (cost - tokens) / self.rate
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        if wait or charge:
+            ratelimit_total.inc(limiter=self.name, result='limited' if wait else 'allowed')
+        return wait
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class Budget:
+    """全局并发预算：同时执行的昂贵操作不超过 limit 个，满了直接拒绝，不排队"""
+
+    def __init__(self, name, limit):
+        self.name = name
+        self.limit = limit
+        self.in_use = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self.in_use >= self.limit:
+                ratelimit_total.inc(limiter=self.name, result='limited')
+                return False
+            self.in_use += 1
+        ratelimit_total.inc(limiter=self.name, result='allowed')
+        return True
+
+    def release(self):
+        with self._lock:
+            self.in_use -= 1
+
+
+expensive = Budget('expensive_concurrency', EXPENSIVE_CONCURRENCY)
+
+Gauge('ratelimit_keys', '每个限流器当前记住的键数', lambda: {(l.name,): len(l) for l in _limiters}, ('limiter',))
+Gauge('ratelimit_expensive_in_use', '正在执行的昂贵操作数', lambda: expensive.in_use)
+Gauge('ratelimit_expensive_limit', '昂贵操作的并发上限', lambda: expensive.limit)
+
+# 各路由的限流规则，rate 是每秒补充的令牌数
+login_ip = Limiter('login_ip', rate=1, burst=10)
+login_user = Limiter('login_user', rate=5 / 60, burst=5)           # 同一个IP对同一个用户名每分钟输错5次
+register_ip = Limiter('register_ip', rate=1 / 10, burst=5)
+check_username_ip = Limiter('check_username_ip', rate=5, burst=20)
+upload_ip = Limiter('upload_ip', rate=1 / 2, burst=5)
+upload_user = Limiter('upload_user', rate=1 / 10, burst=3)
+
+
+def by_ip():
+    return request.remote_addr
+
+
+def by_user():
+    return session.get('user_id')
+
+
+def by_form(field):
+    """按表单字段取键，比如登录时的用户名"""
+    def key():
+        value = (request.form.get(field) or '').strip()
+        return value or None
+    return key
+
+
+def by_ip_and_form(field):
+    """按 (IP, 表单字段) 取键：别人在自己的IP上输错密码，不会把这个用户名在其他IP上锁住"""
+    form_key = by_form(field)
+
+    def key():
+        value = form_key()
+        return (request.remote_addr, value) if value is not None else None
+    return key
+
+
+def failed():
+    """视图里调用：这次请求失败了（比如密码错误），由 limit 的 failures 规则扣令牌"""
+    g._ratelimit_failed = True
+
+
+def _limited(retry_after, template):
+    seconds = max(1, math.ceil(retry_after))
+    message = LIMITED_MESSAGE.format(seconds)
+    if template is not None:
+        response = Response(render_template(template, error=message), 429)
+    elif request.path.startswith('/api/'):
+        response = jsonify({'error': message})
+        response.status_code = 429
+    else:
+        response = Response(message, 429, content_type='text/plain; charset=utf-8')
+    response.headers['Retry-After'] = str(seconds)
+    return response
+
+
+def limit(*rules, failures=(), costly=False, template=None, methods=('POST',)):
+    """限流装饰器，在视图函数之前检查，超出时直接返回429，不会开始 bcrypt、图片处理等工作
+
+    rules 是若干 (限流器, 取键函数)，取键函数返回 None 时跳过这条规则（比如没填用户名）；
+    failures 的格式一样，但只在视图调用了 failed() 时才扣令牌（比如只算密码错误），令牌用完后同样直接返回429；
+    costly=True 时还要占用一个全局并发预算，视图函数返回后归还。
+    template 指定时用这个模板显示提示（模板要支持 error 变量），否则按路径返回JSON或纯文本。
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not RATELIMIT or request.method not in methods:
+                return view(*args, **kwargs)
+            for limiter, key_func in rules:
+                key = key_func()
+                if key is None:
+                    continue
+                wait = limiter.take(key)
+                if wait:
+                    return _limited(wait, template)
+            charged = []
+            for limiter, key_func in failures:
+                key = key_func()
+                if key is None:
+                    continue
+                wait = limiter.take(key, charge=False)
+                if wait:
+                    return _limited(wait, template)
+                charged.append((limiter, key))
+            if costly and not expensive.acquire():
+                return _limited(1, template)
+            try:
+                return view(*args, **kwargs)
+            finally:
+                if costly:
+                    expensive.release()
+                if g.pop('_ratelimit_failed', False):
+                    for limiter, key in charged:
+                        limiter.take(key)
+        return wrapper
+    return decorator
+
@@ -0,0 +1,376 @@
+from collections import OrderedDict
+from flask.sessions import SessionInterface, SessionMixin
+import json
+import os
+import secrets
+import threading
+import time
+
+from app import bus, writer
+from app.db import get_db
+
+SESSION_LIFETIME = int(os.environ.get('SESSION_LIFETIME', 30 * 24 * 3600))  # 秒，超过这么久没访问的会话过期
+CACHE_SIZE = 10000          # 内存里最多缓存多少个会话
+LAST_SEEN_INTERVAL = 60     # 秒，最后访问时间攒一批再写库
+SWEEP_INTERVAL = 3600       # 秒，多久清理一次过期会话
+# 只放在内存里、不写库的键：每次访问都会变，丢了也无所谓（回声洞去重的游标）
+MEMORY_ONLY_KEYS = {'echocave'}
+
+
+def _new_sid():
+    return secrets.token_urlsafe(24)
+
+
+class ServerSession(dict, SessionMixin):
+    """服务端会话：cookie 里只有会话id，数据在第一次被读写时才加载"""
+
+    def __init__(self, store, sid, new=False):
+        super().__init__()
+        self.store = store
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        self.accessed = False
+        self.rotated_from = None
+        self._loaded = new
+
+    def _load(self):
+        self.accessed = True
+        if self._loaded:
+            return
+        self._loaded = True
+        data = self.store.load(self.sid)
+        if data is None:
+            # 不存在或已过期：换一个新id，不沿用客户端带来的id
+            self.sid, self.new = _new_sid(), True
+        else:
+            dict.update(self, data)
+
+    def regenerate(self):
+        """登录后换一个新的会话id，旧id作废，防止会话固定攻击"""
+        self._load()
+        if not self.new:
+            self.rotated_from = self.sid
+        self.sid, self.new, self.modified = _new_sid(), True, True
+
+    # 读操作
+    def __getitem__(self, key):
+        self._load()
+        return super().__getitem__(key)
+
+    def __contains__(self, key):
+        self._load()
+        return super().__contains__(key)
+
+    def __iter__(self):
+        self._load()
+        return super().__iter__()
+
+    def __len__(self):
+        self._load()
+        return super().__len__()
+
+    def get(self, key, default=None):
+        self._load()
+        return super().get(key, default)
+
+    def keys(self):
+        self._load()
+        return super().keys()
+
+    def values(self):
+        self._load()
+        return super().values()
+
+    def items(self):
+        self._load()
+        return super().items()
+
+    # 写操作
+    def __setitem__(self, key, value):
+        self._load()
+        # 写入和原来一样的值不算修改，不用保存
+        if key not in self or super().__getitem__(key) != value:
+            self.modified = True
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self._load()
+        self.modified = True
+        super().__delitem__(key)
+
+    def pop(self, key, *default):
+        self._load()
+        self.modified = self.modified or key in self
+        return super().pop(key, *default)
+
+    def setdefault(self, key, default=None):
+        self._load()
+        if key not in self:
+            self.modified = True
+        return super().setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        self._load()
+        self.modified = True
+        super().update(*args, **kwargs)
+
+    def clear(self):
+        self._load()
+        self.modified = True
+        super().clear()
+
+
+class SessionStore:
+    """会话仓库：内存 LRU + SQLite sessions 表
+
+    只有登录用户的会话写库，未登录的会话（爬虫、游客）和 MEMORY_ONLY_KEYS 只放在内存里；
+    写库交给写队列合并提交，不等落盘。只是访问一下时只在内存里记录最后访问时间，
+    每隔 LAST_SEEN_INTERVAL 秒合并写一次，顺便定期清理过期会话。
+    多进程模式下会话数据变化时把新数据广播给其他 worker，不用等写库完成，
+    请求落到哪个 worker 上都能读到。
+    """
+
+    def __init__(self):
+        self._cache = OrderedDict()   # 会话id -> [数据, 用户id, 最后访问时间]
+        self._by_user = {}            # 用户id -> 缓存里属于他的会话id
+        self._seen = {}               # 还没写库的最后访问时间
+        self._lock = threading.Lock()
+        self._flushed_at = time.monotonic()
+        self._swept_at = time.monotonic()
+        bus.subscribe('sessions.forget', lambda sids: [self._forget(sid) for sid in sids])
+        bus.subscribe('sessions.forget_user', self._forget_user)
+        bus.subscribe('sessions.put', self._put_remote)
+
+    def _remember(self, sid, data, user_id, last_seen):
+        with self._lock:
+            self._cache[sid] = [data, user_id, last_seen]
+            self._cache.move_to_end(sid)
+            if user_id:
+                self._by_user.setdefault(user_id, set()).add(sid)
+            while len(self._cache) > CACHE_SIZE:
+                old_sid, (_, old_user, _) = self._cache.popitem(last=False)
+                self._unindex(old_sid, old_user)
+
+    def _unindex(self, sid, user_id):
+        sids = self._by_user.get(user_id)
+        if sids is not None:
+            sids.discard(sid)
+            if not sids:
+                del self._by_user[user_id]
+
+    def _forget(self, sid):
+        with self._lock:
+            entry = self._cache.pop(sid, None)
+            self._seen.pop(sid, None)
+            if entry is not None:
+                self._unindex(sid, entry[1])
+
+    def _forget_user(self, user_id):
+        with self._lock:
+            for sid in self._by_user.pop(user_id, set()):
+                self._cache.pop(sid, None)
+                self._seen.pop(sid, None)
+
+    def load(self, sid):
+        """读取会话数据（返回副本），不存在或已过期时返回None"""
+        now = time.time()
+        with self._lock:
+            entry = self._cache.get(sid)
+            if entry is not None:
+                self._cache.move_to_end(sid)
+        if entry is None:
+            row = get_db().conn.execute(
+                "SELECT data, user_id, last_seen FROM sessions WHERE id = ?",
+                (sid,)
+            ).fetchone()
+            if row is None:
+                return None
+            entry = [json.loads(row[0]), row[1], row[2]]
+            self._remember(sid, *entry)
+        if now - entry[2] > SESSION_LIFETIME:
+            self.delete(sid)
+            return None
+        return dict(entry[0])
+
+    def touch(self, sid):
+        now = time.time()
+        with self._lock:
+            entry = self._cache.get(sid)
+            if entry is not None:
+                entry[2] = now
+            # 没登录的会话不在数据库里
+            if entry is None or entry[1]:
+                self._seen[sid] = now
+
+    @staticmethod
+    def _persisted(data):
+        return {key: value for key, value in data.items() if key not in MEMORY_ONLY_KEYS}
+
+    def save(self, sid, data, rotated_from=None):
+        """保存会话：先更新内存并广播，写库交给写队列，不等待
+
+        没登录的会话只放在内存里；要写库的部分（去掉 MEMORY_ONLY_KEYS）和上次一样时也不写库。
+        """
+        user_id = data.get('user_id')
+        now = time.time()
+        persisted = self._persisted(data)
+        payload = json.dumps(persisted, ensure_ascii=False)
+
+        def op(db):
+            if rotated_from:
+                db.conn.execute("DELETE FROM sessions WHERE id = ?", (rotated_from,))
+            db.conn.execute(
+                '''INSERT INTO sessions (id, user_id, data, created_at, last_seen) VALUES (?, ?, ?, ?, ?)
+                   ON CONFLICT (id) DO UPDATE SET user_id = excluded.user_id, data = excluded.data,
+                                                  last_seen = excluded.last_seen''',
+                (sid, user_id, payload, now, now)
+            )
+
+        if rotated_from:
+            self._forget(rotated_from)
+        with self._lock:
+            old = self._cache.get(sid)
+            if old is not None and old[1] != user_id:
+                self._unindex(sid, old[1])
+            self._seen.pop(sid, None)
+        self._remember(sid, dict(data), user_id, now)
+        bus.broadcast('sessions.put', [sid, data, user_id, now, rotated_from])
+
+        if user_id:
+            if old is None or old[1] != user_id or rotated_from or self._persisted(old[0]) != persisted:
+                writer.submit(op)
+        elif rotated_from or (old is not None and old[1]):
+            # 退出登录后剩下的未登录会话不再留在数据库里
+            writer.submit(lambda db: db.conn.execute("DELETE FROM sessions WHERE id IN (?, ?)", (sid, rotated_from)))
+
+    def _put_remote(self, payload):
+        """其他 worker 保存了会话，直接换上新数据，不用等写库完成"""
+        sid, data, user_id, last_seen, rotated_from = payload
+        if rotated_from:
+            self._forget(rotated_from)
+        with self._lock:
+            old = self._cache.get(sid)
+            if old is not None and old[1] != user_id:
+                self._unindex(sid, old[1])
+        self._remember(sid, data, user_id, last_seen)
+
+    def delete(self, sid):
+        self._forget(sid)
+        writer.submit(lambda db: db.conn.execute("DELETE FROM sessions WHERE id = ?", (sid,)))
+        bus.broadcast('sessions.forget', [sid])
+
+    def invalidate_user(self, user_id):
+        """删除某个用户的全部会话（所有设备都退出登录），一条语句完成
+
+        内存里的会话马上作废，写库只排队不等待，写库排队再久退出登录也不会失败。
+        写完后再清一次缓存并通知其他 worker，免得写库之前从数据库读回来的旧会话留在缓存里。
+        """
+        self._forget_user(user_id)
+
+        def done(future):
+            self._forget_user(user_id)
+            bus.broadcast('sessions.forget_user', user_id)
+
+        writer.submit(lambda db: db.conn.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))).add_done_callback(done)
+
+    def update_user(self, user_id, **fields):
+        """改掉某个用户全部会话里的字段（改名、换头像后其他设备上的会话也跟着变），在一个事务里完成
+
+        和 invalidate_user 一样先改内存、写库不等待，写完后再通知其他 worker。
+        """
+        def op(db):
+            rows = db.conn.execute("SELECT id, data FROM sessions WHERE user_id = ?", (user_id,)).fetchall()
+            db.conn.executemany(
+                "UPDATE sessions SET data = ? WHERE id = ?",
+                [(json.dumps(dict(json.loads(data), **fields), ensure_ascii=False), sid) for sid, data in rows]
+            )
+
+        def apply():
+            with self._lock:
+                for sid in self._by_user.get(user_id, ()):
+                    self._cache[sid][0] = dict(self._cache[sid][0], **fields)
+
+        def done(future):
+            apply()
+            # 其他 worker 直接丢掉缓存，下次从数据库读新数据
+            bus.broadcast('sessions.forget_user', user_id)
+
+        apply()
+        writer.submit(op).add_done_callback(done)
+
+    def maybe_flush(self):
+        """定期把攒下的最后访问时间合并写库，并清理过期会话"""
+        now = time.monotonic()
+        if now - self._flushed_at < LAST_SEEN_INTERVAL:
+            return
+        with self._lock:
+            if now - self._flushed_at < LAST_SEEN_INTERVAL:
+                return
+            self._flushed_at = now
+            seen, self._seen = self._seen, {}
+            sweep = now - self._swept_at >= SWEEP_INTERVAL
+            if sweep:
+                self._swept_at = now
+        if seen:
+            writer.submit(lambda db: db.conn.executemany(
+                "UPDATE sessions SET last_seen = ? WHERE id = ? AND last_seen < ?",
+                [(last_seen, sid, last_seen) for sid, last_seen in seen.items()]
+            ))
+        if sweep:
+            self.sweep()
+
+    def sweep(self):
+        """删除过期会话"""
+        deadline = time.time() - SESSION_LIFETIME
+        with self._lock:
+            expired = [sid for sid, entry in self._cache.items() if entry[2] < deadline]
+        for sid in expired:
+            self._forget(sid)
+        writer.submit(lambda db: db.conn.execute("DELETE FROM sessions WHERE last_seen < ?", (deadline,)))
+
+
+store = SessionStore()
+
+
+class ServerSessionInterface(SessionInterface):
+    """Flask 会话后端：cookie 只保存随机的会话id"""
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if not sid:
+            return ServerSession(store, _new_sid(), new=True)
+        return ServerSession(store, sid)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain, path = self.get_cookie_domain(app), self.get_cookie_path(app)
+        if session.accessed:
+            response.vary.add('Cookie')
+        store.maybe_flush()
+        if not session._loaded:
+            # 这次请求没有用到会话，不需要加载，也不需要写 cookie
+            return
+        if not session:
+            if not session.new or session.rotated_from:
+                store.delete(session.rotated_from or session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        if session.modified or session.new:
+            store.save(session.sid, dict(session), session.rotated_from)
+        else:
+            store.touch(session.sid)
+        if session.new or session.permanent:
+            response.set_cookie(
+                name, session.sid,
+                expires=self.get_expiration_time(app, session),
+                httponly=self.get_cookie_httponly(app),
+                domain=domain, path=path,
+                secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app) or 'Lax'
+            )
+
+
+def init_app(app):
+    """把 Flask 的会话换成服务端会话"""
+    app.session_interface = ServerSessionInterface()
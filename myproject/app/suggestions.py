@@ -0,0 +1,140 @@
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from itertools import chain, groupby
+import heapq
+import threading
+import time
+
+from app import bus
+from app.metrics import Gauge, Histogram
+
+REBUILD_INTERVAL = 600   # 秒，定期从数据库全量重建一次，防止增量更新漏掉的变化（比如直接改库）一直留着
+SUGGESTION_LIMIT = 10
+
+suggest_seconds = Histogram('friend_suggest_seconds', '计算"可能认识的人"的耗时',
+                            buckets=(0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1))
+
+
+class FriendGraph:
+    """内存里的好友关系图：用户id -> 排好序的好友id数组（array('l')，每个好友只占几个字节）
+
+    启动后第一次用到时从 friendships 表全量加载，之后好友关系变化时增量更新，
+    每隔 REBUILD_INTERVAL 秒在后台线程里重建一次；重建期间的增量更新会记下来，重建完再补上。
+    """
+
+    def __init__(self):
+        self._adj = None
+        self._lock = threading.Lock()
+        self._journal = None     # 正在重建时记录的增量更新 [(是否添加, a, b)]
+        self._built_at = 0
+
+    def rebuild(self, db):
+        """从数据库全量加载，返回用户数"""
+        with self._lock:
+            self._journal = []
+        try:
+            cursor = db.conn.execute("SELECT user_id, friend_id FROM friendships ORDER BY user_id, friend_id")
+            adj = {user_id: array('l', (row[1] for row in rows))
+                   for user_id, rows in groupby(cursor, key=lambda row: row[0])}
+        except Exception:
+            with self._lock:
+                self._journal = None
+            raise
+        with self._lock:
+            for add, a, b in self._journal:
+                self._apply(adj, add, a, b)
+            self._adj, self._journal = adj, None
+            self._built_at = time.monotonic()
+        return len(adj)
+
+    def _ensure(self, db):
+        if self._adj is None:
+            self.rebuild(db)
+        elif time.monotonic() - self._built_at > REBUILD_INTERVAL and self._journal is None:
+            self._built_at = time.monotonic()  # 避免重复启动
+            threading.Thread(target=self._rebuild_in_background, name='friend-graph', daemon=True).start()
+
+    def _rebuild_in_background(self):
+        from app.db import connection
+        with connection() as db:
+            self.rebuild(db)
+
+    @staticmethod
+    def _apply(adj, add, a, b):
+        for x, y in ((a, b), (b, a)):
+            friends = adj.get(x)
+            if friends is None:
+                if add:
+                    adj[x] = array('l', (y,))
+                continue
+            i = bisect_left(friends, y)
+            present = i < len(friends) and friends[i] == y
+            if add and not present:
+                friends.insert(i, y)
+            elif not add and present:
+                del friends[i]
+
+    def _update(self, add, a, b):
+        with self._lock:
+            if self._adj is not None:
+                self._apply(self._adj, add, a, b)
+            if self._journal is not None:
+                self._journal.append((add, a, b))
+
+    def link(self, a, b):
+        """a、b 成为好友（提交之后调用），其他 worker 也一起更新"""
+        self._update(True, a, b)
+        bus.broadcast('friends.link', [a, b])
+
+    def unlink(self, a, b):
+        """a、b 不再是好友（提交之后调用）"""
+        self._update(False, a, b)
+        bus.broadcast('friends.unlink', [a, b])
+
+    def friends(self, db, user_id):
+        self._ensure(db)
+        return self._adj.get(user_id, ())
+
+    def suggest(self, db, user_id, limit=SUGGESTION_LIMIT, exclude=()):
+        """按共同好友数从多到少推荐还不是好友的人，返回 [(用户id, 共同好友数)]，不查数据库"""
+        start = time.perf_counter()
+        self._ensure(db)
+        adj = self._adj
+        friends = adj.get(user_id, ())
+        # 好友的好友全部摊平后计数，出现几次就有几个共同好友；计数在 C 里完成
+        counts = Counter(chain.from_iterable(adj.get(friend, ()) for friend in friends))
+        counts.pop(user_id, None)
+        for other in chain(friends, exclude):
+            counts.pop(other, None)
+        # 共同好友数相同时按id排，结果稳定
+        best = heapq.nsmallest(limit, counts.items(), key=lambda item: (-item[1], item[0]))
+        suggest_seconds.observe(time.perf_counter() - start)
+        return best
+
+    def __len__(self):
+        adj = self._adj
+        return len(adj) if adj is not None else 0
+
+
+graph = FriendGraph()
+bus.subscribe('friends.link', lambda payload: graph._update(True, *payload))
+bus.subscribe('friends.unlink', lambda payload: graph._update(False, *payload))
+Gauge('friend_graph_users', '内存好友关系图里的用户数', lambda: len(graph))
+
+
+def suggest(db, user_id, limit=SUGGESTION_LIMIT):
+    """"可能认识的人"：排除已经有待处理好友请求（任一方向）的人，返回 [(用户id, 用户名, 头像, 头像版本, 共同好友数)]"""
+    pending = db.conn.execute(
+        "SELECT from_id FROM friend_requests WHERE to_id = ? UNION SELECT to_id FROM friend_requests WHERE from_id = ?",
+        (user_id, user_id)
+    )
+    best = graph.suggest(db, user_id, limit, exclude=[row[0] for row in pending])
+    if not best:
+        return []
+    ids = [other for other, _ in best]
+    rows = db.conn.execute(
+        f"SELECT id, username, avatar, avatar_version FROM users WHERE id IN ({','.join('?' * len(ids))})", ids
+    )
+    users = {row[0]: row[1:] for row in rows}
+    return [(other, *users[other], mutual) for other, mutual in best if other in users]
@@ -0,0 +1,142 @@
+from collections import OrderedDict
+import hashlib
+import math
+import threading
+import time
+
+from app import bus
+
+FALSE_POSITIVE_RATE = 0.01   # 布隆过滤器误判率，误判时会再查一次数据库确认
+MIN_CAPACITY = 1024
+COALESCE_SECONDS = 2         # 同一个客户端在这段时间内重复查询同一个用户名，直接复用上次的结果
+COALESCE_MAX_ENTRIES = 10000
+# 秒，每隔这么久看一眼数据库里有没有不经过网站新增的用户（manage.py import-users 等），有就补进过滤器
+CATCH_UP_INTERVAL = 2
+
+
+class BloomFilter:
+    """用户名布隆过滤器：说"不存在"一定不存在，说"可能存在"时需要查库确认"""
+
+    def __init__(self, capacity):
+        self.capacity = max(capacity, MIN_CAPACITY)
+        self.size = int(-self.capacity * math.log(FALSE_POSITIVE_RATE) / math.log(2) ** 2)
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+
+_filter = None
+_lock = threading.Lock()
+_max_id = 0          # 过滤器里已经包含 id 不超过它的全部用户
+_checked_at = 0
+
+# 最近的查询结果：(客户端, 用户名) -> (时间, 结果)
+_recent = OrderedDict()
+_recent_lock = threading.Lock()
+
+
+def load(db):
+    """从数据库加载全部用户名，启动时调用一次"""
+    global _filter, _max_id, _checked_at
+    count = db.conn.execute("SELECT count(*) FROM users").fetchone()[0]
+    bloom = BloomFilter(count * 2)
+    max_id = 0
+    for user_id, username in db.conn.execute("SELECT id, username FROM users"):
+        bloom.add(username)
+        max_id = max(max_id, user_id)
+    with _lock:
+        _filter = bloom
+        _max_id = max_id
+        _checked_at = time.monotonic()
+
+
+def _catch_up(db):
+    """补上其他进程直接写进数据库的新用户（id 是自增的，只要查比 _max_id 大的），过滤器满了就整个重建"""
+    global _max_id, _checked_at
+    _checked_at = time.monotonic()
+    rows = db.conn.execute("SELECT id, username FROM users WHERE id > ? ORDER BY id", (_max_id,)).fetchall()
+    if not rows:
+        return
+    with _lock:
+        bloom = _filter
+        full = bloom is None or bloom.count + len(rows) > bloom.capacity
+        if not full:
+            for _, username in rows:
+                bloom.add(username)
+            _max_id = max(_max_id, rows[-1][0])
+    if full:
+        load(db)
+
+
+def add(db, username):
+    """注册或改名成功后登记新用户名，元素数超出容量时按两倍容量重建"""
+    bus.broadcast('usernames.add', username)
+    with _lock:
+        bloom = _filter
+    if bloom is None:
+        return load(db)
+    if bloom.count >= bloom.capacity:
+        return load(db)
+    with _lock:
+        bloom.add(username)
+
+
+def _add_remote(username):
+    """其他 worker 登记的用户名；过滤器满了就先丢掉，下次查询时重新加载"""
+    global _filter
+    with _lock:
+        if _filter is None:
+            return
+        if _filter.count >= _filter.capacity:
+            _filter = None
+        else:
+            _filter.add(username)
+
+
+bus.subscribe('usernames.add', _add_remote)
+
+
+def might_exist(db, username):
+    """用户名可能已经存在时返回True；返回False时一定不存在，不需要查库"""
+    if _filter is None:
+        load(db)
+    elif time.monotonic() - _checked_at > CATCH_UP_INTERVAL:
+        _catch_up(db)
+    return username in _filter
+
+
+def recent_answer(client, username):
+    """取出同一客户端刚刚查过的结果，过期或没有时返回None"""
+    key = (client, username)
+    with _recent_lock:
+        entry = _recent.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[0] > COALESCE_SECONDS:
+            del _recent[key]
+            return None
+        return entry[1]
+
+
+def remember_answer(client, username, answer):
+    """记住这次查询的结果，超出上限时淘汰最早的记录"""
+    with _recent_lock:
+        _recent[(client, username)] = (time.monotonic(), answer)
+        _recent.move_to_end((client, username))
+        while len(_recent) > COALESCE_MAX_ENTRIES:
+            _recent.popitem(last=False)
+
@@ -1,8 +1,10 @@
 from flask import Blueprint, request, render_template
+from app.pagecache import cached
 
 ab = Blueprint('about', __name__)
 
 @ab.route('/about')
+@cached
 def about():
     if request.method == 'GET':
         return render_template('about.html')
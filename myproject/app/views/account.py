@@ -1,24 +1,19 @@
 from flask import Blueprint, render_template, request, redirect, jsonify, session, flash, url_for
-from WkSqlite3 import WkSqlite3
-import bcrypt
+import logging
 import os
-import sys
+import sqlite3
 from datetime import datetime
-from werkzeug.utils import secure_filename
-import logging
-
-logging.getLogger('WkSqlite3').setLevel(logging.WARNING)
-
-# 确保能正确找到数据库文件
-def get_db_path():
-    """获取数据库文件的绝对路径"""
-    current_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-    return os.path.join(current_dir, 'database.db')
+from app.db import get_db, connection
+from app import usernames, pagecache, ratelimit, writer
+from app.ratelimit import by_ip, by_user, by_ip_and_form
+from app.sessions import store as sessions
+from app.hashing import HashingBusy, hash_password, check_password, needs_rehash
+from app.avatar import get_avatar, submit_avatar, avatar_status
 
 ac = Blueprint('account', __name__)  # 蓝图对象
+log = logging.getLogger(__name__)
 
 # 上传配置
-UPLOAD_FOLDER = 'static/uploads'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp', 'bmp'}
 MAX_FILE_SIZE = 5 * 1024 * 1024  # 5MB
 
@@ -28,7 +23,7 @@ def allowed_file(filename):
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 def process_user_avatar(file, user_id):
-    """处理用户头像：验证、转换、保存"""
+    """处理用户头像：检查大小后交给后台进程池验证、转换、生成各尺寸文件"""
     try:
         # 检查文件大小
         file.seek(0, 2)  # 移动到文件末尾
@@ -38,69 +33,12 @@ def process_user_avatar(file, user_id):
         if file_size > MAX_FILE_SIZE:
             return False, f"文件太大！请选择小于5MB的图片（当前：{file_size//1024}KB）"
         
-        # 尝试使用Pillow处理图片
-        try:
-            from PIL import Image
-            import io
-            
-            # 读取文件数据
-            file_data = file.read()
-            
-            # 用Pillow打开图片
-            image = Image.open(io.BytesIO(file_data))
-            
-            # 验证图片完整性
-            image.verify()
-            
-            # 重新打开（因为verify()会关闭图片）
-            image = Image.open(io.BytesIO(file_data))
-            
-            # 转换格式和调整大小
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
-            
-            # 调整大小（保持比例）
-            width, height = image.size
-            if width > 800 or height > 800:
-                image.thumbnail((800, 800), Image.Resampling.LANCZOS)
-            
-            # 保存为标准JPEG
-            output_path = os.path.join(UPLOAD_FOLDER, f"{user_id}.jpg")
-            image.save(output_path, 'JPEG', quality=85, optimize=True)
-            
-            return True, f"{user_id}.jpg"
-            
-        except ImportError:
-            # 如果没有安装Pillow，使用原始方法
-            print("Pillow未安装，使用原始文件保存方法")
-            file_extension = secure_filename(file.filename).rsplit('.', 1)[1].lower()
-            new_filename = f"{user_id}.{file_extension}"
-            file_path = os.path.join(UPLOAD_FOLDER, new_filename)
-            file.save(file_path)
-            return True, new_filename
+        # 图片解码和缩放很耗CPU，放到后台进程里做，请求线程只负责写暂存文件
+        return submit_avatar(file.read(), user_id)
             
     except Exception as e:
         return False, f"图片处理失败: {str(e)}"
 
-# 初始化数据库（确保表存在）
-def init_db():
-    """初始化数据库"""
-    db_path = get_db_path()
-    db = WkSqlite3(db_path)  # 传入完整路径
-    db.set_table('users')
-    # 创建用户表（如果不存在）
-    db.conn.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            pwd_hash TEXT UNIQUE NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            status TEXT
-        )
-    ''')
-    db.conn.commit()
-    return db
-
 def get_image_files(folder_path):
     image_extensions = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp'}
     image_files = []
@@ -112,6 +50,11 @@ def get_image_files(folder_path):
     
     return image_files
 
+BUSY_MESSAGE = "❌ 服务器繁忙，请稍后再试"
+# 写队列排队超时：操作还在排队，之后仍可能生效，不能让用户以为没做成
+REGISTER_BUSY_MESSAGE = "❌ 服务器繁忙，注册可能稍后才完成，请过一会儿先试试登录"
+RENAME_BUSY_MESSAGE = "❌ 服务器繁忙，用户名可能稍后才修改成功，请稍后刷新看看"
+
 # 用户名检查方法
 def check_username_exists(db, username):
     """检查用户名是否存在"""
@@ -139,27 +82,44 @@ def get_user_id(db, username):
     result = cursor.fetchone()
     return result[0] if result else None
 
-def find_user_profile_picture(user_id):
-    """查找用户的头像文件"""
-    upload_folder = 'static/uploads'
-    image_extensions = ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp']
-    
-    # 确保上传目录存在
-    if not os.path.exists(upload_folder):
-        os.makedirs(upload_folder, exist_ok=True)
-    
-    # 查找用户头像
-    for ext in image_extensions:
-        filename = f"{user_id}{ext}"
-        file_path = os.path.join(upload_folder, filename)
-        
-        if os.path.exists(file_path):
-            return f"/static/uploads/{filename}"
+# 下面的写操作交给写队列执行：writer.execute(操作, 参数...)，和其他并发的写操作合并提交
+def create_user(db, username, pwd_hash):
+    """新增用户，返回用户id；用户名已被占用（并发注册同名）时返回None"""
+    try:
+        return db.conn.execute(
+            "INSERT INTO users (username, pwd_hash) VALUES (?, ?)",
+            (username, pwd_hash)
+        ).lastrowid
+    except sqlite3.IntegrityError:
+        return None
+
+def rename_user(db, user_id, new_username):
+    """修改用户名，新用户名已被占用时返回False"""
+    try:
+        db.conn.execute("UPDATE users SET username = ? WHERE id = ?", (new_username, user_id))
+    except sqlite3.IntegrityError:
+        return False
+    return True
+
+def update_password_hash(db, user_id, pwd_hash):
+    db.conn.execute("UPDATE users SET pwd_hash = ? WHERE id = ?", (pwd_hash, user_id))
+
+def username_changed(db, user_id, new_username):
+    """改名提交之后：登记新用户名，好友列表、好友请求里都会显示用户名，其他设备上的会话里的用户名也一起改掉"""
+    usernames.add(db, new_username)
+    pagecache.bump_related(db, user_id)
+    sessions.update_user(user_id, current_user=new_username)
 
-    # 直接返回默认头像路径
-    return '/static/uploads/default.png'
+def username_changed_later(user_id, new_username):
+    """排队超时的改名之后才提交时，在后台线程里补上收尾"""
+    with connection() as db:
+        username_changed(db, user_id, new_username)
 
 @ac.route('/login', methods=['GET', 'POST'])
+# 同一个用户名的限流只算密码错误，并且按 (IP, 用户名) 计数，别人没法靠故意输错把用户锁在门外
+@ratelimit.limit((ratelimit.login_ip, by_ip), failures=[(ratelimit.login_user, by_ip_and_form('username'))],
+                 costly=True, template='login.html')
+@pagecache.cached
 def login():
     if request.method == 'GET':
         return render_template('login.html')
@@ -171,8 +131,8 @@ def login():
         if not all([username, pwd]):
             return render_template('login.html', error="❌ 请填写用户名和密码！")
         
-        # 初始化数据库
-        db = init_db()
+        # 从连接池获取数据库连接
+        db = get_db()
         
         try:
             # 检查用户是否存在
@@ -184,16 +144,22 @@ def login():
             if not stored_hash:
                 return render_template('login.html', error="❌ 用户数据异常！")
             
-            # 验证密码
-            if bcrypt.checkpw(pwd.encode(), stored_hash.encode()):
+            # 验证密码（在专用的哈希线程池里计算）
+            if check_password(pwd, stored_hash):
                 print(f'✅ 登录成功：用户名：{username}')
                 userid = get_user_id(db, username)
+
+                # 计算强度配置变了，趁着拿到明文密码顺手重新哈希，交给写队列后不等写完
+                if needs_rehash(stored_hash):
+                    try:
+                        writer.submit(update_password_hash, userid, hash_password(pwd))
+                    except HashingBusy:
+                        pass  # 下次登录再重新哈希
                 
                 # 查找用户头像
-                profile_picture_path = find_user_profile_picture(userid)
-                if not profile_picture_path:
-                    profile_picture_path = '/static/uploads/default.png'
+                profile_picture_path = get_avatar(db, userid, size='small')
 
+                session.regenerate()
                 session['current_user'] = username
                 session['user_id'] = userid
                 session['login_time'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
@@ -203,12 +169,17 @@ def login():
                 return redirect('/home')
             else:
                 print(f'❌ 登录失败：用户名：{username}，密码错误')
+                ratelimit.failed()
                 return render_template('login.html', error="❌ 密码错误！")
 
+        except HashingBusy:
+            return render_template('login.html', error=BUSY_MESSAGE), 503, {'Retry-After': '1'}
         except Exception as e:
             return render_template('login.html', error=f"❌ 登录失败: {str(e)}")
 
 @ac.route('/register', methods=['POST', 'GET'])
+@ratelimit.limit((ratelimit.register_ip, by_ip), costly=True, template='register.html')
+@pagecache.cached
 def register():
     if request.method == 'GET':
         return render_template('register.html')
@@ -232,8 +203,8 @@ def register():
             error="❌ 两次密码输入不一致！"
         )
 
-    # 初始化数据库
-    db = init_db()
+    # 从连接池获取数据库连接
+    db = get_db()
         
     try:
         # 检查用户名是否已存在
@@ -243,18 +214,25 @@ def register():
                 error=f"❌ 用户名 '{reg_username}' 已被注册！"
             )
 
-        # 生成密码哈希
-        pwd_hash = bcrypt.hashpw(reg_pwd.encode(), bcrypt.gensalt())
+        # 生成密码哈希（在专用的哈希线程池里计算）
+        pwd_hash = hash_password(reg_pwd)
 
-        # 插入新用户
-        db.insert_row(
-            username=reg_username, 
-            pwd_hash=pwd_hash.decode()  # 转成字符串存储
-        )
+        # 插入新用户，交给写队列（并发注册同名时唯一约束会让插入失败）
+        if writer.execute(create_user, reg_username, pwd_hash) is None:
+            return render_template(
+                'register.html', 
+                error=f"❌ 用户名 '{reg_username}' 已被注册！"
+            )
+        usernames.add(db, reg_username)
 
         print(f'有人执行了注册操作：用户名：{reg_username}')
         return render_template('welcome.html', userinfo=f'✅ 注册成功！欢迎 {reg_username}')
 
+    except HashingBusy:
+        return render_template('register.html', error=BUSY_MESSAGE), 503, {'Retry-After': '1'}
+    except writer.WriteBusy:
+        # 之后真的写入了，用户名过滤器会自己从数据库补上新用户（usernames.CATCH_UP_INTERVAL）
+        return render_template('register.html', error=REGISTER_BUSY_MESSAGE), 503, {'Retry-After': '1'}
     except Exception as e:
         # 捕获其他可能的错误（如数据库唯一约束冲突）
         if "UNIQUE constraint failed" in str(e):
@@ -269,6 +247,7 @@ def register():
 
 # 实时用户名检查API
 @ac.route('/api/check_username', methods=['POST'])
+@ratelimit.limit((ratelimit.check_username_ip, by_ip))
 def api_check_username():
     """API接口：检查用户名是否可用"""
     data = request.get_json()
@@ -280,14 +259,26 @@ def api_check_username():
     if len(username) < 3 or len(username) > 20:
         return jsonify({'available': False, 'message': '用户名长度必须在3-20个字符之间'})
 
-    db = init_db()
-    if check_username_exists(db, username):
-        return jsonify({'available': False, 'message': '❌ 用户名已被注册'})
-    return jsonify({'available': True, 'message': '✅ 用户名可用'})
+    # 同一个客户端连续查询同一个用户名时直接复用刚才的结果
+    client = request.remote_addr
+    answer = usernames.recent_answer(client, username)
+    if answer is None:
+        # 布隆过滤器说不存在就一定可用，只有"可能存在"时才查数据库确认
+        db = get_db()
+        taken = usernames.might_exist(db, username) and check_username_exists(db, username)
+        if taken:
+            answer = {'available': False, 'message': '❌ 用户名已被注册'}
+        else:
+            answer = {'available': True, 'message': '✅ 用户名可用'}
+        usernames.remember_answer(client, username, answer)
+    return jsonify(answer)
 
 # 退出登录路由
 @ac.route('/logout')
 def logout():
+    # 退出登录时这个用户在所有设备上的会话一起作废
+    if session.get('user_id'):
+        sessions.invalidate_user(session['user_id'])
     session.pop('current_user', None)
     session.pop('user_id', None)
     session.pop('login_time', None)
@@ -297,22 +288,34 @@ def logout():
 
 # 个人资料页
 @ac.route('/profile')
+@pagecache.cached
 def profile():
     username = session.get('current_user')
     user_id = session.get('user_id')
-    profile_picture_path = session.get('profile_picture_path')
     
     if not username:
         return redirect('/login?error=请先登录')
+
+    # 头像在后台处理，处理完成前这里显示的仍是旧头像
+    db = get_db()
+    processing, error = avatar_status(user_id)
+    if error:
+        flash(f'❌ {error}', 'warning')
+    if processing:
+        pagecache.skip()
+    session['profile_picture_path'] = get_avatar(db, user_id, size='small')
     
     return render_template(
         'profile.html',
         username=username,
         userid=user_id,
-        profile_picture_path=profile_picture_path
+        profile_picture_path=get_avatar(db, user_id),
+        profile_picture_webp=get_avatar(db, user_id, fmt='webp'),
+        avatar_processing=processing
     )
 
 @ac.route('/upload_image', methods=['POST'])
+@ratelimit.limit((ratelimit.upload_ip, by_ip), (ratelimit.upload_user, by_user), costly=True)
 def upload_image():
     """处理头像上传"""
     # 检查用户是否登录
@@ -340,8 +343,7 @@ def upload_image():
         success, result = process_user_avatar(file, user_id)
         
         if success:
-            session['profile_picture_path'] = f"/static/uploads/{result}"
-            flash('✅ 头像上传成功！', 'success')
+            flash(f'✅ {result}', 'success')
         else:
             flash(f'❌ {result}', 'warning')
         
@@ -355,7 +357,7 @@ def upload_image():
 def change_username():
     if request.method == 'GET':
         return redirect(url_for('account.profile'))
-    db = init_db()
+    db = get_db()
     username = session.get('current_user')
     user_id = get_user_id(db, username)
     new_username = request.form.get('new_username')
@@ -369,17 +371,19 @@ def change_username():
     elif check_username_exists(db, new_username):
         flash('❌ 用户名已被注册', 'warning')
     else:
-        flash('修改成功!', 'success')
-    
-    print(new_username)
-    try:
-        # 执行更新操作
-        db.conn.execute("UPDATE users SET username = ? WHERE id = ?", (new_username, user_id))
-        # 提交事务，确保更改保存到数据库 [citation:2]
-        db.conn.commit()
-        session['current_user'] = new_username
-        print("更新成功！")
-    except Exception as e:
-        print(f"更新失败: {e}")
+        try:
+            # 交给写队列执行；检查之后被别人抢先用了这个用户名时，唯一约束会让修改失败
+            if writer.execute(rename_user, user_id, new_username):
+                session['current_user'] = new_username
+                username_changed(db, user_id, new_username)
+                flash('修改成功!', 'success')
+            else:
+                flash('❌ 用户名已被注册', 'warning')
+        except writer.WriteBusy as busy:
+            busy.then(lambda renamed: renamed and username_changed_later(user_id, new_username))
+            flash(RENAME_BUSY_MESSAGE, 'warning')
+        except Exception:
+            flash('❌ 修改失败，请稍后重试', 'warning')
+            log.exception('修改用户名失败: user_id=%s', user_id)
 
     return redirect(url_for('account.profile'))
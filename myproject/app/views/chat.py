@@ -1,7 +1,136 @@
-from flask import Blueprint
+from flask import Blueprint, request, render_template, session, redirect, flash, jsonify
+import time
+
+from app.db import get_db
+from app.pubsub import notify
+from app import writer
+from app.views.friend import is_friend, list_friends, get_username
 
 Chat = Blueprint('chat list',__name__,)           #蓝图对象
 
+HISTORY_SIZE = 50       # 每页聊天记录条数
+MAX_MESSAGE_LENGTH = 1000
+BUSY_MESSAGE = "服务器繁忙，消息可能稍后才发出，请不要重复发送"
+
+
+def conversation_key(user_id, friend_id):
+    """两个人的会话标识，和谁先发消息无关"""
+    a, b = sorted((int(user_id), int(friend_id)))
+    return f"{a}:{b}"
+
+def message_dict(row):
+    msg_id, sender_id, content, created_at = row
+    return {'id': msg_id, 'sender_id': sender_id, 'content': content, 'created_at': created_at}
+
+def get_messages(db, conversation, before=None, after_id=None, limit=HISTORY_SIZE):
+    """按 (时间, id) 做游标分页读取聊天记录，返回按时间正序排列的列表"""
+    if after_id is not None:
+        # 断线重连后补齐缺失的消息
+        cursor = db.conn.execute(
+            '''SELECT id, sender_id, content, created_at FROM messages
+               WHERE conversation = ? AND id > ?
+               ORDER BY created_at, id LIMIT ?''',
+            (conversation, after_id, limit)
+        )
+        return [message_dict(row) for row in cursor]
+    if before is not None:
+        cursor = db.conn.execute(
+            '''SELECT id, sender_id, content, created_at FROM messages
+               WHERE conversation = ? AND (created_at, id) < (?, ?)
+               ORDER BY created_at DESC, id DESC LIMIT ?''',
+            (conversation, before[0], before[1], limit)
+        )
+    else:
+        cursor = db.conn.execute(
+            '''SELECT id, sender_id, content, created_at FROM messages
+               WHERE conversation = ?
+               ORDER BY created_at DESC, id DESC LIMIT ?''',
+            (conversation, limit)
+        )
+    return [message_dict(row) for row in reversed(cursor.fetchall())]
+
+def save_message(conversation, sender_id, content):
+    """通过写队列保存消息，和其他并发的写操作合并提交，返回消息；等不到提交时抛出 WriteBusy"""
+    created_at = time.time()
+
+    def op(db):
+        cursor = db.conn.execute(
+            "INSERT INTO messages (conversation, sender_id, content, created_at) VALUES (?, ?, ?, ?)",
+            (conversation, sender_id, content, created_at)
+        )
+        return message_dict((cursor.lastrowid, sender_id, content, created_at))
+
+    return writer.execute(op)
+
+def push_message(conversation, friend_id, message):
+    """和好友事件一样走推送服务（页面上 base.html 打开的那条连接），自己的其他设备也能收到"""
+    event = dict(message, conversation=conversation)
+    notify(friend_id, 'message', event)
+    notify(message['sender_id'], 'message', event)
+
 @Chat.route('/chatlist')
 def chatlist():
-    return '聊天列表'
\ No newline at end of file
+    user_id = session.get('user_id')
+    if not user_id:
+        flash('请先登录！', 'error')
+        return redirect('/login')
+    friends, _ = list_friends(get_db(), user_id)
+    return render_template('chatlist.html', friend_list=friends)
+
+
+@Chat.route('/chat/<int:friend_id>')
+def chat(friend_id):
+    user_id = session.get('user_id')
+    if not user_id:
+        flash('请先登录！', 'error')
+        return redirect('/login')
+    db = get_db()
+    if not is_friend(db, user_id, friend_id):
+        flash('❌ 只能和好友聊天', 'warning')
+        return redirect('/chatlist')
+    return render_template(
+        'chat.html',
+        friend_id=friend_id,
+        friend_name=get_username(db, friend_id),
+        user_id=user_id,
+        messages=get_messages(db, conversation_key(user_id, friend_id))
+    )
+
+
+@Chat.route('/api/chat/<int:friend_id>/messages', methods=['GET', 'POST'])
+def api_messages(friend_id):
+    """API接口：GET 分页读取聊天记录，POST 发送消息"""
+    user_id = session.get('user_id')
+    if not user_id:
+        return jsonify({'error': '请先登录'}), 401
+    db = get_db()
+    if not is_friend(db, user_id, friend_id):
+        return jsonify({'error': '只能和好友聊天'}), 403
+    conversation = conversation_key(user_id, friend_id)
+
+    if request.method == 'GET':
+        before = request.args.get('before')  # 格式：时间戳:消息id
+        after_id = request.args.get('after_id', type=int)
+        if before:
+            try:
+                created_at, msg_id = before.split(':')
+                before = (float(created_at), int(msg_id))
+            except ValueError:
+                return jsonify({'error': '参数错误'}), 400
+        return jsonify({'messages': get_messages(db, conversation, before or None, after_id)})
+
+    content = ((request.get_json(silent=True) or {}).get('content') or '').strip()
+    if not content:
+        return jsonify({'error': '消息不能为空'}), 400
+    if len(content) > MAX_MESSAGE_LENGTH:
+        return jsonify({'error': f'消息不能超过{MAX_MESSAGE_LENGTH}个字'}), 400
+
+    try:
+        message = save_message(conversation, user_id, content)
+    except writer.WriteBusy as busy:
+        # 消息还在排队，之后仍可能写入：那时照常推送，页面收到推送就会显示出来
+        busy.then(lambda message: push_message(conversation, friend_id, message))
+        return jsonify({'error': BUSY_MESSAGE}), 503, {'Retry-After': '1'}
+    push_message(conversation, friend_id, message)
+    return jsonify(message)
+
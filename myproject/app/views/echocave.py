@@ -0,0 +1,13 @@
+from flask import Blueprint, request, session, jsonify
+from app.echocave import store
+
+ec = Blueprint('echocave', __name__)
+
+@ec.route('/api/echocave/random')
+def random_echocave():
+    """API接口：随机返回一条回声洞，unique=1 时同一会话内看完一轮之前不会重复"""
+    if request.args.get('unique') == '1':
+        text, session['echocave'] = store.next_unique(session.get('echocave'))
+    else:
+        text = store.random()
+    return jsonify({'text': text if text is not None else "暂无内容"})
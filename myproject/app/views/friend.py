@@ -1,34 +1,25 @@
-from flask import Blueprint, request, render_template, session, redirect, flash
-from WkSqlite3 import WkSqlite3
-import os
+from flask import Blueprint, request, render_template, session, redirect, flash, jsonify
+from app.db import get_db
+from app.avatar import remember, avatar_url
+from app.pubsub import notify
+from app import writer
+from app.pagecache import cached, bump
+from app.suggestions import graph, suggest
 
 fr = Blueprint('friend', __name__)
 
+PAGE_SIZE = 50      # 好友列表每页条数
+MAX_PAGE_SIZE = 200
+SEARCH_LIMIT = 20   # 搜索结果每页条数
+SEARCH_CANDIDATES = 1000    # 包含关键字（不是前缀）的用户最多取这么多个再排序，搜索结果翻不到这么远
+SEARCH_MIN_CONTAINS = 3     # 关键字至少这么长才搜用户名中间包含它的用户（三元组索引能用的最短长度）
+MAX_BATCH = 500     # 批量接口一次最多处理的条数
+SQL_CHUNK = 500     # IN (...) 里一次最多放多少个参数，老版本SQLite上限是999
+SUGGESTION_LIMIT = 10   # "可能认识的人"默认条数
+MAX_SUGGESTIONS = 50
+BUSY_MESSAGE = "❌ 服务器繁忙，操作可能稍后才生效，请稍后刷新看看"
 
-# 确保能正确找到数据库文件
-def get_db_path():
-    """获取数据库文件的绝对路径"""
-    current_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-    return os.path.join(current_dir, 'database.db')
-
-# 初始化数据库（确保表存在）
-def init_db():
-    """初始化数据库"""
-    db_path = get_db_path()
-    db = WkSqlite3(db_path)  # 传入完整路径
-    db.set_table('users')
-    # 创建用户表（如果不存在）
-    db.conn.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            pwd_hash TEXT UNIQUE NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            status TEXT
-        )
-    ''')
-    db.conn.commit()
-    return db
+_has_search_index = None
 
 def get_user_id(db, username):
     """获取用户id"""
@@ -48,81 +39,303 @@ def get_username(db, userid):
     result = cursor.fetchone()
     return result[0] if result else None
 
-def get_friends(db, username):
-    """查看当前用户的好友"""
+def get_friends(db, user_id):
+    """查看当前用户的好友id列表"""
     cursor = db.conn.execute(
-        "SELECT friends_id FROM users WHERE username = ?",
-        (username,)
+        "SELECT friend_id FROM friendships WHERE user_id = ?",
+        (user_id,)
     )
-    result = cursor.fetchone()
-    return result[0] if result else None
+    return [row[0] for row in cursor]
 
-def get_friend_request(db, username):
-    """查看当前用户的好友请求信息"""
+def is_friend(db, user_id, friend_id):
+    """判断两人是否已经是好友"""
     cursor = db.conn.execute(
-        "SELECT friend_request FROM users WHERE username = ?",
-        (username,)
+        "SELECT 1 FROM friendships WHERE user_id = ? AND friend_id = ?",
+        (user_id, friend_id)
     )
-    result = cursor.fetchone()
-    return result[0] if result else None
+    return cursor.fetchone() is not None
 
-def update_friends(db, friends_id, username):
-    """更新数据库中的好友列表"""
-    friends_id_str = ",".join(friends_id)
+def get_friend_request(db, user_id):
+    """查看谁向当前用户发送了好友请求，返回对方id列表"""
+    cursor = db.conn.execute(
+        "SELECT from_id FROM friend_requests WHERE to_id = ?",
+        (user_id,)
+    )
+    return [row[0] for row in cursor]
 
-    db.conn.execute(
-        "UPDATE users SET friends_id = ? WHERE username = ?",
-        (friends_id_str, username)
+def has_friend_request(db, to_id, from_id):
+    """判断 from_id 是否向 to_id 发送过好友请求"""
+    cursor = db.conn.execute(
+        "SELECT 1 FROM friend_requests WHERE to_id = ? AND from_id = ?",
+        (to_id, from_id)
     )
-    db.conn.commit()
+    return cursor.fetchone() is not None
+
+# 下面的写操作不会自己提交，由调用方把一次完整操作放进同一个事务里提交
+def update_friends(db, user_id, friend_id, add=True):
+    """添加或删除一对好友关系（双向）"""
+    pairs = [(user_id, friend_id), (friend_id, user_id)]
+    if add:
+        db.conn.executemany(
+            "INSERT OR IGNORE INTO friendships (user_id, friend_id) VALUES (?, ?)",
+            pairs
+        )
+    else:
+        db.conn.executemany(
+            "DELETE FROM friendships WHERE user_id = ? AND friend_id = ?",
+            pairs
+        )
+
+def update_friend_request(db, to_id, from_id, add=True):
+    """添加或删除一条好友请求"""
+    if add:
+        db.conn.execute(
+            "INSERT OR IGNORE INTO friend_requests (to_id, from_id) VALUES (?, ?)",
+            (to_id, from_id)
+        )
+    else:
+        db.conn.execute(
+            "DELETE FROM friend_requests WHERE to_id = ? AND from_id = ?",
+            (to_id, from_id)
+        )
+
+# 下面是完整的好友操作，交给写队列执行：writer.execute(操作, 参数...)
+# 每个操作在写线程里原子地完成（先检查再修改，不会被并发的请求打断），并和同时提交的其他操作合并成一次提交
+def send_friend_request(db, from_id, to_id):
+    """发送好友请求，返回 'sent'、'already_friends' 或 'already_requested'"""
+    if is_friend(db, from_id, to_id):
+        return 'already_friends'
+    if has_friend_request(db, to_id, from_id):
+        return 'already_requested'
+    update_friend_request(db, to_id, from_id)
+    return 'sent'
+
+def accept_friend_request(db, user_id, from_id):
+    """接受好友请求，对方没有发过请求时返回False"""
+    if not has_friend_request(db, user_id, from_id):
+        return False
+    update_friend_request(db, user_id, from_id, add=False)
+    # 对方也可能给自己发过请求，一并清掉
+    update_friend_request(db, from_id, user_id, add=False)
+    update_friends(db, user_id, from_id)
+    return True
+
+def decline_friend_request(db, user_id, from_id):
+    """拒绝好友请求"""
+    update_friend_request(db, user_id, from_id, add=False)
 
-def update_friend_request(db, friend_request, username):
-    """更新数据库中的好友列表请求"""
-    friend_request_str = ",".join(friend_request)
+def remove_friend(db, user_id, friend_id):
+    """删除好友（双向），不是好友时返回False"""
+    if not is_friend(db, user_id, friend_id):
+        return False
+    update_friends(db, user_id, friend_id, add=False)
+    return True
 
-    db.conn.execute(
-        "UPDATE users SET friend_request = ? WHERE username = ?",
-        (friend_request_str, username)
+# 批量操作每一项的结果：做成了 / 没做成
+BATCH_DONE = {'accept': 'accepted', 'decline': 'declined', 'delete': 'deleted'}
+BATCH_FAILED = {'accept': 'not_requested', 'decline': 'not_requested', 'delete': 'not_friends'}
+
+def apply_friend_batch(db, user_id, actions):
+    """批量接受/拒绝好友请求、删除好友，actions 是 [(对方id, 动作)]，每个人只能出现一次
+
+    对方id先放进临时表，之后不管多少条都只执行固定几条集合SQL，不逐条查询。
+    返回 [(对方id, 结果)]，顺序和 actions 一致。
+    """
+    conn = db.conn
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS friend_batch (other INTEGER PRIMARY KEY, action TEXT NOT NULL)")
+    conn.execute("DELETE FROM temp.friend_batch")
+    conn.executemany("INSERT INTO temp.friend_batch (other, action) VALUES (?, ?)", actions)
+
+    # 先按修改前的状态判断每一项能不能做
+    done = {row[0] for row in conn.execute(
+        '''SELECT b.other FROM temp.friend_batch b
+           WHERE (b.action IN ('accept', 'decline') AND EXISTS (
+                     SELECT 1 FROM friend_requests r WHERE r.to_id = ? AND r.from_id = b.other))
+              OR (b.action = 'delete' AND EXISTS (
+                     SELECT 1 FROM friendships f WHERE f.user_id = ? AND f.friend_id = b.other))''',
+        (user_id, user_id)
+    )}
+    accepted = '''SELECT r.from_id FROM friend_requests r
+                  JOIN temp.friend_batch b ON b.other = r.from_id AND b.action = 'accept'
+                  WHERE r.to_id = ?'''
+    conn.execute(
+        f'''INSERT OR IGNORE INTO friendships (user_id, friend_id)
+            SELECT ?, from_id FROM ({accepted}) UNION ALL SELECT from_id, ? FROM ({accepted})''',
+        (user_id, user_id, user_id, user_id)
     )
-    db.conn.commit()
+    # 被接受的人如果也给自己发过请求，一并清掉
+    conn.execute(f"DELETE FROM friend_requests WHERE from_id = ? AND to_id IN ({accepted})", (user_id, user_id))
+    conn.execute(
+        '''DELETE FROM friend_requests WHERE to_id = ? AND from_id IN (
+               SELECT other FROM temp.friend_batch WHERE action IN ('accept', 'decline'))''',
+        (user_id,)
+    )
+    removed = "SELECT other FROM temp.friend_batch WHERE action = 'delete'"
+    conn.execute(f"DELETE FROM friendships WHERE user_id = ? AND friend_id IN ({removed})", (user_id,))
+    conn.execute(f"DELETE FROM friendships WHERE friend_id = ? AND user_id IN ({removed})", (user_id,))
+    conn.execute("DELETE FROM temp.friend_batch")
+    return [(other, BATCH_DONE[action] if other in done else BATCH_FAILED[action]) for other, action in actions]
 
-def find_user_profile_picture(user_id):
-    """查找用户的头像文件"""
-    upload_folder = 'static/uploads'
-    image_extensions = ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp']
-    
-    # 确保上传目录存在
-    if not os.path.exists(upload_folder):
-        os.makedirs(upload_folder, exist_ok=True)
-    
-    # 查找用户头像
-    for ext in image_extensions:
-        filename = f"{user_id}{ext}"
-        file_path = os.path.join(upload_folder, filename)
-        
-        if os.path.exists(file_path):
-            return f"/static/uploads/{filename}"
+# 写操作提交之后的收尾：更新好友关系图、让页面缓存失效、通知对方
+# 不依赖请求，写队列超时、操作之后才提交时由 WriteBusy.then 在后台线程里补上
+def friend_removed(user_id, username, other):
+    graph.unlink(user_id, other)
+    bump(user_id, other)
+    notify(other, 'friend_delete', {'user_id': user_id, 'username': username})
+
+def friend_accepted(user_id, username, other):
+    graph.link(user_id, other)
+    bump(user_id, other)
+    notify(other, 'friend_accept', {'user_id': user_id, 'username': username})
+
+def request_sent(user_id, username, other):
+    bump(user_id, other)
+    notify(other, 'friend_request', {'user_id': user_id, 'username': username})
+
+def batch_applied(user_id, username, outcomes):
+    """outcomes 是 [(对方id, 结果)]，只处理做成了的，页面缓存一次全部失效"""
+    changed = [(other, result) for other, result in outcomes if result in BATCH_DONE.values()]
+    bump(user_id, *(other for other, _ in changed))
+    for other, result in changed:
+        if result == 'accepted':
+            graph.link(user_id, other)
+            notify(other, 'friend_accept', {'user_id': user_id, 'username': username})
+        elif result == 'deleted':
+            graph.unlink(user_id, other)
+            notify(other, 'friend_delete', {'user_id': user_id, 'username': username})
 
-    # 直接返回默认头像路径
-    return '/static/uploads/default.png'
+def busy_redirect(busy, location, callback):
+    """写队列太忙：提示稍后再试。操作还在排队，之后真的提交了再由 callback(结果) 收尾"""
+    busy.then(callback)
+    flash(BUSY_MESSAGE, 'warning')
+    return redirect(location)
 
-def search_user(db, text):
-    """在数据库中搜索用户"""
-    result = []
+def batch_busy(busy, user_id, username):
+    """批量操作排队超时：这一批之后仍可能提交，客户端重试前应该先重新读取好友列表"""
+    busy.then(lambda outcomes: batch_applied(user_id, username, outcomes))
+    return jsonify({'error': BUSY_MESSAGE}), 503, {'Retry-After': '1'}
+
+def answer_all_requests(db, user_id, action):
+    """接受或拒绝全部待处理的好友请求，和读取请求列表在同一个事务里"""
+    rows = db.conn.execute("SELECT from_id FROM friend_requests WHERE to_id = ?", (user_id,)).fetchall()
+    return apply_friend_batch(db, user_id, [(row[0], action) for row in rows])
+
+def get_usernames(db, user_ids):
+    """一批用户id -> 用户名，按块查询"""
+    user_ids = list(user_ids)
+    names = {}
+    for i in range(0, len(user_ids), SQL_CHUNK):
+        chunk = user_ids[i:i + SQL_CHUNK]
+        names.update(db.conn.execute(
+            f"SELECT id, username FROM users WHERE id IN ({','.join('?' * len(chunk))})", chunk
+        ).fetchall())
+    return names
+
+def get_user_ids(db, usernames):
+    """一批用户名 -> 用户id，按块查询"""
+    usernames = list(usernames)
+    ids = {}
+    for i in range(0, len(usernames), SQL_CHUNK):
+        chunk = usernames[i:i + SQL_CHUNK]
+        ids.update(db.conn.execute(
+            f"SELECT username, id FROM users WHERE username IN ({','.join('?' * len(chunk))})", chunk
+        ).fetchall())
+    return ids
+
+def list_friends(db, user_id, after=0, limit=PAGE_SIZE):
+    """一次查询取出一页好友，按好友id做游标分页，返回 (好友列表, 下一页游标)"""
     cursor = db.conn.execute(
-        "SELECT username FROM users"
+        '''SELECT u.id, u.username, u.avatar, u.avatar_version FROM friendships f
+           JOIN users u ON u.id = f.friend_id
+           WHERE f.user_id = ? AND f.friend_id > ?
+           ORDER BY f.friend_id LIMIT ?''',
+        (user_id, after, limit + 1)
     )
-    if text:
-        for i in cursor:
-            if text in i[0]:
-                result.append(i[0])
-    else:
+    return _page(cursor.fetchall(), limit)
+
+def list_friend_requests(db, user_id, after=0, limit=PAGE_SIZE):
+    """一次查询取出一页好友请求，返回 (请求列表, 下一页游标)"""
+    cursor = db.conn.execute(
+        '''SELECT u.id, u.username, u.avatar, u.avatar_version FROM friend_requests r
+           JOIN users u ON u.id = r.from_id
+           WHERE r.to_id = ? AND r.from_id > ?
+           ORDER BY r.from_id LIMIT ?''',
+        (user_id, after, limit + 1)
+    )
+    return _page(cursor.fetchall(), limit)
+
+def _page(rows, limit):
+    """把多取的一行当作"还有下一页"的标记，转换成 (id, 用户名, 头像, WebP头像) 列表"""
+    next_after = rows[limit - 1][0] if len(rows) > limit else None
+    page = []
+    for uid, name, avatar, version in rows[:limit]:
+        remember(uid, avatar, version)
+        page.append((uid, name, avatar_url(avatar, version, 'small'), avatar_url(avatar, version, 'small', 'webp')))
+    return page, next_after
+
+def has_search_index(db):
+    """数据库里有没有用户名全文索引（老版本SQLite建不了）"""
+    global _has_search_index
+    if _has_search_index is None:
+        cursor = db.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'users_search'"
+        )
+        _has_search_index = cursor.fetchone() is not None
+    return _has_search_index
+
+def search_user(db, text, limit=SEARCH_LIMIT, offset=0):
+    """在数据库中搜索用户名包含关键字的用户
+
+    以关键字开头的（完全匹配自然在最前）按用户名走唯一索引排在前面，翻完了再接着列出其余包含关键字的。
+    关键字太短或者没有全文索引时只找前缀匹配，不逐个扫描用户名，见 prefix_only。
+    """
+    if not text:
         return 'NoInput'
+    prefix = (text, text + '\U0010ffff')
+    result = [row[0] for row in db.conn.execute(
+        '''SELECT username FROM users
+           WHERE username >= ? AND username < ?
+           ORDER BY username LIMIT ? OFFSET ?''',
+        (*prefix, limit, offset)
+    )]
+    if len(result) < limit and not prefix_only(db, text):
+        if result:
+            skip = 0
+        else:
+            # 这一页已经在前缀匹配之后，算出还要跳过多少个（最多数到 offset 个）
+            skip = offset - db.conn.execute(
+                "SELECT count(*) FROM (SELECT 1 FROM users WHERE username >= ? AND username < ? LIMIT ?)",
+                (*prefix, offset)
+            ).fetchone()[0]
+        result += search_contains(db, text, limit - len(result), skip)
     if not result:
         return None
     return result
 
+def prefix_only(db, text):
+    """这个关键字是否只能按前缀搜索：三元组索引用不上时逐个扫描用户名太慢，只扫一部分又会漏掉结果"""
+    return len(text) < SEARCH_MIN_CONTAINS or not has_search_index(db)
+
+def search_contains(db, text, limit, offset):
+    """用户名包含关键字、但不以它开头的用户，按长度、用户名排序
+
+    三元组索引找出包含关键字的用户（不区分大小写，再用 instr 按原样筛一遍），调用前先用 prefix_only 确认能用。
+    候选先截断到 SEARCH_CANDIDATES 个再排序，匹配的人再多也不会全部拿来排。
+    """
+    cursor = db.conn.execute(
+        '''SELECT username FROM (
+               SELECT u.username FROM users_search s
+               JOIN users u ON u.id = s.rowid
+               WHERE users_search MATCH ? AND instr(u.username, ?) > 1
+               LIMIT ?
+           )
+           ORDER BY length(username), username LIMIT ? OFFSET ?''',
+        ('"' + text.replace('"', '""') + '"', text, SEARCH_CANDIDATES, limit, offset)
+    )
+    return [row[0] for row in cursor]
+
 @fr.route('/friend_list')
+@cached
 def friend_list():
     if request.method == 'GET':
         username = session.get('current_user')
@@ -130,85 +343,36 @@ def friend_list():
             flash('请先登录！', 'error')
             return redirect('/login')
             
-        db = init_db()
+        db = get_db()
         userid = get_user_id(db, username)
-        friends = get_friends(db, username)
-        friend_list = []
         del_friend = request.args.get('del')
 
-        # 处理好友列表显示
-        if friends:
-            friends = friends.split(',')
-            for friend_id in friends:
-                if friend_id:  # 确保不是空字符串
-                    friend_name = get_username(db, friend_id)
-                    if friend_name:  # 确保用户存在
-                        friend_list.append((find_user_profile_picture(friend_id), friend_name))
-        else:
-            friends = []
-        
         # 处理删除好友请求
         if del_friend:
-            print(f"要删除的好友: {del_friend}")
-            
-            # 获取要删除的好友ID（确保是字符串）
-            del_friend_id = str(get_user_id(db, del_friend))
-            print(f"要删除的好友ID: {del_friend_id}")
+            del_friend_id = get_user_id(db, del_friend)
             
-            if friends and del_friend_id in friends:
-                # 创建新列表而不是修改原列表
-                new_friends = [f for f in friends if f != del_friend_id]
-                
-                # 更新当前用户的好友列表
-                update_friends(db, new_friends, username)
-                
-                # 也删除对方好友列表中的自己
-                friend_friends = get_friends(db, del_friend)
-                if friend_friends:
-                    friend_friends = friend_friends.split(',')
-                    new_friend_friends = [f for f in friend_friends if f != str(userid)]
-                    update_friends(db, new_friend_friends, del_friend)
-                
+            try:
+                removed = del_friend_id and writer.execute(remove_friend, userid, del_friend_id)
+            except writer.WriteBusy as busy:
+                return busy_redirect(busy, '/friend_list',
+                                     lambda done: done and friend_removed(userid, username, del_friend_id))
+            if removed:
+                friend_removed(userid, username, del_friend_id)
                 flash('✅ 成功删除好友', 'success')
                 return redirect('/friend_list')
             else:
                 flash('❌ 未找到该好友', 'error')
 
-        # 处理好友请求消息
-        friend_request = get_friend_request(db, username)
-        friend_request_list = []
-        if friend_request:
-            friend_request = friend_request.split(',')
-            for i in friend_request:
-                friend_request_list.append((find_user_profile_picture(i), get_username(db, i)))
-        else:
-            friend_request = []
-
         accept_friend = request.args.get('accept')
         if accept_friend:
             accept_id = get_user_id(db, accept_friend)
-            if str(accept_id) in friend_request:
-                
-                a = 0
-                for i in friend_request:
-                    if str(i) == str(accept_id):
-                        friend_request.pop(a)
-                        break
-                    a += 1
-                update_friend_request(db, friend_request, username)
-
-                if not friends:
-                    friends = []
-                if not str(accept_id) in friends:
-                    friends.append(str(accept_id))
-                    update_friends(db, friends, username)
-                    accept_friend_friends = get_friends(db, accept_friend)
-                    if accept_friend_friends:
-                        accept_friend_friends = accept_friend_friends.split(',')
-                    else:
-                        accept_friend_friends = []
-                    accept_friend_friends.append(str(userid))
-                    update_friends(db, accept_friend_friends, accept_friend)
+            try:
+                accepted = accept_id and writer.execute(accept_friend_request, userid, accept_id)
+            except writer.WriteBusy as busy:
+                return busy_redirect(busy, '/friend_list',
+                                     lambda done: done and friend_accepted(userid, username, accept_id))
+            if accepted:
+                friend_accepted(userid, username, accept_id)
                 flash(f'✅已和{accept_friend}成为好友!', 'success')
                 return redirect('/friend_list')
             else:
@@ -217,43 +381,177 @@ def friend_list():
         decline_friend = request.args.get('decline')
         if decline_friend:
             decline_id = get_user_id(db, decline_friend)
-            a = 0
-            for i in friend_request:
-                if str(i) == str(decline_id):
-                    friend_request.pop(a)
-                    break
-                a += 1
-            update_friend_request(db, friend_request, username)
+            if decline_id:
+                try:
+                    writer.execute(decline_friend_request, userid, decline_id)
+                except writer.WriteBusy as busy:
+                    return busy_redirect(busy, '/friend_list', lambda _: bump(userid, decline_id))
+                bump(userid, decline_id)
             flash(f'✅已拒绝{decline_friend}的好友申请', 'success')
             return redirect('/friend_list')
+
+        # 好友列表和好友请求各一次查询，只渲染第一页，后面的由页面通过 /api/friends 加载
+        friend_list, friends_next = list_friends(db, userid)
+        friend_request_list, requests_next = list_friend_requests(db, userid)
         
         return render_template(
             'friend_list.html',
-            friend_list=friend_list if friend_list else None,
-            friend_request_list=friend_request_list
+            friend_list=[(avatar, name, webp) for _, name, avatar, webp in friend_list] or None,
+            friend_request_list=[(avatar, name, webp) for _, name, avatar, webp in friend_request_list],
+            friends_next=friends_next,
+            requests_next=requests_next
         )
 
 
+@fr.route('/api/friends')
+def api_friends():
+    """API接口：分页获取好友（type=friends）或好友请求（type=requests）"""
+    user_id = session.get('user_id')
+    if not user_id:
+        return jsonify({'error': '请先登录'}), 401
+
+    after = request.args.get('after', 0, type=int)
+    limit = min(max(request.args.get('limit', PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+    if request.args.get('type', 'friends') == 'requests':
+        rows, next_after = list_friend_requests(get_db(), user_id, after, limit)
+    else:
+        rows, next_after = list_friends(get_db(), user_id, after, limit)
+
+    return jsonify({
+        'items': [{'id': uid, 'username': name, 'avatar_url': avatar} for uid, name, avatar, _ in rows],
+        'next': next_after
+    })
+
+
+@fr.route('/api/friends/batch', methods=['POST'])
+def api_friends_batch():
+    """API接口：批量接受/拒绝好友请求、删除好友，整批在一个事务里完成
+
+    请求体 {"actions": [{"action": "accept", "username": "xx"}, {"action": "delete", "user_id": 3}, ...]}，
+    action 可以是 accept、decline、delete；或者 {"all": "accept"} / {"all": "decline"} 处理全部好友请求。
+    返回每一项的结果：accepted/declined/deleted，以及 not_requested、not_friends、unknown_user、
+    invalid_user（对方是自己）、invalid_action、duplicate 等没做成的原因。
+    """
+    user_id = session.get('user_id')
+    username = session.get('current_user')
+    if not user_id:
+        return jsonify({'error': '请先登录'}), 401
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': '请求格式错误'}), 400
+
+    db = get_db()
+    results = []     # 每一项：{'action', 'user_id', 'username', 'result'}
+    if 'all' in data:
+        if data['all'] not in ('accept', 'decline'):
+            return jsonify({'error': 'all 只能是 accept 或 decline'}), 400
+        try:
+            outcomes = writer.execute(answer_all_requests, user_id, data['all'])
+        except writer.WriteBusy as busy:
+            return batch_busy(busy, user_id, username)
+        names = get_usernames(db, [other for other, _ in outcomes])
+        results = [{'action': data['all'], 'user_id': other, 'username': names.get(other), 'result': result}
+                   for other, result in outcomes]
+    else:
+        items = data.get('actions')
+        if not isinstance(items, list) or not items:
+            return jsonify({'error': 'actions 不能为空'}), 400
+        if len(items) > MAX_BATCH:
+            return jsonify({'error': f'一次最多处理 {MAX_BATCH} 条'}), 400
+        items = [item if isinstance(item, dict) else {} for item in items]
+
+        # 用户名和id各一次（按块）查询，换算成 id；类型不对的（列表、true 之类）不参与查询
+        ids = get_user_ids(db, {item['username'] for item in items if isinstance(item.get('username'), str)})
+        given = {item['user_id'] for item in items if type(item.get('user_id')) is int and 'username' not in item}
+        names = get_usernames(db, given)
+        seen, actions = set(), []
+        for item in items:
+            action = item.get('action')
+            if 'username' in item:
+                other_name = item['username'] if isinstance(item['username'], str) else None
+                other = ids.get(other_name) if other_name is not None else None
+            else:
+                other = item.get('user_id') if type(item.get('user_id')) is int else None
+                other_name = names.get(other) if other is not None else None
+                if other_name is None:
+                    other = None
+            entry = {'action': action if isinstance(action, str) else None, 'user_id': other, 'username': other_name}
+            if not isinstance(action, str) or action not in BATCH_DONE:
+                entry['result'] = 'invalid_action'
+            elif other is None:
+                entry['result'] = 'unknown_user'
+            elif other == user_id:
+                entry['result'] = 'invalid_user'
+            elif other in seen:
+                entry['result'] = 'duplicate'
+            else:
+                seen.add(other)
+                actions.append((other, action))
+            results.append(entry)
+        try:
+            outcomes = dict(writer.execute(apply_friend_batch, user_id, actions)) if actions else {}
+        except writer.WriteBusy as busy:
+            return batch_busy(busy, user_id, username)
+        for entry in results:
+            if 'result' not in entry:
+                entry['result'] = outcomes[entry['user_id']]
+
+    # 提交之后再让页面缓存失效、通知对方
+    batch_applied(user_id, username, [(entry['user_id'], entry['result']) for entry in results])
+
+    summary = {}
+    for entry in results:
+        summary[entry['result']] = summary.get(entry['result'], 0) + 1
+    return jsonify({'results': results, 'summary': summary})
+
+
+@fr.route('/api/friends/suggestions')
+def api_friend_suggestions():
+    """API接口："可能认识的人"，按共同好友数排序，由内存里的好友关系图计算"""
+    user_id = session.get('user_id')
+    if not user_id:
+        return jsonify({'error': '请先登录'}), 401
+
+    limit = min(max(request.args.get('limit', SUGGESTION_LIMIT, type=int), 1), MAX_SUGGESTIONS)
+    items = []
+    for uid, name, avatar, version, mutual in suggest(get_db(), user_id, limit):
+        remember(uid, avatar, version)
+        items.append({'id': uid, 'username': name, 'avatar_url': avatar_url(avatar, version, 'small'),
+                      'mutual': mutual})
+    return jsonify({'items': items})
+
+
 @fr.route('/addfriend', methods=['GET', 'POST'])
+@cached
 def addfriend():
     if request.method == 'GET':
         return render_template('addfriend.html', user_list='get')
     
     elif request.method == 'POST':
-        db = init_db()
+        db = get_db()
         search = request.form.get('search', '').strip()
+        page = max(request.form.get('page', 1, type=int), 1)
         
         if not search:
             return render_template('addfriend.html', user_list=None)
         
-        user_list = search_user(db, search)
+        # 多取一条用来判断还有没有下一页
+        user_list = search_user(db, search, SEARCH_LIMIT + 1, (page - 1) * SEARCH_LIMIT)
         
+        # 没有全文索引时输多长都只能按前缀搜，就不提示了
+        short = len(search) < SEARCH_MIN_CONTAINS and has_search_index(db)
         if user_list == 'NoInput':
             return render_template('addfriend.html', user_list=None)
         elif not user_list:
-            return render_template('addfriend.html', user_list=None)
+            return render_template('addfriend.html', user_list=None, short_query=short)
         
-        return render_template('addfriend.html', user_list=user_list)
+        return render_template(
+            'addfriend.html',
+            user_list=user_list[:SEARCH_LIMIT],
+            page=page,
+            has_more=len(user_list) > SEARCH_LIMIT,
+            short_query=short
+        )
 
 # 添加处理好友请求的路由
 @fr.route('/add_friend_action', methods=['POST'])
@@ -265,7 +563,7 @@ def add_friend_action():
     friend_username = request.form.get('friend_username')
     current_user = session['current_user']
     
-    db = init_db()
+    db = get_db()
 
     userid = get_user_id(db, current_user)
     
@@ -275,25 +573,19 @@ def add_friend_action():
         flash('❌用户不存在', 'error')
         return redirect('/addfriend')
     
-    # 检查是否已经是好友
-    current_friends = get_friends(db, current_user)
-    if current_friends:
-        friends_list = current_friends.split(',')
-        if str(friend_id) in friends_list:
-            flash('❌已经是好友了', 'warning')
-            return redirect('/addfriend')
-    
-    friend_friend_request = get_friend_request(db, friend_username)
-    if friend_friend_request:
-            friend_friend_request = friend_friend_request.split(',')
-    else:
-        friend_friend_request = []
-
-    if str(userid) in friend_friend_request:
+    # 检查是否已经是好友、是否已经发过请求，都在写线程里和写入一起完成
+    try:
+        result = writer.execute(send_friend_request, userid, friend_id)
+    except writer.WriteBusy as busy:
+        return busy_redirect(busy, '/addfriend',
+                             lambda result: result == 'sent' and request_sent(userid, current_user, friend_id))
+    if result == 'already_friends':
+        flash('❌已经是好友了', 'warning')
+        return redirect('/addfriend')
+    if result == 'already_requested':
         flash(f'❌已经给Ta发送请求啦, 不要重复发送哦')
         return redirect('/addfriend')
-    friend_friend_request.append(str(userid))
-    update_friend_request(db, friend_friend_request, friend_username)
+    request_sent(userid, current_user, friend_id)
     
     flash(f'✅ 已发送好友请求给 {friend_username}', 'success')
     return redirect('/addfriend')
\ No newline at end of file
@@ -0,0 +1,140 @@
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+import queue
+import sqlite3
+import threading
+import time
+
+from app.db import connect, get_pool
+from app.metrics import Histogram
+
+BATCH_SIZE = 256     # 一次提交最多合并的写操作数
+WAIT_TIMEOUT = 10    # 秒，等待写入完成的最长时间
+RETRIES = 3          # 数据库被其他连接锁住时整批重试的次数
+
+batch_size = Histogram('db_write_batch_size', '每次提交合并的写操作数', buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+commit_seconds = Histogram('db_write_commit_seconds', '写队列每批从开始事务到提交完成的耗时')
+
+
+class WriteBusy(Exception):
+    """等不到写操作完成：排队超时，或者数据库一直被锁住
+
+    排队超时的操作还在队列里，之后仍可能提交（future 不为 None），调用方不能当作没写入；
+    数据库被锁住时整批已经回滚，操作没有生效（future 为 None）。
+    """
+
+    def __init__(self, future=None):
+        super().__init__('写入排队超时' if future is not None else '数据库繁忙')
+        self.future = future
+
+    def then(self, callback):
+        """排队超时的操作之后真的提交了，再调用 callback(op 的返回值)，比如让页面缓存失效
+
+        callback 在单独的线程里调用（不占用写线程），里面可以再使用写队列。
+        """
+        if self.future is None:
+            return
+
+        def done(future):
+            if future.exception() is None:
+                threading.Thread(target=callback, args=(future.result(),), name='db-write-late', daemon=True).start()
+        self.future.add_done_callback(done)
+
+
+class WriteQueue:
+    """单线程写队列：把并发提交的写操作合并到同一个事务里提交（group commit）
+
+    每个写操作是一个 op(db, *args) 函数，在自己的 SAVEPOINT 里执行，
+    出错只回滚它自己，不影响同一批的其他操作。提交成功后才通知调用方。
+    写线程的连接使用 synchronous=FULL，提交返回时数据已经落盘，
+    并发的写操作越多，每次落盘分摊到的操作就越多。
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+                self._thread.start()
+
+    def submit(self, op, *args):
+        """提交一个写操作，返回 Future，结果是 op 的返回值"""
+        self._start()
+        future = Future()
+        self._queue.put((op, args, future))
+        return future
+
+    def _run(self):
+        db = connect(get_pool().path)
+        db.conn.isolation_level = None  # 事务由这里显式控制
+        db.conn.execute("PRAGMA synchronous = FULL")
+        while True:
+            batch = [self._queue.get()]
+            # 排队中的写操作一次取完，合并成一个事务
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            batch_size.observe(len(batch))
+            self._apply(db, batch)
+
+    def _apply(self, db, batch):
+        conn = db.conn
+        for attempt in range(RETRIES):
+            results = []
+            start = time.perf_counter()
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                for op, args, future in batch:
+                    conn.execute("SAVEPOINT op")
+                    try:
+                        results.append((future, op(db, *args), None))
+                        conn.execute("RELEASE op")
+                    except Exception as e:
+                        conn.execute("ROLLBACK TO op")
+                        conn.execute("RELEASE op")
+                        results.append((future, None, e))
+                conn.execute("COMMIT")
+                commit_seconds.observe(time.perf_counter() - start)
+                break
+            except Exception as e:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                # 其他连接正在写（busy_timeout 也等不到），整批稍后重试；写操作只改数据库，重做是安全的
+                if isinstance(e, sqlite3.OperationalError) and 'locked' in str(e) and attempt + 1 < RETRIES:
+                    time.sleep(0.05 * (attempt + 1))
+                    continue
+                for op, args, future in batch:
+                    future.set_exception(e)
+                return
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+
+writer = WriteQueue()
+
+
+def submit(op, *args):
+    """提交写操作，不等待完成"""
+    return writer.submit(op, *args)
+
+
+def execute(op, *args, timeout=WAIT_TIMEOUT):
+    """提交写操作并等待提交落盘，返回 op 的返回值
+
+    等不到（超时，或者数据库一直被锁住）时抛出 WriteBusy，和 HashingBusy 一样由页面返回"服务器繁忙"。
+    """
+    future = writer.submit(op, *args)
+    try:
+        return future.result(timeout)
+    except FutureTimeout:
+        raise WriteBusy(future) from None
+    except sqlite3.OperationalError as e:
+        raise WriteBusy() from e
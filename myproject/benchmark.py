@@ -0,0 +1,468 @@
+"""性能基准测试
+
+用法：
+    python benchmark.py run --users 2000 --concurrency 8 --duration 10 -o before.json
+        复制一份项目到临时目录，生成测试数据，用 waitress 启动网站，逐个压测主要页面
+    python benchmark.py run --url http://127.0.0.1:5000 -o result.json
+        压测一个已经在运行、并且已经用 seed 生成过测试数据的网站
+    python benchmark.py seed --users 2000
+        给当前目录下的数据库生成测试数据（run 会在临时目录里自动执行）
+    python benchmark.py compare before.json after.json
+        对比两次结果，延迟或吞吐量变差超过阈值时返回非零退出码
+"""
+import argparse
+import http.client
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from urllib.parse import urlencode, urlsplit
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+USERNAME_FORMAT = 'user{:06d}'   # 测试用户名，压测时按编号随机挑选
+PASSWORD = 'benchmark'
+ROUTES = ['login', 'register', 'check_username', 'home', 'friend_list', 'addfriend', 'upload_image']
+# 对比时延迟差值小于这个数（毫秒）当作噪声
+MIN_DELTA_MS = 1.0
+# 上传头像后个人资料页上的提示：上传被接受、后台还在处理、出错
+AVATAR_ACCEPTED = ('✅ 头像已上传', '✅ 头像上传成功')
+AVATAR_PROCESSING = '新头像正在处理中'
+AVATAR_FAILED = '❌'
+AVATAR_WAIT = 30          # 秒，上传后最多等多久头像处理完成
+AVATAR_POLL_INTERVAL = 0.05
+
+
+# ---------- 生成测试数据 ----------
+
+def seed(args):
+    """在当前项目的数据库里生成用户、好友关系、好友请求和头像
+
+    用户和好友关系由 app.bulk.generate 生成（和 manage.py seed-users 一样），好友数是长尾分布。
+    """
+    import bcrypt
+    from app import db, hashing, avatar, bulk
+
+    rng = random.Random(args.seed)
+    pwd_hash = bcrypt.hashpw(PASSWORD.encode(), bcrypt.gensalt(hashing.BCRYPT_ROUNDS)).decode()
+    with db.connection() as conn:
+        if conn.conn.execute("SELECT count(*) FROM users").fetchone()[0] and not args.force:
+            sys.exit('❌ 数据库里已经有用户了，确认要继续生成请加 --force')
+        start = time.perf_counter()
+        ids, pairs, requests = bulk.generate(conn, args.users, args.friends, args.requests, pwd_hash=pwd_hash,
+                                             username_format=USERNAME_FORMAT, seed=args.seed)
+        print(f'✅ 已生成 {len(ids)} 个用户，{pairs} 对好友，{requests} 个好友请求 '
+              f'({time.perf_counter() - start:.1f}s)')
+
+        with_avatar = rng.sample(list(ids), min(args.avatars, len(ids)))
+        if with_avatar:
+            try:
+                import PIL  # noqa: F401
+            except ImportError:
+                print('⚠️ 未安装 Pillow，跳过头像')
+                return
+            os.makedirs(avatar.STAGING_FOLDER, exist_ok=True)
+            for user_id in with_avatar:
+                staging_path = os.path.join(avatar.STAGING_FOLDER, f'seed_{user_id}')
+                with open(staging_path, 'wb') as f:
+                    f.write(sample_image(rng))
+                prefix = avatar.render_avatar(staging_path, user_id)
+                os.remove(staging_path)
+                conn.conn.execute(
+                    "UPDATE users SET avatar = ?, avatar_version = avatar_version + 1 WHERE id = ?",
+                    (prefix, user_id)
+                )
+            conn.conn.commit()
+            print(f'✅ 已生成 {len(with_avatar)} 个头像')
+
+
+def sample_image(rng, size=256):
+    """生成一张随机颜色的JPEG，用来当测试头像和上传的图片"""
+    import io
+    from PIL import Image
+
+    image = Image.new('RGB', (size, size), tuple(rng.randrange(256) for _ in range(3)))
+    image.paste(tuple(rng.randrange(256) for _ in range(3)), (size // 4, size // 4, size * 3 // 4, size * 3 // 4))
+    output = io.BytesIO()
+    image.save(output, 'JPEG', quality=90)
+    return output.getvalue()
+
+
+# ---------- 启动被测网站 ----------
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def copy_project(target):
+    """复制项目代码和静态资源，不带数据库、构建产物和用户上传的头像"""
+    def ignore(directory, names):
+        ignored = {name for name in names if name.startswith('database.db') or name in ('__pycache__', 'dist')}
+        if os.path.basename(directory) == 'uploads':
+            ignored.update(name for name in names if name != 'default.png')
+        return ignored
+
+    shutil.copytree(PROJECT_DIR, target, ignore=ignore)
+
+
+def start_server(workdir, args):
+    """在复制出来的项目里生成测试数据并启动 waitress，返回 (进程, 端口)"""
+    subprocess.run(
+        [sys.executable, 'benchmark.py', 'seed', '--users', str(args.users), '--friends', str(args.friends),
+         '--requests', str(args.requests), '--avatars', str(args.avatars), '--seed', str(args.seed)],
+        cwd=workdir, check=True
+    )
+    port = free_port()
+    # 压测的请求都来自本机，关掉限流，否则登录、注册很快就只剩429
+    env = dict(os.environ, PORT=str(port), EVENTS_PORT=str(free_port()), RATELIMIT='0')
+    log = open(os.path.join(workdir, 'server.log'), 'wb')
+    server = subprocess.Popen([sys.executable, 'app.py'], cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            sys.exit(f'❌ 网站启动失败，日志见 {log.name}')
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            conn.request('GET', '/about')
+            conn.getresponse().read()
+            return server, port
+        except OSError:
+            time.sleep(0.2)
+    server.kill()
+    sys.exit(f'❌ 网站启动超时，日志见 {log.name}')
+
+
+# ---------- 压测 ----------
+
+class Client:
+    """一个虚拟用户：一条 keep-alive 连接和自己的会话 cookie"""
+
+    def __init__(self, host, port):
+        self.host, self.port = host, port
+        self.conn = None
+        self.cookie = None
+        self.body = b''
+
+    def request(self, method, path, body=None, headers=None):
+        """发一个请求，返回 (状态码, 耗时秒数)，连接出错时状态码为 None；响应内容留在 self.body"""
+        headers = dict(headers or {})
+        if self.cookie:
+            headers['Cookie'] = self.cookie
+        if self.conn is None:
+            self.conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+        start = time.perf_counter()
+        self.body = b''
+        try:
+            self.conn.request(method, path, body=body, headers=headers)
+            response = self.conn.getresponse()
+            self.body = response.read()
+        except (OSError, http.client.HTTPException):
+            self.conn.close()
+            self.conn = None
+            return None, time.perf_counter() - start
+        elapsed = time.perf_counter() - start
+        cookie = response.getheader('Set-Cookie')
+        if cookie and cookie.startswith('session='):
+            self.cookie = cookie.split(';', 1)[0]
+        return response.status, elapsed
+
+    def login(self, username):
+        status, _ = self.post_form('/login', {'username': username, 'pwd': PASSWORD})
+        return status == 302
+
+    def post_form(self, path, fields):
+        return self.request('POST', path, urlencode(fields), {'Content-Type': 'application/x-www-form-urlencoded'})
+
+
+def multipart(field, filename, data):
+    boundary = f'----benchmark{random.getrandbits(64):016x}'
+    body = (
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+        f'Content-Type: image/jpeg\r\n\r\n'
+    ).encode() + data + f'\r\n--{boundary}--\r\n'.encode()
+    return body, {'Content-Type': f'multipart/form-data; boundary={boundary}'}
+
+
+class Workload:
+    """每个路由一个场景：返回 (状态码, 耗时, 是否符合预期)"""
+
+    def __init__(self, args):
+        self.users = args.users
+        self.run_id = f'{os.getpid() % 1000:03d}{int(time.time()) % 1000:03d}'
+        self._counter = 0
+        self._lock = threading.Lock()
+        self._image = None
+
+    def random_user(self, rng):
+        return USERNAME_FORMAT.format(rng.randrange(self.users))
+
+    def image(self):
+        if self._image is None:
+            self._image = sample_image(random.Random(0), size=512)
+        return self._image
+
+    def next_name(self):
+        with self._lock:
+            self._counter += 1
+            return f'r{self.run_id}_{self._counter}'
+
+    def login(self, client, rng):
+        client.cookie = None
+        status, elapsed = client.post_form('/login', {'username': self.random_user(rng), 'pwd': PASSWORD})
+        return status, elapsed, status == 302
+
+    def register(self, client, rng):
+        name = self.next_name()
+        status, elapsed = client.post_form('/register', {'username': name, 'pwd': PASSWORD, 'confirm_pwd': PASSWORD})
+        return status, elapsed, status == 200
+
+    def check_username(self, client, rng):
+        # 一半查已经存在的用户名，一半查不存在的
+        name = self.random_user(rng) if rng.random() < 0.5 else f'free{rng.getrandbits(40):x}'
+        status, elapsed = client.request(
+            'POST', '/api/check_username', json.dumps({'username': name}), {'Content-Type': 'application/json'}
+        )
+        return status, elapsed, status == 200
+
+    def home(self, client, rng):
+        status, elapsed = client.request('GET', '/home')
+        return status, elapsed, status == 200
+
+    def friend_list(self, client, rng):
+        status, elapsed = client.request('GET', '/friend_list')
+        return status, elapsed, status == 200
+
+    def addfriend(self, client, rng):
+        name = self.random_user(rng)
+        status, elapsed = client.post_form('/addfriend', {'search': name[:rng.randrange(2, len(name) + 1)]})
+        return status, elapsed, status == 200
+
+    def upload_image(self, client, rng):
+        """上传之后不管成功失败都跳转到个人资料页，要看那里的提示，再等后台处理完才知道是不是真的成功了
+
+        耗时只算上传请求本身；等待处理的时间这个虚拟用户不发新的上传，所以吞吐量是"上传并处理完成"的速度。
+        """
+        body, headers = multipart('image', 'avatar.jpg', self.image())
+        status, elapsed = client.request('POST', '/upload_image', body, headers)
+        if status != 302:
+            return status, elapsed, False
+        client.request('GET', '/profile')
+        page = client.body.decode('utf-8', 'replace')
+        if not any(text in page for text in AVATAR_ACCEPTED):
+            return status, elapsed, False
+        deadline = time.monotonic() + AVATAR_WAIT
+        while AVATAR_PROCESSING in page and time.monotonic() < deadline:
+            time.sleep(AVATAR_POLL_INTERVAL)
+            client.request('GET', '/profile')
+            page = client.body.decode('utf-8', 'replace')
+        # 后台处理失败时，个人资料页会把原因显示一次
+        return status, elapsed, AVATAR_PROCESSING not in page and AVATAR_FAILED not in page
+
+    # 需要先登录的场景
+    LOGGED_IN = {'home', 'friend_list', 'addfriend', 'upload_image'}
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = max(0, math.ceil(p / 100 * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+def run_route(route, workload, host, port, args):
+    """用 concurrency 个线程压测一个路由，先预热再计时，返回统计结果"""
+    scenario = getattr(workload, route)
+    clients = [Client(host, port) for _ in range(args.concurrency)]
+    if route in Workload.LOGGED_IN:
+        for i, client in enumerate(clients):
+            if not client.login(USERNAME_FORMAT.format(i % workload.users)):
+                sys.exit(f'❌ 测试用户登录失败，确认已经用 seed 生成过 {workload.users} 个测试用户')
+
+    results = [[] for _ in clients]
+    errors = [0] * len(clients)
+    phase = {'record': False, 'stop': False}
+
+    def worker(i):
+        rng = random.Random(args.seed * 1000 + i)
+        while not phase['stop']:
+            status, elapsed, ok = scenario(clients[i], rng)
+            if phase['record']:
+                results[i].append(elapsed)
+                if not ok:
+                    errors[i] += 1
+
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(len(clients))]
+    for thread in threads:
+        thread.start()
+    time.sleep(args.warmup)
+    phase['record'] = True
+    started = time.perf_counter()
+    time.sleep(args.duration)
+    phase['stop'] = True
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(x for r in results for x in r)
+    count = len(latencies)
+    ms = lambda value: round(value * 1000, 3) if value is not None else None
+    return {
+        'requests': count,
+        'errors': sum(errors),
+        'throughput': round(count / elapsed, 2),
+        'mean_ms': ms(sum(latencies) / count) if count else None,
+        'p50_ms': ms(percentile(latencies, 50)),
+        'p95_ms': ms(percentile(latencies, 95)),
+        'p99_ms': ms(percentile(latencies, 99)),
+        'max_ms': ms(latencies[-1]) if count else None,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=PROJECT_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    routes = args.routes.split(',') if args.routes else ROUTES
+    unknown = set(routes) - set(ROUTES)
+    if unknown:
+        sys.exit(f'❌ 未知的路由: {", ".join(sorted(unknown))}')
+
+    server = workdir = None
+    if args.url:
+        url = urlsplit(args.url)
+        host, port = url.hostname, url.port or 80
+    else:
+        workdir = tempfile.mkdtemp(prefix='benchmark-')
+        copy_project(os.path.join(workdir, 'project'))
+        workdir = os.path.join(workdir, 'project')
+        server, port = start_server(workdir, args)
+        host = '127.0.0.1'
+
+    workload = Workload(args)
+    report = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'users': args.users,
+            'concurrency': args.concurrency,
+            'duration': args.duration,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+        },
+        'routes': {},
+    }
+    try:
+        for route in routes:
+            print(f'⏱️ {route} ...', file=sys.stderr)
+            stats = report['routes'][route] = run_route(route, workload, host, port, args)
+            print(f'   {stats["throughput"]} req/s, p50 {stats["p50_ms"]}ms, p95 {stats["p95_ms"]}ms, '
+                  f'p99 {stats["p99_ms"]}ms, 错误 {stats["errors"]}', file=sys.stderr)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(10)
+            if args.keep:
+                print(f'📁 测试目录保留在 {workdir}', file=sys.stderr)
+            else:
+                shutil.rmtree(os.path.dirname(workdir), ignore_errors=True)
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+# ---------- 对比 ----------
+
+def compare(args):
+    """逐个路由对比 p50/p95/p99 和吞吐量，变差超过阈值的标记为退化"""
+    with open(args.base, encoding='utf-8') as f:
+        base = json.load(f)['routes']
+    with open(args.new, encoding='utf-8') as f:
+        new = json.load(f)['routes']
+
+    regressions = []
+    print(f'{"路由":<16}{"指标":<12}{"基准":>12}{"本次":>12}{"变化":>10}')
+    for route in [r for r in base if r in new]:
+        for metric in ('throughput', 'p50_ms', 'p95_ms', 'p99_ms'):
+            before, after = base[route].get(metric), new[route].get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            if metric == 'throughput':
+                worse = change < -args.threshold
+            else:
+                worse = change > args.threshold and after - before >= MIN_DELTA_MS
+            flag = '  ⚠️ 退化' if worse else ''
+            print(f'{route:<16}{metric:<12}{before:>12}{after:>12}{change:>+10.1%}{flag}')
+            if worse:
+                regressions.append((route, metric))
+        before, after = base[route].get('errors', 0), new[route].get('errors', 0)
+        if after > before:
+            print(f'{route:<16}{"errors":<12}{before:>12}{after:>12}{"":>10}  ⚠️ 退化')
+            regressions.append((route, 'errors'))
+
+    if regressions:
+        print(f'\n❌ {len(regressions)} 项指标退化超过 {args.threshold:.0%}')
+        sys.exit(1)
+    print(f'\n✅ 没有超过 {args.threshold:.0%} 的退化')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='性能基准测试')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    def population(p):
+        p.add_argument('--users', type=int, default=2000, help='测试用户数')
+        p.add_argument('--friends', type=int, default=20, help='平均每人的好友数')
+        p.add_argument('--requests', type=int, default=5, help='每个用户收到的好友请求数')
+        p.add_argument('--avatars', type=int, default=200, help='生成头像的用户数')
+        p.add_argument('--seed', type=int, default=1, help='随机数种子，相同的种子生成相同的数据')
+
+    p = commands.add_parser('run', help='生成测试数据、启动网站并压测')
+    population(p)
+    p.add_argument('--url', help='压测已经在运行的网站，不再自动启动')
+    p.add_argument('--routes', help=f'逗号分隔，默认全部：{",".join(ROUTES)}')
+    p.add_argument('--concurrency', type=int, default=8, help='并发虚拟用户数')
+    p.add_argument('--duration', type=float, default=10, help='每个路由计时多少秒')
+    p.add_argument('--warmup', type=float, default=2, help='每个路由计时前预热多少秒')
+    p.add_argument('--keep', action='store_true', help='保留临时目录（数据库和服务器日志）')
+    p.add_argument('-o', '--output', help='结果写到这个JSON文件，默认输出到标准输出')
+    p.set_defaults(func=run)
+
+    p = commands.add_parser('seed', help='给当前目录的数据库生成测试数据')
+    population(p)
+    p.add_argument('--force', action='store_true', help='数据库里已经有用户时也继续生成')
+    p.set_defaults(func=seed)
+
+    p = commands.add_parser('compare', help='对比两次结果')
+    p.add_argument('base')
+    p.add_argument('new')
+    p.add_argument('--threshold', type=float, default=0.10, help='允许的变化比例，默认 0.10')
+    p.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
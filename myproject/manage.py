@@ -0,0 +1,129 @@
+"""命令行管理工具
+
+用法：
+    python manage.py backfill-avatars   扫描上传目录，把已有头像登记到数据库
+    python manage.py build-assets       给静态资源加内容哈希并预压缩
+    python manage.py gc-avatars         删掉被替换超过保留期的旧头像文件
+    python manage.py import-users users.csv        批量导入用户（CSV/JSONL，明文密码或 bcrypt 哈希）
+    python manage.py export-users -o users.jsonl   导出全部用户，导出的文件可以直接再导入
+    python manage.py seed-users --users 100000     生成测试用户、好友关系和好友请求
+
+导入、导出、生成都可以加 --db 指定数据库文件，比如生成一个单独的库来估算数据量。
+"""
+import argparse
+import os
+import sys
+import time
+
+from app import db, avatar, assets, bulk, suggestions
+
+# 正在运行的网站几秒内就能识别新用户名（usernames.CATCH_UP_INTERVAL），好友关系图要等定期重建
+SEED_HINT = '⚠️ 正在运行的网站最多 {} 分钟后才会用新的好友关系计算"可能认识的人"'
+
+
+def backfill_avatars(args):
+    """扫描一次上传目录，登记还没有头像记录的用户"""
+    with db.connection() as conn:
+        count = avatar.backfill(conn.conn)
+        conn.conn.commit()
+    print(f'✅ 已登记 {count} 个头像')
+
+
+def build_assets(args):
+    """生成带内容哈希的静态资源和 gzip/brotli 预压缩文件"""
+    count = assets.build()
+    print(f'✅ 已构建 {count} 个静态文件 -> {assets.BUILD_FOLDER}')
+    if assets.brotli is None:
+        print('⚠️ 未安装 brotli，只生成了 gzip 预压缩文件')
+
+
+def gc_avatars(args):
+    """扫描全部头像目录，删掉不再使用的旧版本"""
+    count = avatar.collect_garbage(grace=args.grace)
+    print(f'✅ 已删除 {count} 个旧头像文件')
+
+
+def open_db(args):
+    """导入导出只需要一个连接，--db 指定时用那个数据库文件（不存在就新建并迁移）"""
+    db.init_pool(path=args.db or db.DB_PATH, size=1)
+
+
+def import_users(args):
+    """边读边导入，明文密码由进程池计算哈希"""
+    open_db(args)
+    fmt = bulk.detect_format(args.file, args.format)
+    start = time.perf_counter()
+    with open(args.file, newline='', encoding='utf-8') if args.file != '-' else sys.stdin as stream:
+        with db.connection() as conn:
+            stats = bulk.import_users(conn, bulk.read_rows(stream, fmt), update=args.update,
+                                      rounds=args.rounds, workers=args.workers, batch_size=args.batch_size)
+    print(f'✅ {stats} ({time.perf_counter() - start:.1f}s)')
+
+
+def export_users(args):
+    """按 id 顺序分批导出，包括密码哈希"""
+    open_db(args)
+    fmt = bulk.detect_format(args.output, args.format)
+    with open(args.output, 'w', newline='', encoding='utf-8') if args.output != '-' else sys.stdout as stream:
+        with db.connection() as conn:
+            count = bulk.export_users(conn, stream, fmt, batch_size=args.batch_size)
+    print(f'✅ 已导出 {count} 个用户', file=sys.stderr)
+
+
+def seed_users(args):
+    """生成测试数据，最后报告数据库文件大小，用来估算生产环境的数据量"""
+    open_db(args)
+    start = time.perf_counter()
+    with db.connection() as conn:
+        ids, pairs, sent = bulk.generate(conn, args.users, args.friends, args.requests, seed=args.seed,
+                                         batch_size=args.batch_size)
+    size = os.path.getsize(args.db or db.DB_PATH)
+    print(f'✅ 已生成 {len(ids)} 个用户，{pairs} 对好友，{sent} 个好友请求 '
+          f'({time.perf_counter() - start:.1f}s，数据库 {size / 1024 / 1024:.1f} MB)')
+    print(SEED_HINT.format(suggestions.REBUILD_INTERVAL // 60))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='网站管理工具')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    commands.add_parser('backfill-avatars', help='扫描上传目录，把已有头像登记到数据库').set_defaults(func=backfill_avatars)
+    commands.add_parser('build-assets', help='给静态资源加内容哈希并预压缩').set_defaults(func=build_assets)
+
+    gc = commands.add_parser('gc-avatars', help='删掉被替换超过保留期的旧头像文件')
+    gc.add_argument('--grace', type=int, default=avatar.GC_GRACE, help=f'旧文件保留秒数，默认 {avatar.GC_GRACE}')
+    gc.set_defaults(func=gc_avatars)
+
+    def bulk_options(p):
+        p.add_argument('--db', help='数据库文件，默认是网站用的 database.db')
+        p.add_argument('--batch-size', type=int, default=bulk.BATCH_SIZE, help=f'每个事务的行数，默认 {bulk.BATCH_SIZE}')
+
+    p = commands.add_parser('import-users', help='批量导入用户（CSV/JSONL）')
+    p.add_argument('file', help='要导入的文件，- 表示标准输入；每行要有 username，以及 password 或 pwd_hash')
+    p.add_argument('--format', choices=bulk.FORMATS, help='默认按扩展名判断，.jsonl 以外都当作 CSV')
+    p.add_argument('--update', action='store_true', help='用户名已存在时覆盖密码哈希（默认跳过）')
+    p.add_argument('--rounds', type=int, help='bcrypt 计算强度，默认和网站一致')
+    p.add_argument('--workers', type=int, help='计算哈希的进程数，默认 CPU 核数')
+    bulk_options(p)
+    p.set_defaults(func=import_users)
+
+    p = commands.add_parser('export-users', help='导出全部用户（CSV/JSONL）')
+    p.add_argument('-o', '--output', default='-', help='输出文件，默认标准输出')
+    p.add_argument('--format', choices=bulk.FORMATS, help='默认按扩展名判断，.jsonl 以外都当作 CSV')
+    bulk_options(p)
+    p.set_defaults(func=export_users)
+
+    p = commands.add_parser('seed-users', help='生成测试用户、好友关系和好友请求')
+    p.add_argument('--users', type=int, default=10000, help='用户数')
+    p.add_argument('--friends', type=int, default=20, help='平均每人的好友数')
+    p.add_argument('--requests', type=int, default=5, help='每人收到的好友请求数')
+    p.add_argument('--seed', type=int, default=1, help='随机数种子，相同的种子生成相同的数据')
+    bulk_options(p)
+    p.set_defaults(func=seed_users)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
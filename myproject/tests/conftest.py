@@ -0,0 +1,26 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_DIR)
+
+
+@pytest.fixture(scope='session')
+def app(tmp_path_factory):
+    """app.py 里的网站，数据库换成临时文件，整个测试过程共用一个连接池"""
+    from app import db
+    db.init_pool(str(tmp_path_factory.mktemp('db') / 'test.db'), size=4)
+    # app.py 和 app 包同名，按文件路径加载
+    spec = importlib.util.spec_from_file_location('site_main', os.path.join(PROJECT_DIR, 'app.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.app.config['TESTING'] = True
+    return module.app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
@@ -0,0 +1,30 @@
+from concurrent.futures import Future
+import threading
+import time
+
+from app import avatar, writer
+from app.db import connection
+
+
+def test_busy_write_keeps_processing_until_commit(app, monkeypatch, tmp_path):
+    user_id = writer.execute(lambda db: db.conn.execute(
+        "INSERT INTO users (username, pwd_hash) VALUES ('avatarbusy', 'x')").lastrowid)
+    monkeypatch.setattr(writer.execute, '__kwdefaults__', {'timeout': 0.3})
+    release = threading.Event()
+    writer.submit(lambda db: release.wait(10))
+
+    with avatar._jobs_lock:
+        avatar._pending[user_id] = None
+    rendered = Future()
+    rendered.set_result((f'{user_id}/abc123', 0.01))
+    avatar._finish_avatar(rendered, user_id, str(tmp_path / 'staging'))
+    # 写队列排队超时不算失败，页面继续显示"处理中"
+    assert avatar.avatar_status(user_id) == (True, None)
+
+    release.set()
+    deadline = time.monotonic() + 5
+    while avatar.avatar_status(user_id)[0] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert avatar.avatar_status(user_id) == (False, None)
+    with connection() as db:
+        assert db.conn.execute("SELECT avatar FROM users WHERE id = ?", (user_id,)).fetchone()[0] == f'{user_id}/abc123'
@@ -0,0 +1,39 @@
+import socket
+
+from app.events import EventGateway
+from app.pubsub import user_channel
+
+
+def publish(gateway, n):
+    # 没有启动推送线程，给个能写的唤醒 socket 就行
+    gateway._wake_r, gateway._wake_w = socket.socketpair()
+    for i in range(n):
+        gateway._on_publish(user_channel(1), {'type': 'message', 'data': {'n': i}})
+
+
+def test_ids_carry_boot_epoch():
+    gateway = EventGateway()
+    publish(gateway, 2)
+    body = gateway._poll_body(gateway._events_since(user_channel(1), 0), 0)
+    assert [e['id'] for e in body['events']] == [f"{gateway.epoch}:1", f"{gateway.epoch}:2"]
+    assert body['last'] == gateway.last_id == f"{gateway.epoch}:2"
+
+
+def test_restarted_gateway_replays_events_for_old_ids():
+    old = EventGateway()
+    publish(old, 5)
+    # 重启后序号从头开始，旧编号里的序号比新事件大，不能拿来过滤
+    new = EventGateway()
+    publish(new, 2)
+    since = new._parse_since(old.last_id)
+    assert since == 0
+    assert [seq for seq, _ in new._events_since(user_channel(1), since)] == [1, 2]
+
+
+def test_since_within_same_epoch():
+    gateway = EventGateway()
+    publish(gateway, 3)
+    assert gateway._parse_since(f"{gateway.epoch}:1") == 1
+    assert gateway._parse_since('') == 3
+    assert gateway._parse_since('7') == 3
+    assert gateway._parse_since(f"{gateway.epoch}:x") == 3
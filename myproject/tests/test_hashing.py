@@ -0,0 +1,42 @@
+import threading
+import time
+
+import pytest
+
+from app import hashing
+
+
+@pytest.fixture
+def saturated():
+    """占满计算和排队的全部名额，测试结束后放行"""
+    hashing.init(16)
+    release = threading.Event()
+    threads = [threading.Thread(target=hashing._run, args=(lambda: release.wait(10),), daemon=True)
+               for _ in range(hashing._slots._initial_value)]
+    for thread in threads:
+        thread.start()
+    deadline = time.monotonic() + 5
+    while hashing._slots._value and time.monotonic() < deadline:
+        time.sleep(0.01)
+    yield
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    hashing.init(16)
+
+
+def test_slots_leave_request_threads_free():
+    hashing.init(16)
+    assert hashing._slots._initial_value < 16
+
+
+def test_rejects_when_slots_are_full(saturated):
+    with pytest.raises(hashing.HashingBusy):
+        hashing.hash_password('pw123456')
+
+
+def test_register_asks_to_retry_when_busy(saturated, client):
+    response = client.post('/register', data={'username': 'busyuser', 'pwd': 'pw123456', 'confirm_pwd': 'pw123456'})
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+    assert '服务器繁忙' in response.get_data(as_text=True)
@@ -0,0 +1,31 @@
+import pytest
+
+from app import writer
+from app.db import connection
+from app.views.friend import search_user
+
+
+@pytest.fixture(scope='module')
+def users(app):
+    # 中间包含关键字的用户排在一大批用户之后，逐个扫描前面一部分用户名时会漏掉它
+    names = [f'filler{i:05d}' for i in range(5000)] + ['kwmatch', 'xx_kwmatch']
+    writer.execute(lambda db: db.conn.executemany(
+        "INSERT INTO users (username, pwd_hash) VALUES (?, 'x')", [(name,) for name in names]
+    ))
+
+
+def test_finds_contains_match_after_many_users(users):
+    with connection() as db:
+        assert search_user(db, 'kwmatch') == ['kwmatch', 'xx_kwmatch']
+
+
+def test_short_query_only_matches_prefix(users):
+    with connection() as db:
+        assert search_user(db, 'kw') == ['kwmatch']
+
+
+def test_short_query_shows_hint(users, client):
+    page = client.post('/addfriend', data={'search': 'kw'}).get_data(as_text=True)
+    assert 'kwmatch' in page
+    assert 'xx_kwmatch' not in page
+    assert '输入至少3个字符' in page
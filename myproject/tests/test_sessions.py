@@ -0,0 +1,25 @@
+import threading
+
+import pytest
+
+from app import writer
+
+
+@pytest.fixture
+def stalled_writer(app, monkeypatch):
+    """让写库线程卡在一个操作上，后面排队的写都要等它，等待写库的请求很快就算超时"""
+    monkeypatch.setattr(writer.execute, '__kwdefaults__', {'timeout': 0.3})
+    release = threading.Event()
+    writer.submit(lambda db: release.wait(10))
+    yield
+    release.set()
+
+
+def test_logout_does_not_wait_for_writes(stalled_writer, client):
+    with client.session_transaction() as sess:
+        sess['user_id'] = 1
+        sess['current_user'] = 'someone'
+    response = client.get('/logout')
+    assert response.status_code == 302
+    with client.session_transaction() as sess:
+        assert 'user_id' not in sess